@@ -1,16 +1,25 @@
 # Uncomment this to pass the first stage
 import sys
 import socket
-from threading import Thread, Lock, Event, RLock
+import selectors
+import heapq
+import threading
+from collections import deque
+from threading import Thread, Lock, Event, RLock, Condition
 from typing import Union, Any
 from enum import Enum
 import time
 import random
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import argparse
 import secrets
-import re
 import struct
+import bisect
+from array import array
+import os
+import fnmatch
+import mmap
+import signal
 
 # import fastcrc
 # import crc
@@ -20,6 +29,38 @@ def millis():
     return int(time.time() * 1000)
 
 
+# Expire times are kept in a signed 64-bit array
+EXPIRE_TIME_MIN = -(1 << 63)
+EXPIRE_TIME_MAX = (1 << 63) - 1
+
+
+def expire_time(when: int, unit: int, absolute: bool):
+    """
+    Returns the unix time in milliseconds of when, given in units of unit
+    milliseconds and relative to now unless absolute, or None if it does
+    not fit in the expiry index.
+    """
+    when *= unit
+    if not absolute:
+        when += millis()
+    return when if EXPIRE_TIME_MIN <= when <= EXPIRE_TIME_MAX else None
+
+
+def bytes_to_human(n: int):
+    for unit in ("B", "K", "M", "G", "T"):
+        if n < 1024 or unit == "T":
+            return f"{n}{unit}" if unit == "B" else f"{n:.2f}{unit}"
+        n /= 1024
+
+
+def rss_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
 class RESPBytes(bytes):
     def rstrip_all(self, strip_str):
         """
@@ -55,392 +96,1579 @@ class RESPBytes(bytes):
         return count, result
 
 
-class RESPStr(str):
-    def rstrip_all(self, strip_str):
+class Stream(object):
+    """
+    Stream storage engine.
+
+    Entry IDs are kept as packed (ms, seq) integers in two parallel arrays, in
+    ascending order, so XADD is an append and range lookups are a bisect over
+    the milliseconds followed by a bisect over the sequence numbers sharing
+    them. Field names are stored once per run of entries with the same
+    fields, values are stored as one tuple per entry.
+    """
+
+    __slots__ = ("_ms", "_seq", "_names", "_values", "nbytes")
+
+    MAX_SEQ = (1 << 64) - 1
+
+    def __init__(self):
+        self._ms = array("Q")
+        self._seq = array("Q")
+        self._names: list[tuple] = []
+        self._values: list[tuple] = []
+
+        # Estimated size of the entries, see estimate_size()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._ms)
+
+    @property
+    def last_id(self):
         """
-        Efficiently strips all occurrences of strip_str from the end of the string
-        and returns the count of occurrences stripped.
+        Returns the (ms, seq) ID of the top entry, or (0, 0) if empty.
+        """
+        if not self._ms:
+            return 0, 0
+        return self._ms[-1], self._seq[-1]
 
-        Args:
-        - strip_str: The string to be stripped from the end of the string
+    def add(self, ms: int, seq: int, fields: list):
+        """
+        Appends an entry, its ID must be greater than the top entry's.
+        """
+        names = tuple(fields[0::2])
+        values = tuple(fields[1::2])
 
-        Returns:
-        - The count of occurrences of strip_str stripped from the end of the string
+        nbytes = 32 + sys.getsizeof(values) + sum(map(sys.getsizeof, values))
+
+        # Share the field names tuple with the previous entry when possible
+        if self._names and self._names[-1] == names:
+            names = self._names[-1]
+        else:
+            nbytes += sys.getsizeof(names) + sum(map(sys.getsizeof, names))
+
+        self._ms.append(ms)
+        self._seq.append(seq)
+        self._names.append(names)
+        self._values.append(values)
+        self.nbytes += nbytes
+
+    def lower_bound(self, ms: int, seq: int):
         """
-        # Initialize count of occurrences stripped
-        count = 0
+        Returns the index of the first entry with ID >= ms-seq.
+        """
+        lo = bisect.bisect_left(self._ms, ms)
+        hi = bisect.bisect_right(self._ms, ms, lo)
+        return bisect.bisect_left(self._seq, seq, lo, hi)
 
-        # Calculate the length of strip_str
-        strip_len = len(strip_str)
+    def upper_bound(self, ms: int, seq: int):
+        """
+        Returns the index of the first entry with ID > ms-seq.
+        """
+        lo = bisect.bisect_left(self._ms, ms)
+        hi = bisect.bisect_right(self._ms, ms, lo)
+        return bisect.bisect_right(self._seq, seq, lo, hi)
 
-        # Convert self to a mutable string
-        mutable_str = bytearray(self, "utf-8")
+    def entry(self, idx: int):
+        """
+        Returns the entry at idx as its formatted ID and a flat list of
+        field/value pairs.
+        """
+        fields = []
+        for name, value in zip(self._names[idx], self._values[idx]):
+            fields.append(name)
+            fields.append(value)
+        return Stream.format_id(self._ms[idx], self._seq[idx]), fields
 
-        # Iterate over the end of the string, checking if it ends with strip_str
-        while mutable_str.endswith(strip_str.encode()):
-            # Strip strip_str from the end of the string
-            del mutable_str[-strip_len:]
-            # Increment count of occurrences stripped
-            count += 1
+    def entry_parts(self, idx: int):
+        """
+        Returns the ms, seq, field names and values of the entry at idx
+        without building any intermediate list.
+        """
+        return self._ms[idx], self._seq[idx], self._names[idx], self._values[idx]
 
-        # Convert the mutable string back to a regular string
-        result = mutable_str.decode()
+    def entries(self, start: int = 0, end: int = None):
+        """
+        Iterates over the entries in [start, end) without copying the range.
+        """
+        if end is None:
+            end = len(self._ms)
 
-        return count, result
+        for idx in range(start, end):
+            yield self.entry(idx)
 
+    @staticmethod
+    def format_id(ms: int, seq: int):
+        return f"{ms}-{seq}"
 
-class StreamEntry(dict):
-    def __init__(self, *args, **kwargs):
-        if "id" not in kwargs:
-            kwargs["id"] = f"{str(millis())}-0"
-        super().__init__(*args, **kwargs)
+    @staticmethod
+    def parse_id(id: str):
+        """
+        Parses "<ms>-<seq>", "<ms>-*", "<ms>" and "*" stream IDs without
+        regular expressions. A missing or "*" part is returned as -1 and
+        (-1, -1) is returned for invalid IDs.
+        """
+        if id == "*":
+            return -1, -1
 
-    def __lt__(self, other):
-        if "id" in self and "id" in other:
-            # return self["id"] < other["id"]
+        ms, sep, seq = id.partition("-")
+        if not ms.isdigit() or int(ms) > Stream.MAX_SEQ:
+            return -1, -1
+        if not sep or seq == "*":
+            return int(ms), -1
+        if not seq.isdigit() or int(seq) > Stream.MAX_SEQ:
+            return -1, -1
 
-            time, seq = Stream.parse_id(self["id"])
-            other_time, other_seq = Stream.parse_id(other["id"])
+        return int(ms), int(seq)
 
-            if time > other_time:
-                return False
-            elif time == other_time:
-                if seq < other_seq:
-                    return True
-                else:
-                    return False
-            return True
-        else:
-            raise ValueError("Both objects must have an 'id' key for comparison")
 
-    def __gt__(self, other):
-        if "id" in self and "id" in other:
-            # return self["id"] > other["id"]
+class StreamError(ValueError):
+    def __init__(self, message):
+        super(StreamError, self).__init__(message)
 
-            time, seq = Stream.parse_id(self["id"])
-            other_time, other_seq = Stream.parse_id(other["id"])
 
-            if time < other_time:
-                return False
-            elif time == other_time:
-                if seq > other_seq:
-                    return True
-                else:
-                    return False
-            return True
-        else:
-            raise ValueError("Both objects must have an 'id' key for comparison")
+class ZSet(dict):
+    """
+    A sorted set loaded from an RDB file, as a member to score mapping.
+    """
 
-    def __eq__(self, other):
-        if "id" in self and "id" in other:
-            # return self["id"] == other["id"]
 
-            time, seq = Stream.parse_id(self["id"])
-            other_time, other_seq = Stream.parse_id(other["id"])
+# Containers loaded from RDB files besides strings and streams, by type name
+VALUE_TYPES = ((ZSet, "zset"), (dict, "hash"), (list, "list"), (set, "set"))
 
-            if time != other_time:
-                return False
-            if seq != other_seq:
-                return False
-            return True
+
+def value_type(value):
+    """
+    Returns the TYPE name of a keyspace value.
+    """
+    if isinstance(value, str):
+        return "string"
+    elif isinstance(value, Stream):
+        return "stream"
+    for cls, name in VALUE_TYPES:
+        if isinstance(value, cls):
+            return name
+    raise TypeError(f"Unexpected value type {type(value).__name__}")
+
+
+class StoreElement(object):
+    """
+    A value of the keyspace. There is one per key so it has no __dict__,
+    and the expiry is kept in the shard expiry index, only for the keys
+    that have one.
+    """
+
+    __slots__ = ("value", "lru", "pos")
+
+    def __init__(self, value: Union[str, Stream]):
+        self.value = value
+        # LRU clock or LFU counter as of the last access, see
+        # StoreShard.touch()
+        self.lru = 0
+        # Position of the key in StoreShard.keylist
+        self.pos = 0
+
+
+# Dict entry (hash, key and value pointers plus the index slot, at a 2/3
+# load factor), the slot in the shard key list, the element and its position
+STORE_ENTRY_OVERHEAD = (
+    (3 * 8 + 8) * 3 // 2 + 8 + sys.getsizeof(StoreElement("")) + sys.getsizeof(1 << 20)
+)
+
+# Expires dict entry with its position, and the slots in the volatile key
+# and expiry arrays
+EXPIRE_ENTRY_OVERHEAD = 3 * 8 + sys.getsizeof(0) + 8 + 8
+
+
+def estimate_size(key: str, value: Union[str, Stream]):
+    """
+    Estimates the memory taken by a key and its value, including the dict
+    entry and the StoreElement.
+    """
+    if isinstance(value, str):
+        value_size = sys.getsizeof(value)
+    elif isinstance(value, Stream):
+        value_size = sys.getsizeof(value) + value.nbytes
+    else:
+        value_size = sys.getsizeof(value) + sum(map(sys.getsizeof, value))
+        if isinstance(value, dict):
+            value_size += sum(map(sys.getsizeof, value.values()))
+
+    return STORE_ENTRY_OVERHEAD + sys.getsizeof(key) + value_size
+
+
+class StoreShard(object):
+    """
+    One partition of the keyspace with its own lock and counters.
+    """
+
+    # Access clocks, advanced by Store.update_clock() from the server cron so
+    # that touching a key on lookup costs one attribute store
+    lru_clock = 0
+    lfu_clock = 0
+    lfu = False
+
+    LFU_INIT_VAL = 5
+    LFU_LOG_FACTOR = 10
+    LFU_DECAY_TIME = 1
+
+    TYPES = ("string", "list", "set", "zset", "hash", "stream")
+
+    def __init__(self):
+        self.lock: RLock = RLock()
+        self.data: dict[str, StoreElement] = {}
+        # All the keys in a list to sample them for eviction in O(1)
+        self.keylist: list[str] = []
+
+        # Expiry index: the keys with a TTL and their expiry time in
+        # parallel arrays to sample them in O(1), and the position of each
+        # key in them
+        self.volatile: list[str] = []
+        self.volatile_expiry = array("q")
+        self.expires: dict[str, int] = {}
+
+        # Kept up to date on every change so INFO never walks the keyspace
+        self.used_memory = 0
+        self.type_count = dict.fromkeys(StoreShard.TYPES, 0)
+        self.type_bytes = dict.fromkeys(StoreShard.TYPES, 0)
+        self.stat_expired_keys = 0
+
+    # The helpers below expect the shard lock to be held
+
+    def insert(self, key: str, e: StoreElement, expiry: int = -1):
+        old = self.data.get(key)
+        if old is not None:
+            self.forget(key, old)
+            e.pos = old.pos
         else:
-            raise ValueError("Both objects must have an 'id' key for comparison")
+            e.pos = len(self.keylist)
+            self.keylist.append(key)
 
+        if StoreShard.lfu:
+            e.lru = (StoreShard.lfu_clock << 8) | StoreShard.LFU_INIT_VAL
+        else:
+            e.lru = StoreShard.lru_clock
+
+        self.data[key] = e
+        self.account(key, e.value, 1)
+        if expiry >= 0:
+            self.set_expiry(key, expiry)
+
+    def forget(self, key: str, e: StoreElement):
+        self.account(key, e.value, -1)
+        self.unindex_expiry(key)
+
+    def account(self, key: str, value: Union[str, Stream], n: int):
+        size = estimate_size(key, value)
+        typ = value_type(value)
+        self.used_memory += n * size
+        self.type_count[typ] += n
+        self.type_bytes[typ] += n * size
+
+    def grow(self, typ: str, nbytes: int):
+        self.used_memory += nbytes
+        self.type_bytes[typ] += nbytes
+
+    def get_expiry(self, key: str):
+        pos = self.expires.get(key)
+        return -1 if pos is None else self.volatile_expiry[pos]
+
+    def set_expiry(self, key: str, expiry: int):
+        if expiry < 0:
+            self.unindex_expiry(key)
+            return
 
-class Stream(list):
-    def __init__(self, *args):
-        for arg in args:
-            if isinstance(arg, StreamEntry):
-                self.append(arg)
-                return
-            elif isinstance(arg, list):
-                for obj in arg:
-                    if not isinstance(obj, StreamEntry):
-                        raise TypeError("Stream can only store StreamEntry objects")
-                super().__init__(arg)
-                return
-        raise ValueError(
-            "Invalid input. Must be a StreamEntry or a list of StreamEntry objects."
-        )
+        pos = self.expires.get(key)
+        if pos is not None:
+            self.volatile_expiry[pos] = expiry
+            return
 
-    def append(self, obj):
-        if not isinstance(obj, StreamEntry):
-            raise TypeError("Stream can only store StreamEntry objects")
-        super().append(obj)
+        # The int64 array rejects out of range times with OverflowError,
+        # append to it first so a failure leaves the index untouched
+        self.volatile_expiry.append(expiry)
+        self.expires[key] = len(self.volatile)
+        self.volatile.append(key)
+        self.used_memory += EXPIRE_ENTRY_OVERHEAD
 
-    def search(self, id: str, end=True):
-        lo = 0
-        hi = len(self) - 1
-        closest = None
+    def unindex_expiry(self, key: str):
+        pos = self.expires.pop(key, None)
+        if pos is None:
+            return
 
-        if id == "-":
-            return lo
-        if id == "+":
-            return hi
+        self.used_memory -= EXPIRE_ENTRY_OVERHEAD
 
-        time, seq = Stream.parse_id(id)
-        if time == -1:
+        # Move the last key into the hole
+        last = self.volatile.pop()
+        last_expiry = self.volatile_expiry.pop()
+        if pos < len(self.volatile):
+            self.volatile[pos] = last
+            self.volatile_expiry[pos] = last_expiry
+            self.expires[last] = pos
+
+    def remove(self, key: str):
+        e = self.data.pop(key)
+        self.forget(key, e)
+
+        last = self.keylist.pop()
+        if e.pos < len(self.keylist):
+            self.keylist[e.pos] = last
+            self.data[last].pos = e.pos
+
+        return e
+
+    def expire(self, key: str):
+        self.remove(key)
+        self.stat_expired_keys += 1
+
+    def lookup(self, key: str, now: int):
+        """
+        Returns the element of key, expiring it first if its time has come.
+        """
+        e = self.data.get(key)
+        if e is None:
             return None
 
-        if seq == -1:
-            seq = Stream.parse_id(self[-1]["id"])[1] if end else 0
-            id = f"{str(time)}-{str(seq)}"
+        if self.expires:
+            pos = self.expires.get(key)
+            if pos is not None and self.volatile_expiry[pos] <= now:
+                self.expire(key)
+                return None
+
+        self.touch(e)
+        return e
+
+    def touch(self, e: StoreElement):
+        if StoreShard.lfu:
+            e.lru = (StoreShard.lfu_clock << 8) | StoreShard.lfu_incr(
+                StoreShard.lfu_decr(e.lru)
+            )
+        else:
+            e.lru = StoreShard.lru_clock
+
+    @staticmethod
+    def lfu_decr(lru: int):
+        """
+        Returns the LFU counter of lru, decremented by one for every
+        LFU_DECAY_TIME minutes since the last access.
+        """
+        elapsed = (StoreShard.lfu_clock - (lru >> 8)) & 0xFFFF
+        return max(0, (lru & 0xFF) - elapsed // StoreShard.LFU_DECAY_TIME)
 
-        se = StreamEntry(id=id)
+    @staticmethod
+    def lfu_incr(counter: int):
+        """
+        Logarithmic increment: the higher the counter, the less likely it
+        is to grow. Saturates at 255.
+        """
+        if counter == 255:
+            return counter
 
-        while lo <= hi:
-            mid = (lo + hi) // 2
+        base = max(0, counter - StoreShard.LFU_INIT_VAL)
+        if random.random() < 1.0 / (base * StoreShard.LFU_LOG_FACTOR + 1):
+            counter += 1
+        return counter
 
-            if se < self[mid]:
-                hi = mid - 1
-            elif se > self[mid]:
-                closest = mid
-                lo = mid + 1
+    def eviction_sample(self, policy: str, nsamples: int):
+        """
+        Samples nsamples random keys eligible for eviction under policy.
+        Returns (score, key) pairs, the higher the score the better the
+        candidate.
+        """
+        with self.lock:
+            if policy.startswith("volatile"):
+                candidates = self.volatile
             else:
-                return mid
+                candidates = self.keylist
+
+            samples = []
+            n = len(candidates)
+            for _ in range(min(nsamples, n)):
+                key = candidates[random.randrange(n)]
+                e = self.data[key]
+                if policy.endswith("lru"):
+                    score = StoreShard.lru_clock - e.lru
+                elif policy.endswith("lfu"):
+                    score = 255 - StoreShard.lfu_decr(e.lru)
+                else:
+                    # volatile-ttl, the sooner the better
+                    score = -self.get_expiry(key)
+                samples.append((score, key))
 
-        return closest if end else lo
+            return samples
 
-    @staticmethod
-    def parse_id(id: str):
-        pattern = r"(\d+)(?:-(\d+|\*))?|(\*)"
-        match = re.match(pattern, id)
-        if match:
-            groups = match.groups()
-            if groups[0] is not None and groups[1] is not None:
-                return int(groups[0]), -1 if groups[1] == "*" else int(groups[1])
-            if groups[0] is not None:
-                return int(groups[0]), -1
+    def expire_sample(self, now: int, nsample: int):
+        """
+        Checks up to nsample random keys with a TTL and expires the ones
+        past their time. Returns the number of keys sampled, the expired
+        keys and the sum of the remaining TTLs of the others.
+        """
+        with self.lock:
+            expired = []
+            ttl_sum = 0
+            nsample = min(nsample, len(self.volatile))
+            for _ in range(nsample):
+                if not self.volatile:
+                    break
 
-        return -1, -1
+                idx = random.randrange(len(self.volatile))
+                ttl = self.volatile_expiry[idx] - now
+                if ttl <= 0:
+                    key = self.volatile[idx]
+                    self.expire(key)
+                    expired.append(key)
+                else:
+                    ttl_sum += ttl
 
+            return nsample, expired, ttl_sum
 
-class StreamError(ValueError):
-    def __init__(self, message):
-        super(StreamError, self).__init__(message)
 
+class EvictionPool(object):
+    """
+    The best eviction candidates seen so far across samples, sorted by
+    increasing score. Keeping them around between evictions makes the
+    sampled approximation much closer to a true LRU/LFU.
+    """
 
-@dataclass
-class StoreElement(object):
-    value: Union[str, Stream]
-    expiry: float
+    SIZE = 16
+
+    def __init__(self):
+        self._entries: list[tuple] = []
+
+    def clear(self):
+        self._entries.clear()
+
+    def populate(self, shard: int, samples: list):
+        for score, key in samples:
+            if len(self._entries) == EvictionPool.SIZE and score <= self._entries[0][0]:
+                continue
+            if any(k == key and s == shard for _, k, s in self._entries):
+                continue
+
+            bisect.insort(self._entries, (score, key, shard))
+            if len(self._entries) > EvictionPool.SIZE:
+                del self._entries[0]
+
+    def pop(self):
+        """
+        Returns the key and shard index of the best candidate, or None.
+        """
+        if not self._entries:
+            return None
+
+        _, key, shard = self._entries.pop()
+        return key, shard
 
 
 class Store(object):
+    """
+    The keyspace, partitioned by key hash into independently locked shards
+    so that clients working on unrelated keys don't contend for one lock.
+    Operations on several keys lock their shards in index order.
+    """
+
     _instance = None
 
-    def __new__(cls):
+    NSHARDS = 16
+
+    def __new__(cls, nshards: int = NSHARDS):
         if cls._instance is None:
             cls._instance = super(Store, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self):
-        self._lock: RLock = RLock()
-        self._store: dict[str, StoreElement] = {}
+    def __init__(self, nshards: int = NSHARDS):
+        self._shards = [StoreShard() for _ in range(nshards)]
 
-    def expired(self, key):
-        with self._lock:
-            if key not in self._store:
-                return True
+        # Active expire cycle state and statistics
+        self._expire_cursor = 0
 
-            e = self._store[key]
-            if e.expiry < 0:
-                return False
-            if e.expiry > millis():
-                return False
+        # Eviction state
+        self._evict_lock = Lock()
+        self._evict_pool = EvictionPool()
+        self._evict_cursor = 0
+        self.stat_expired_stale_perc = 0.0
+        # Running estimate of the TTL of the keys with one, in milliseconds
+        self.stat_avg_ttl = 0
+        self.stat_expired_time_cap_reached_count = 0
+        self.stat_expire_cycle_time_used = 0
+
+    @classmethod
+    def detached(cls, nshards: int = NSHARDS):
+        """
+        Returns a store other than the keyspace, to be filled and then
+        swapped in with swap().
+        """
+        db = super(Store, cls).__new__(cls)
+        db.__init__(nshards)
+        return db
+
+    def swap(self, other: "Store"):
+        """
+        Exchanges the contents of this store and other. Operations already
+        waiting on a shard lock apply to the contents swapped out.
+        """
+        old = self._shards
+        for shard in old:
+            shard.lock.acquire()
+        try:
+            self._shards, other._shards = other._shards, old
+            self._expire_cursor = 0
+            with self._evict_lock:
+                self._evict_pool.clear()
+        finally:
+            for shard in reversed(old):
+                shard.lock.release()
+
+    def shard(self, key: str):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _locked_shards(self, keys: list):
+        """
+        Returns the distinct shards of keys in the fixed locking order.
+        """
+        indices = sorted({hash(key) % len(self._shards) for key in keys})
+        return [self._shards[i] for i in indices]
 
-            self._store.pop(key)
-            return True
+    def expired(self, key):
+        now = millis()
+        shard = self.shard(key)
+        with shard.lock:
+            return shard.lookup(key, now) is None
 
     def size(self):
-        with self._lock:
-            return len(self._store)
+        return sum(len(shard.data) for shard in self._shards)
+
+    def expires_size(self):
+        return sum(len(shard.expires) for shard in self._shards)
+
+    def used_memory(self):
+        return sum(shard.used_memory for shard in self._shards)
+
+    @property
+    def stat_expired_keys(self):
+        return sum(shard.stat_expired_keys for shard in self._shards)
+
+    def update_clock(self):
+        now = time.time()
+        StoreShard.lru_clock = int(now)
+        StoreShard.lfu_clock = int(now // 60) & 0xFFFF
+
+    def set_policy(self, policy: str):
+        lfu = policy.endswith("lfu")
+        if lfu != StoreShard.lfu:
+            # The access clocks of the keys are meaningless to the new
+            # policy, the next accesses fix them up
+            StoreShard.lfu = lfu
+            self._evict_pool.clear()
+
+    def evict(self, policy: str, nsamples: int):
+        """
+        Evicts one key according to the maxmemory policy, sampling nsamples
+        keys into the eviction pool. Returns the evicted key, or None if no
+        key can be evicted.
+        """
+        nshards = len(self._shards)
+        volatile = policy.startswith("volatile")
+
+        with self._evict_lock:
+            for _ in range(nshards):
+                idx = self._evict_cursor
+                self._evict_cursor = (idx + 1) % nshards
+                shard = self._shards[idx]
+
+                if policy.endswith("random"):
+                    with shard.lock:
+                        candidates = shard.volatile if volatile else shard.keylist
+                        if candidates:
+                            key = candidates[random.randrange(len(candidates))]
+                            shard.remove(key)
+                            return key
+                    continue
+
+                self._evict_pool.populate(idx, shard.eviction_sample(policy, nsamples))
+
+                # Best candidates first, skipping the keys that went away
+                # since they were sampled
+                while (entry := self._evict_pool.pop()) is not None:
+                    key, idx = entry
+                    shard = self._shards[idx]
+                    with shard.lock:
+                        if key in shard.data and (not volatile or key in shard.expires):
+                            shard.remove(key)
+                            return key
+
+        return None
+
+    ACTIVE_EXPIRE_KEYS_PER_LOOP = 20
+    ACTIVE_EXPIRE_STALE_PERC = 25
+
+    def active_expire_cycle(self, budget: float):
+        """
+        Expires keys whose TTL elapsed without them being accessed. Samples
+        the keys with a TTL of each shard, and samples the shard again while
+        more than ACTIVE_EXPIRE_STALE_PERC percent of the sample was expired.
+        Stops after budget seconds, the next cycle resumes from the shard
+        where this one stopped. Returns the expired keys.
+        """
+        start = time.perf_counter()
+        deadline = start + budget
+        nshards = len(self._shards)
+
+        expired = []
+        nsampled = 0
+        nexpired = 0
+        ttl_sum = 0
+        timelimit_exit = False
+
+        for i in range(nshards):
+            idx = (self._expire_cursor + i) % nshards
+            shard = self._shards[idx]
+
+            while True:
+                sampled, keys, sampled_ttl = shard.expire_sample(
+                    millis(), Store.ACTIVE_EXPIRE_KEYS_PER_LOOP
+                )
+                expired += keys
+                nsampled += sampled
+                nexpired += len(keys)
+                ttl_sum += sampled_ttl
+
+                if time.perf_counter() >= deadline:
+                    timelimit_exit = True
+                    break
+                if len(keys) * 100 <= sampled * Store.ACTIVE_EXPIRE_STALE_PERC:
+                    break
+
+            if timelimit_exit:
+                self._expire_cursor = idx
+                self.stat_expired_time_cap_reached_count += 1
+                break
+
+        elapsed = time.perf_counter() - start
+        self.stat_expire_cycle_time_used += int(elapsed * 1000000)
+
+        # Running estimate of the share of already expired keys among the
+        # keys with a TTL
+        current_perc = nexpired / nsampled if nsampled else 0
+        self.stat_expired_stale_perc = (
+            current_perc * 0.05 + self.stat_expired_stale_perc * 0.95
+        )
+
+        # Same smoothing of the sampled average TTL as Redis, a full pass
+        # that found no key with a TTL resets it
+        ttl_samples = nsampled - nexpired
+        if ttl_samples:
+            avg_ttl = ttl_sum // ttl_samples
+            if self.stat_avg_ttl:
+                avg_ttl = (self.stat_avg_ttl // 50) * 49 + avg_ttl // 50
+            self.stat_avg_ttl = avg_ttl
+        elif not nsampled and not timelimit_exit:
+            self.stat_avg_ttl = 0
+
+        return expired
+
+    def lock_all(self):
+        for shard in self._shards:
+            shard.lock.acquire()
+
+    def unlock_all(self):
+        for shard in reversed(self._shards):
+            shard.lock.release()
+
+    def items(self):
+        """
+        Iterates over the keys with their value and expiry. The caller must
+        hold all the shard locks, see lock_all().
+        """
+        for shard in self._shards:
+            for key, e in shard.data.items():
+                yield key, e.value, shard.get_expiry(key)
 
     def keys(self):
-        with self._lock:
-            return list(self._store.keys())
+        keys = []
+        for shard in self._shards:
+            with shard.lock:
+                keys += shard.data.keys()
+        return keys
 
     def type(self, key: str):
-        with self._lock:
-            if key not in self._store:
-                return "none"
-
-            e = self._store.get(key)
+        now = millis()
+        shard = self.shard(key)
+        with shard.lock:
+            e = shard.lookup(key, now)
             if not e:
                 return "none"
 
-            if isinstance(e.value, Stream):
-                return "stream"
-            elif len(e.value) > 0:
-                return "string"
+            if isinstance(e.value, str) and not e.value:
+                return "none"
 
-            return "none"
+            return value_type(e.value)
 
-    def append(self, key: str, value: StreamEntry):
-        with self._lock:
-            time, seq = Stream.parse_id(value["id"])
+    def append(self, key: str, entry_id: str, fields: list):
+        if entry_id == "*":
+            time, seq = -1, -1
+        else:
+            time, seq = Stream.parse_id(entry_id)
+            if time == -1:
+                raise StreamError("Invalid stream ID specified as stream command argument")
             if time == 0 and seq == 0:
                 raise StreamError("The ID specified in XADD must be greater than 0-0")
 
-            if time == -1:
-                time = millis()
-
-            if key not in self._store:
-                if seq == -1:
-                    if time == 0:
-                        seq = 1
-                    else:
-                        seq = 0
-
-                    value["id"] = f"{str(time)}-{str(seq)}"
+        now = millis()
 
-                self.set(key, Stream(value))
-                return value["id"]
-
-            if not isinstance(self._store[key].value, Stream):
+        shard = self.shard(key)
+        with shard.lock:
+            e = shard.lookup(key, now)
+            if e is None:
+                stream = Stream()
+            elif isinstance(e.value, Stream):
+                stream = e.value
+            else:
                 return ""
 
-            # Validate entry ID
-            top_entry = self._store[key].value[-1]
-            top_time, top_seq = Stream.parse_id(top_entry["id"])
+            top_time, top_seq = stream.last_id
 
-            if time < top_time or (time == top_time and seq != -1 and seq <= top_seq):
+            if time == -1:
+                # Fully auto-generated ID, keep IDs increasing if the clock
+                # went backwards
+                time = max(now, top_time)
+
+            if len(stream) > 0 and (
+                time < top_time or (time == top_time and seq != -1 and seq <= top_seq)
+            ):
                 raise StreamError(
                     "The ID specified in XADD is equal or smaller than the target stream top item"
                 )
 
             if seq == -1:
-                if time == top_time:
+                if len(stream) > 0 and time == top_time:
                     seq = top_seq + 1
+                elif time == 0:
+                    seq = 1
                 else:
                     seq = 0
 
-                value["id"] = f"{str(time)}-{str(seq)}"
+            nbytes = stream.nbytes
+            stream.add(time, seq, fields)
+
+            if e is None:
+                shard.insert(key, StoreElement(stream))
+            else:
+                shard.grow("stream", stream.nbytes - nbytes)
 
-            self._store[key].value.append(value)
-            return value["id"]
+            return Stream.format_id(time, seq)
 
     def set(self, key: str, value: Union[str, Stream], expiry=-1):
-        with self._lock:
-            self._store[key] = StoreElement(value, expiry)
+        shard = self.shard(key)
+        with shard.lock:
+            shard.insert(key, StoreElement(value), expiry)
 
     def get(self, key):
-        with self._lock:
-            if key not in self._store:
-                return ""
+        now = millis()
+        shard = self.shard(key)
+        with shard.lock:
+            e = shard.lookup(key, now)
+            return "" if e is None else e.value
 
-            e = self._store[key]
+    def get_many(self, keys: list):
+        """
+        Returns the values of keys as of a single point in time.
+        """
+        now = millis()
+        shards = self._locked_shards(keys)
+        for shard in shards:
+            shard.lock.acquire()
+        try:
+            values = []
+            for key in keys:
+                e = self.shard(key).lookup(key, now)
+                values.append("" if e is None else e.value)
+            return values
+        finally:
+            for shard in reversed(shards):
+                shard.lock.release()
+
+    def expire(self, key: str, when: int, cond: str = None):
+        """
+        Sets the expiry of key to the unix time when in milliseconds,
+        deleting it right away if that is in the past. cond is one of NX
+        (key has no expiry), XX (key has one), GT and LT (new expiry is
+        greater or less than the current one, no expiry counting as
+        infinite). Returns 1 if the expiry was set, 0 otherwise.
+        """
+        now = millis()
+        shard = self.shard(key)
+        with shard.lock:
+            e = shard.lookup(key, now)
+            if e is None:
+                return 0
 
-            if e.expiry > 0 and e.expiry <= millis():
-                self._store.pop(key)
-                return ""
+            current = shard.get_expiry(key)
+            if (
+                (cond == "NX" and current >= 0)
+                or (cond == "XX" and current < 0)
+                or (cond == "GT" and (current < 0 or when <= current))
+                or (cond == "LT" and 0 <= current <= when)
+            ):
+                return 0
 
-            return e.value
+            if when <= now:
+                shard.remove(key)
+            else:
+                shard.set_expiry(key, when)
+            return 1
 
-    def delete(self, key):
-        with self._lock:
-            if key not in self._store:
+    def expiry(self, key: str):
+        """
+        Returns the expiry of key as a unix time in milliseconds, -1 if it
+        has none or -2 if the key doesn't exist.
+        """
+        now = millis()
+        shard = self.shard(key)
+        with shard.lock:
+            e = shard.lookup(key, now)
+            if e is None:
+                return -2
+
+            return shard.get_expiry(key)
+
+    def persist(self, key: str):
+        now = millis()
+        shard = self.shard(key)
+        with shard.lock:
+            e = shard.lookup(key, now)
+            if e is None or key not in shard.expires:
                 return 0
 
-            self._store.pop(key)
+            shard.unindex_expiry(key)
             return 1
 
+    def memory_usage(self, key: str):
+        """
+        Returns the estimated number of bytes taken by key, its value and
+        its bookkeeping, or None if the key doesn't exist.
+        """
+        now = millis()
+        shard = self.shard(key)
+        with shard.lock:
+            e = shard.lookup(key, now)
+            if e is None:
+                return None
 
-class Connection(object):
-    def __init__(
-        self, socket: socket.socket, addr: tuple, server: "Server", isreplica=False
-    ):
-        self._socket = socket
-        self._addr = addr
-        self._server = server
-        self._thread = None
-        self._isreplica = isreplica
+            usage = estimate_size(key, e.value)
+            if key in shard.expires:
+                usage += EXPIRE_ENTRY_OVERHEAD
+            return usage
 
-    @property
-    def addr(self):
-        return self._addr
+    def type_stats(self):
+        """
+        Returns the number of keys and their memory per value type.
+        """
+        stats = {}
+        for shard in self._shards:
+            for typ, count in shard.type_count.items():
+                nkeys, nbytes = stats.get(typ, (0, 0))
+                stats[typ] = (nkeys + count, nbytes + shard.type_bytes[typ])
+        return stats
+
+    def delete(self, *keys):
+        """
+        Deletes keys atomically, returns the number of keys that existed.
+        """
+        now = millis()
+        shards = self._locked_shards(keys)
+        for shard in shards:
+            shard.lock.acquire()
+        try:
+            deleted = 0
+            for key in keys:
+                shard = self.shard(key)
+                if shard.lookup(key, now) is not None:
+                    shard.remove(key)
+                    deleted += 1
+            return deleted
+        finally:
+            for shard in reversed(shards):
+                shard.lock.release()
+
+
+class TimerHandle(object):
+    __slots__ = ("deadline", "seq", "callback", "cancelled")
+
+    def __init__(self, deadline: float, seq: int, callback):
+        self.deadline = deadline
+        self.seq = seq
+        self.callback = callback
+        self.cancelled = False
 
-    def set_thread(self, t):
-        self._thread = t
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
 
-    def start(self):
-        self._thread.start()
+    def cancel(self):
+        self.cancelled = True
 
-    def join(self):
-        self._thread.join()
 
-    def set_replica(self):
-        self.isreplica = True
-        self._server.add_replica(self)
-        print(f"Connection {self._addr} set as replica")
+class EventLoop(object):
+    """
+    Single-threaded reactor multiplexing non-blocking sockets over a selector.
 
-    def relay(self, msg: bytes):
-        self.send(msg)
+    Handlers registered with the loop expose handle_read() and handle_write().
+    Other threads hand work to the loop through call_soon_threadsafe().
+    """
 
-    def send(self, data: bytes):
-        ndata = len(data)
-        nsent = 0
-        nbytes = 0
-        while ndata > 0:
-            nbytes = self._socket.send(data[nbytes:])
-            nsent += nbytes
-            ndata -= nbytes
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._timers: list[TimerHandle] = []
+        self._timer_seq = 0
+        self._ready = deque()
+        self._thread_id = None
+        self._running = False
+        # Called once per iteration before polling, see Server.before_sleep()
+        self.before_sleep = None
+
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, self)
+
+    def in_loop_thread(self):
+        return self._thread_id == threading.get_ident()
+
+    def register(self, fileobj, handler, events=selectors.EVENT_READ):
+        self._selector.register(fileobj, events, handler)
+
+    def modify(self, fileobj, handler, events):
+        self._selector.modify(fileobj, events, handler)
+
+    def unregister(self, fileobj):
+        try:
+            self._selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def call_later(self, delay: float, callback):
+        self._timer_seq += 1
+        timer = TimerHandle(time.monotonic() + delay, self._timer_seq, callback)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._ready.append((callback, args))
+        if self.in_loop_thread():
+            # Runs on the next iteration, no need to wake the loop up
+            return
 
-        return nsent
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # The wakeup socket is already full, the loop will wake up anyway
+            pass
 
-    def handle_connection(self):
-        with self._socket:
-            while True:
-                request_bytes = self._socket.recv(4096)
-                if not request_bytes:
-                    break
+    def handle_read(self):
+        # Drain the wakeup socket, queued callbacks run after the poll
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def handle_write(self):
+        pass
+
+    def _next_timeout(self):
+        if self._ready:
+            return 0
+        while self._timers and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0].deadline - time.monotonic())
 
-                # Parse RESP packet
-                reqlen = len(request_bytes)
-                at = 0
-                while at < reqlen:
-                    n, tokens = RESPparser.parse(request_bytes[at:])
-                    command, *args = tokens
-                    at += n
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0].deadline <= now:
+            timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._invoke(timer.callback)
 
-                    command = command.upper()
+    def _run_ready(self):
+        for _ in range(len(self._ready)):
+            callback, args = self._ready.popleft()
+            self._invoke(callback, *args)
 
-                    if (
-                        not self._isreplica
-                        and command in self._server.PROPAGATED_COMMANDS
-                    ):
-                        self._server.relay(request_bytes)
-                        self._server.master_repl_offset += len(request_bytes)
+    def _invoke(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            sys.stderr.write(f"Exception in event loop callback: {e}\n")
 
-                    response = None
+    def stop(self):
+        self._running = False
 
-                    try:
-                        response = server.process_command(command, args, self)
+    def run_forever(self):
+        self._thread_id = threading.get_ident()
+        self._running = True
 
-                    except StreamError as s:
-                        response = RESPbuilder.error(
-                            args=str(s),
+        while self._running:
+            if self.before_sleep is not None:
+                self._invoke(self.before_sleep)
+
+            events = self._selector.select(self._next_timeout())
+
+            for key, mask in events:
+                handler = key.data
+                if mask & selectors.EVENT_READ:
+                    self._invoke(handler.handle_read)
+                if mask & selectors.EVENT_WRITE:
+                    # The read handler may have closed the connection
+                    if key.fd in self._selector.get_map():
+                        self._invoke(handler.handle_write)
+
+            self._run_timers()
+            self._run_ready()
+
+
+class Listener(object):
+    """
+    Accepts incoming connections on a non-blocking listening socket and hands
+    them over to the event loop.
+    """
+
+    def __init__(self, sock: socket.socket, server: "Server", loop: EventLoop):
+        self._socket = sock
+        self._server = server
+        self._loop = loop
+
+    def start(self):
+        self._socket.setblocking(False)
+        self._loop.register(self._socket, self)
+
+    def handle_read(self):
+        while True:
+            try:
+                client_socket, addr = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. out of file descriptors, retry on the next poll
+                sys.stderr.write(f"Error accepting connection: {e}\n")
+                return
+
+            if len(connections) >= self._server.maxclients:
+                self._server.stat_rejected_conn += 1
+                try:
+                    client_socket.send(
+                        RESPbuilder.error(
+                            args="max number of clients reached",
                             typ=RESPerror.CUSTOM,
                         )
+                    )
+                finally:
+                    client_socket.close()
+                continue
 
-                    except ValueError as v:
-                        sys.stderr.write(f"ValueError: {v}\n")
-                        response = RESPbuilder.error(
-                            args="value is not an integer or out of range",
-                            typ=RESPerror.CUSTOM,
+            conn = Connection(client_socket, addr, self._server, loop=self._loop)
+            self._server.stat_numconnections += 1
+            connections.append(conn)
+            conn.attach()
+
+    def handle_write(self):
+        pass
+
+
+class ReplicaState(Enum):
+    # Waiting for a snapshot to be started for it
+    WAIT_BGSAVE_START = "wait_bgsave_start"
+    # Got +FULLRESYNC, the stream is buffered until the snapshot is sent
+    WAIT_BGSAVE_END = "wait_bgsave_end"
+    SEND_BULK = "send_bulk"
+    ONLINE = "online"
+
+
+class Connection(object):
+    def __init__(
+        self,
+        socket: socket.socket,
+        addr: tuple,
+        server: "Server",
+        isreplica=False,
+        loop: EventLoop = None,
+    ):
+        self._socket = socket
+        self._addr = addr
+        self._server = server
+        self._thread = None
+        self._isreplica = isreplica
+        self._parser = RESPparser()
+
+        # Output buffer and replies waiting to be serialized into it
+        self._outbuf = bytearray()
+        self._replies = deque()
+
+        # Event loop mode state
+        self._loop = loop
+        self._events = 0
+        self._paused = False
+        self._write_blocked = False
+        self._closed = False
+        self._blocked: tuple = None
+
+        # Replication offset right after this client's last write, WAIT
+        # waits for the replicas to reach it
+        self.woff = 0
+        # Set by write command handlers to replace the command propagated to
+        # the replicas, an empty list propagates nothing
+        self.propagate_argv: list = None
+        # Replica connections: last offset acknowledged with REPLCONF ACK
+        self.repl_ack_offset = 0
+        self.repl_ack_time = 0
+        # Capabilities announced with REPLCONF capa
+        self.repl_capa = set()
+        # Port announced with REPLCONF listening-port, shown in INFO
+        self.repl_listening_port = 0
+        # Full resynchronization, see Server.full_resync()
+        self.repl_state: ReplicaState = None
+        self.repl_pending: bytearray = None
+        self.repl_psync_offset = 0
+        self.repl_wait_start = 0
+        # Replica output, see queue_output()
+        self._repl_outbuf: bytearray = None
+        self._repl_cond: Condition = None
+        # Bytes handed to the event loop from other threads, not yet written
+        self._inflight = 0
+        self.obuf_soft_limit_reached_time = 0
+
+    @property
+    def addr(self):
+        return self._addr
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def isreplica(self):
+        return self._isreplica
+
+    def set_thread(self, t):
+        self._thread = t
+
+    def start(self):
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def set_replica(self, state: ReplicaState = ReplicaState.ONLINE):
+        self._isreplica = True
+        self.repl_state = state
+        self.repl_ack_time = time.time()
+        if self._loop is None and self._repl_cond is None:
+            # A slow replica must not block the writers relaying to it
+            self._repl_outbuf = bytearray()
+            self._repl_cond = Condition()
+            Thread(target=self._drain_replica_output, daemon=True).start()
+        self._server.add_replica(self)
+        print(f"Connection {self._addr} set as replica")
+
+    def relay(self, msg: bytes):
+        if self.repl_state == ReplicaState.ONLINE:
+            self.send(msg)
+        elif self.repl_state != ReplicaState.WAIT_BGSAVE_START:
+            # Sent once the snapshot it follows has been transferred
+            self.repl_pending += msg
+
+    def send(self, data: bytes):
+        if self._loop is not None:
+            self.write(data)
+            return len(data)
+
+        if self._repl_cond is not None:
+            self.queue_output(data)
+            return len(data)
+
+        self._socket.sendall(data)
+        self._server.stat_net_output_bytes += len(data)
+        return len(data)
+
+    def queue_output(self, data: bytes):
+        """
+        Appends to the output of a replica in threaded mode, written out by
+        its own thread so that the caller never blocks on the socket.
+        """
+        with self._repl_cond:
+            if self._closed:
+                raise ConnectionError("connection closed")
+            self._repl_outbuf += data
+            self._repl_cond.notify_all()
+
+    def _drain_replica_output(self):
+        cond = self._repl_cond
+        while True:
+            with cond:
+                while not self._repl_outbuf and not self._closed:
+                    cond.wait()
+                if self._closed:
+                    return
+                data = self._repl_outbuf
+                self._repl_outbuf = bytearray()
+                # Wakes up the transfers waiting in wait_output_below()
+                cond.notify_all()
+
+            try:
+                self._socket.sendall(data)
+            except OSError as e:
+                if not self._closed:
+                    sys.stderr.write(f"Error writing to replica {self._addr}: {e}\n")
+                self._server.free_replica(self)
+                return
+            self._server.stat_net_output_bytes += len(data)
+
+    def output_size(self):
+        """
+        Bytes queued for this client and not yet written to its socket.
+        """
+        size = len(self._outbuf) + self._inflight
+        if self._repl_outbuf is not None:
+            size += len(self._repl_outbuf)
+        return size
+
+    def wait_output_below(self, limit: int):
+        """
+        Throttles bulk transfers to the pace of the socket.
+        """
+        while self.output_size() >= limit and not self._closed:
+            if self._repl_cond is not None:
+                with self._repl_cond:
+                    self._repl_cond.wait(0.1)
+            else:
+                time.sleep(0.001)
+
+    def add_reply(self, response: Union[bytes, "LazyReply"]):
+        """
+        Queues a reply. Replies are written out once per read batch, or as
+        soon as the output buffer grows past output-flush-size. Lazy replies
+        are serialized into the output buffer as it drains.
+        """
+        if self._replies or isinstance(response, LazyReply):
+            self._replies.append(response)
+        else:
+            self._outbuf += response
+
+    def output_full(self):
+        return (
+            len(self._outbuf) >= self._server.config.output_flush_size.value
+            or len(self._replies) > 0
+        )
+
+    def _fill_outbuf(self):
+        limit = self._server.config.output_flush_size.value
+
+        while self._replies and len(self._outbuf) < limit:
+            reply = self._replies[0]
+            if isinstance(reply, LazyReply):
+                if not reply.write(self._outbuf, limit):
+                    return
+            else:
+                self._outbuf += reply
+            self._replies.popleft()
+
+    def flush(self):
+        if self._loop is not None:
+            self.handle_write()
+            return
+
+        # Replies go out once the commands they acknowledge are in the AOF,
+        # the first thread to get there writes for all the others
+        self._server.flush_append_only_file()
+
+        while True:
+            self._fill_outbuf()
+            if not self._outbuf:
+                break
+
+            if self._repl_cond is not None:
+                # After the replication stream queued so far
+                self.queue_output(bytes(self._outbuf))
+            else:
+                self._socket.sendall(self._outbuf)
+                self._server.stat_net_output_bytes += len(self._outbuf)
+            self._outbuf.clear()
+
+    def close(self):
+        if self._loop is not None and not self._loop.in_loop_thread():
+            self._loop.call_soon_threadsafe(self.close)
+            return
+
+        if self._closed:
+            return
+
+        self._closed = True
+        if self._repl_cond is not None:
+            with self._repl_cond:
+                self._repl_cond.notify_all()
+        if self._blocked is not None:
+            client, registry = self._blocked
+            registry.unblock(client)
+            self._blocked = None
+        if self._loop is not None:
+            self._loop.unregister(self._socket)
+        try:
+            # Wakes up a handler thread blocked in recv(), a plain close()
+            # leaves the peer connected until that call returns
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
+        if self._isreplica:
+            self._server.remove_replica(self)
+        if self in connections:
+            connections.remove(self)
+
+    def execute(self, command: str, args: list):
+        """
+        Runs a single parsed command and returns the encoded reply.
+        """
+        response = None
+
+        try:
+            response = self._server.process_command(command, args, self)
+
+        except StreamError as s:
+            response = RESPbuilder.error(
+                args=str(s),
+                typ=RESPerror.CUSTOM,
+            )
+
+        except ValueError as v:
+            sys.stderr.write(f"ValueError: {v}\n")
+            response = RESPbuilder.error(
+                args="value is not an integer or out of range",
+                typ=RESPerror.CUSTOM,
+            )
+
+        except Exception as e:
+            sys.stderr.write(f"Exception occurred: {e}\n")
+
+        finally:
+            # Default response
+            if response is None:
+                response = RESPbuilder.error(command, args, typ=RESPerror.UNKNOWN_CMD)
+
+        return response
+
+    def next_command(self):
+        """
+        Returns the next complete command from the read buffer as a tuple of
+        the upper-cased command name and its arguments, or None.
+        """
+        while True:
+            result = self._parser.get_command()
+            if result is None:
+                return None
+
+            n, tokens = result
+            if not isinstance(tokens, list):
+                tokens = [str(tokens)]
+            if len(tokens) == 0:
+                continue
+
+            command, *args = tokens
+            return command.upper(), args
+
+    def handle_connection(self):
+        with self._socket:
+            while True:
+                try:
+                    request_bytes = self._socket.recv(16384)
+                except OSError:
+                    break
+                if not request_bytes:
+                    break
+
+                self._server.stat_net_input_bytes += len(request_bytes)
+                self._parser.feed(request_bytes)
+
+                try:
+                    while (cmd := self.next_command()) is not None:
+                        command, args = cmd
+                        self.add_reply(self.execute(command, args))
+                        if self.output_full():
+                            self.flush()
+
+                except RESPProtocolError as e:
+                    self.add_reply(
+                        RESPbuilder.error(
+                            args=f"Protocol error: {e}", typ=RESPerror.CUSTOM
                         )
+                    )
+                    self.flush()
+                    break
 
-                    except Exception as e:
-                        sys.stderr.write(f"Exception occurred: {e}\n")
+                # One write for all the replies of this read
+                self.flush()
 
-                    finally:
-                        # Default response
-                        if response is None:
-                            response = RESPbuilder.error(
-                                command, args, typ=RESPerror.UNKNOWN_CMD
-                            )
+        self.close()
 
-                    self._socket.sendall(response)
+    # Event loop mode
+
+    def attach(self):
+        self._socket.setblocking(False)
+        self._update_events()
+
+    def _update_events(self):
+        if self._closed:
+            return
+
+        events = 0
+        if not self._paused and not self._write_blocked:
+            events |= selectors.EVENT_READ
+        if self._outbuf or self._replies:
+            events |= selectors.EVENT_WRITE
+
+        if events == self._events:
+            return
+
+        if self._events == 0:
+            self._loop.register(self._socket, self, events)
+        elif events == 0:
+            self._loop.unregister(self._socket)
+        else:
+            self._loop.modify(self._socket, self, events)
+
+        self._events = events
+
+    def write(self, data: bytes):
+        if not self._loop.in_loop_thread():
+            self._inflight += len(data)
+            self._loop.call_soon_threadsafe(self._write_from_thread, data)
+            return
+
+        if self._closed:
+            return
+
+        self.add_reply(data)
+        self.handle_write()
+
+    def _write_from_thread(self, data: bytes):
+        self._inflight -= len(data)
+        self.write(data)
+
+    def handle_write(self):
+        if self._server.aof_fsync_pending():
+            # With appendfsync always replies wait for the fsync covering
+            # their commands, done once per loop iteration for all clients
+            self._server.clients_pending_write[self] = None
+            return
+
+        while True:
+            self._fill_outbuf()
+            if not self._outbuf:
+                break
+
+            try:
+                nbytes = self._socket.send(self._outbuf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.close()
+                return
+            del self._outbuf[:nbytes]
+            self._server.stat_net_output_bytes += nbytes
+
+        self._update_events()
+
+        if self._write_blocked and not self.output_full():
+            # The client drained enough of its replies, go on with the rest
+            # of the pipeline
+            self._write_blocked = False
+            self._update_events()
+            self.process_commands()
+
+    def handle_read(self):
+        try:
+            request_bytes = self._socket.recv(16384)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close()
+            return
+
+        if not request_bytes:
+            self.close()
+            return
+
+        self._server.stat_net_input_bytes += len(request_bytes)
+        self.process_input(request_bytes)
+
+    def process_input(self, request_bytes: bytes):
+        self._parser.feed(request_bytes)
+        self.process_commands()
+
+    def process_commands(self):
+        while not self._paused and not self._closed:
+            if self.output_full():
+                self.handle_write()
+                if self.output_full():
+                    # The socket does not keep up, stop parsing commands
+                    # until the replies are drained
+                    self._write_blocked = True
+                    self._update_events()
+                    return
+
+            try:
+                cmd = self.next_command()
+            except RESPProtocolError as e:
+                self.write(
+                    RESPbuilder.error(
+                        args=f"Protocol error: {e}", typ=RESPerror.CUSTOM
+                    )
+                )
+                self.close()
+                return
+
+            if cmd is None:
+                break
+
+            command, args = cmd
+
+            response = self.execute(command, args)
+            if response is BLOCKED:
+                # The reply comes through unblock(), stop reading until then
+                self._paused = True
+                self._update_events()
+                break
+
+            self.add_reply(response)
+
+        # One write for all the replies of this read
+        self.handle_write()
+
+    def block(self, client: "BlockedClient", registry: "BlockedClients"):
+        self._blocked = (client, registry)
+
+    def unblock(self, response):
+        """
+        Delivers the reply of a blocked command, from any thread. The rest of
+        the pipeline runs on a later loop iteration, not from the writer that
+        served this client.
+        """
+        self._loop.call_soon_threadsafe(self._resume, response)
+
+    def _resume(self, response):
+        self._blocked = None
+        if self._closed:
+            return
+
+        self.write(response)
+        self._paused = False
+        self._update_events()
+
+        self.process_commands()
 
 
 class ServerRole(Enum):
@@ -452,20 +1680,224 @@ class ServerRole(Enum):
 class ConfigObject(object):
     name: str = ""
     value: Any = None
+    # Allowed values of enumerated options
+    choices: tuple = None
+    # Validates and normalizes the string form of free-form options
+    parse: Any = None
+    # (min, max) range integer values are clamped to
+    bounds: tuple = None
 
     def build(self):
+        if isinstance(self.value, bool):
+            return [self.name, "yes" if self.value else "no"]
         return [self.name, str(self.value)]
 
+    def set(self, value: str):
+        """
+        Sets the option from its string form, converted to the type of the
+        current value.
+        """
+        if isinstance(self.value, bool):
+            if value.lower() not in ("yes", "no"):
+                raise ValueError("argument must be 'yes' or 'no'")
+            self.value = value.lower() == "yes"
+        elif isinstance(self.value, int):
+            try:
+                number = parse_memory(value)
+            except ValueError:
+                raise ValueError("argument couldn't be parsed into an integer")
+            if self.bounds is not None:
+                low, high = self.bounds
+                number = min(max(number, low), high)
+            self.value = number
+        elif self.choices is not None:
+            if value.lower() not in self.choices:
+                raise ValueError(
+                    f"argument(s) must be one of the following: {', '.join(self.choices)}"
+                )
+            self.value = value.lower()
+        elif self.parse is not None:
+            self.value = self.parse(value)
+        else:
+            self.value = value
+
+
+def parse_save_params(value: str):
+    """
+    Validates a list of "<seconds> <changes>" snapshot rules, an empty
+    string disables automatic snapshots.
+    """
+    params = value.split()
+    if len(params) % 2:
+        raise ValueError("Invalid save parameters")
+    for param in params:
+        if not param.isdigit():
+            raise ValueError("Invalid save parameters")
+    return " ".join(params)
+
+
+# Client classes of client-output-buffer-limit, "slave" is an alias of
+# "replica"
+OUTPUT_BUFFER_CLASSES = ("normal", "replica", "pubsub")
+
+
+def parse_output_buffer_limits(value: str):
+    """
+    Validates "<class> <hard> <soft> <soft seconds>" groups, with memory
+    units allowed for the limits. Returns them normalized to bytes.
+    """
+    params = value.split()
+    if not params or len(params) % 4:
+        raise ValueError("Wrong number of arguments in buffer limit configuration.")
+
+    groups = []
+    for i in range(0, len(params), 4):
+        cls = params[i].lower()
+        cls = "replica" if cls == "slave" else cls
+        if cls not in OUTPUT_BUFFER_CLASSES:
+            raise ValueError("Invalid client class specified in buffer limit configuration.")
+
+        hard, soft = parse_memory(params[i + 1]), parse_memory(params[i + 2])
+        soft_seconds = int(params[i + 3])
+        if hard < 0 or soft < 0 or soft_seconds < 0:
+            raise ValueError("Error in hard, soft or soft_seconds setting in buffer limit configuration.")
+        groups.append(f"{cls} {hard} {soft} {soft_seconds}")
+    return " ".join(groups)
+
+
+def parse_memory(value: str):
+    """
+    Converts a number with an optional memory unit (1k, 5mb, 2gb...) to an
+    integer.
+    """
+    units = {
+        "k": 1000,
+        "kb": 1024,
+        "m": 1000**2,
+        "mb": 1024**2,
+        "g": 1000**3,
+        "gb": 1024**3,
+    }
+
+    value = value.lower()
+    for unit in ("kb", "mb", "gb", "k", "m", "g"):
+        if value.endswith(unit):
+            return int(value[: -len(unit)]) * units[unit]
+
+    return int(value)
+
 
 class ServerConfig(object):
     dirpath: ConfigObject = ConfigObject(name="dir")
     dbfilename: ConfigObject = ConfigObject(name="dbfilename")
     rdbchecksum: ConfigObject = ConfigObject(name="rdbchecksum")
+    output_flush_size: ConfigObject = ConfigObject(name="output-flush-size")
+    slowlog_log_slower_than: ConfigObject = ConfigObject(
+        name="slowlog-log-slower-than"
+    )
+    slowlog_max_len: ConfigObject = ConfigObject(name="slowlog-max-len")
+    # Same range as Redis' CONFIG_MIN_HZ and CONFIG_MAX_HZ
+    hz: ConfigObject = ConfigObject(name="hz", bounds=(1, 500))
+    maxmemory: ConfigObject = ConfigObject(name="maxmemory")
+    maxmemory_policy: ConfigObject = ConfigObject(
+        name="maxmemory-policy",
+        choices=(
+            "volatile-lru",
+            "volatile-lfu",
+            "volatile-random",
+            "volatile-ttl",
+            "allkeys-lru",
+            "allkeys-lfu",
+            "allkeys-random",
+            "noeviction",
+        ),
+    )
+    maxmemory_samples: ConfigObject = ConfigObject(name="maxmemory-samples")
+    save: ConfigObject = ConfigObject(name="save", parse=parse_save_params)
+    appendonly: ConfigObject = ConfigObject(name="appendonly")
+    appendfilename: ConfigObject = ConfigObject(name="appendfilename")
+    appendfsync: ConfigObject = ConfigObject(
+        name="appendfsync", choices=("always", "everysec", "no")
+    )
+    auto_aof_rewrite_percentage: ConfigObject = ConfigObject(
+        name="auto-aof-rewrite-percentage"
+    )
+    auto_aof_rewrite_min_size: ConfigObject = ConfigObject(
+        name="auto-aof-rewrite-min-size"
+    )
+    repl_backlog_size: ConfigObject = ConfigObject(name="repl-backlog-size")
+    client_output_buffer_limit: ConfigObject = ConfigObject(
+        name="client-output-buffer-limit", parse=parse_output_buffer_limits
+    )
+    repl_diskless_sync: ConfigObject = ConfigObject(name="repl-diskless-sync")
+    repl_diskless_sync_delay: ConfigObject = ConfigObject(
+        name="repl-diskless-sync-delay"
+    )
 
     def __init__(self, rdbchecksum: bool = True, **kwargs):
         self.rdbchecksum.value = rdbchecksum
         self.dirpath.value = kwargs.get("dirpath", "")
         self.dbfilename.value = kwargs.get("dbfilename", "")
+        self.output_flush_size.value = kwargs.get("output_flush_size", 64 * 1024)
+        self.slowlog_log_slower_than.value = kwargs.get(
+            "slowlog_log_slower_than", 10000
+        )
+        self.slowlog_max_len.value = kwargs.get("slowlog_max_len", 128)
+        low, high = self.hz.bounds
+        self.hz.value = min(max(kwargs.get("hz", 10), low), high)
+        self.maxmemory.value = kwargs.get("maxmemory", 0)
+        self.maxmemory_policy.value = kwargs.get("maxmemory_policy", "noeviction")
+        self.maxmemory_samples.value = kwargs.get("maxmemory_samples", 5)
+        self.save.value = parse_save_params(
+            kwargs.get("save", "3600 1 300 100 60 10000")
+        )
+        self.appendonly.value = kwargs.get("appendonly", False)
+        self.appendfilename.value = kwargs.get("appendfilename", "appendonly.aof")
+        self.appendfsync.value = kwargs.get("appendfsync", "everysec")
+        self.auto_aof_rewrite_percentage.value = kwargs.get(
+            "auto_aof_rewrite_percentage", 100
+        )
+        self.auto_aof_rewrite_min_size.value = kwargs.get(
+            "auto_aof_rewrite_min_size", 64 * 1024 * 1024
+        )
+        self.repl_backlog_size.value = kwargs.get("repl_backlog_size", 1024 * 1024)
+        self.repl_diskless_sync.value = kwargs.get("repl_diskless_sync", False)
+        self.client_output_buffer_limit.value = parse_output_buffer_limits(
+            kwargs.get(
+                "client_output_buffer_limit",
+                "normal 0 0 0 replica 256mb 64mb 60 pubsub 32mb 8mb 60",
+            )
+        )
+        self.repl_diskless_sync_delay.value = kwargs.get("repl_diskless_sync_delay", 5)
+
+    def save_params(self):
+        """
+        The automatic snapshot rules as (seconds, changes) pairs.
+        """
+        params = [int(p) for p in self.save.value.split()]
+        return list(zip(params[::2], params[1::2]))
+
+    def output_buffer_limit(self, cls: str):
+        """
+        The (hard, soft, soft seconds) output limits of a client class, 0
+        meaning no limit.
+        """
+        params = self.client_output_buffer_limit.value.split()
+        for i in range(0, len(params), 4):
+            if params[i] == cls:
+                return tuple(int(p) for p in params[i + 1 : i + 4])
+        return (0, 0, 0)
+
+    def options(self):
+        return [
+            opt for opt in vars(ServerConfig).values() if isinstance(opt, ConfigObject)
+        ]
+
+    def lookup(self, name: str):
+        for opt in self.options():
+            if opt.name == name:
+                return opt
+        return None
 
     def build(self):
         return self.dirpath.build() + self.dbfilename.build()
@@ -474,591 +1906,3302 @@ class ServerConfig(object):
         return f"ServerConfig(rdbchecksum={self.rdbchecksum}, dirpath={self.dirpath}, dbfilename={self.dbfilename})"
 
 
-class Server(object):
-    _instance = None
-    PROPAGATED_COMMANDS = ["SET", "DEL", "XADD"]
+class LatencyHistogram(object):
+    """
+    HDR-style latency histogram with power of two buckets in microseconds.
+    Recording a sample is a bit_length() and a list increment.
+    """
 
-    def __init__(
-        self,
-        config: ServerConfig,
-        port: int = 6379,
-        role: ServerRole = ServerRole.MASTER,
-    ):
-        self._host = "localhost"
-        self._port = port
-        self._role = role
-        self._replicas = []
-        self.ackcount = 0
-        self._xadd_ev = Event()
-        self._xadd_streams = set()
+    __slots__ = ("_counts",)
 
-        self.master_replid = secrets.token_hex(20)
-        self.master_repl_offset = 0
+    NBUCKETS = 64
 
-        self.config = config
+    def __init__(self):
+        self._counts = [0] * LatencyHistogram.NBUCKETS
 
-        self.read_rdb()
+    def record(self, usec: int):
+        # Bucket b holds samples in (2^(b-1), 2^b] usec
+        self._counts[(usec - 1).bit_length() if usec > 1 else 0] += 1
 
-    def __new__(
-        cls,
-        port: int = 6379,
-        role: ServerRole = ServerRole.MASTER
-    ):
-        if cls._instance is None:
-            cls._instance = super(Server, cls).__new__(cls)
-            cls._instance.__init__(port, role)
-        return cls._instance
+    def build(self):
+        """
+        Returns the cumulative count of samples per bucket upper bound,
+        skipping buckets where the count doesn't change.
+        """
+        payload = []
+        total = 0
+        for b, count in enumerate(self._counts):
+            if count == 0:
+                continue
+            total += count
+            payload += [1 << b, total]
 
-    @property
-    def port(self):
-        return self._port
+        return payload
 
-    @port.setter
-    def port(self, port_: int):
-        self._port = port_
 
-    @property
-    def role(self):
-        return self._role.value
+class SlowLog(object):
+    """
+    Bounded log of the commands exceeding slowlog-log-slower-than.
+    """
+
+    MAX_ARGC = 32
+    MAX_STRING = 128
+
+    def __init__(self, maxlen: int = 128):
+        self._entries = deque(maxlen=maxlen)
+        self._next_id = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def resize(self, maxlen: int):
+        with self._lock:
+            if maxlen != self._entries.maxlen:
+                self._entries = deque(self._entries, maxlen=maxlen)
+
+    def add(self, command: str, args: list, duration: int, conn: "Connection"):
+        argv = [command] + args
+        if len(argv) > SlowLog.MAX_ARGC:
+            more = len(argv) - SlowLog.MAX_ARGC + 1
+            argv = argv[: SlowLog.MAX_ARGC - 1] + [f"... ({more} more arguments)"]
+
+        for i, arg in enumerate(argv):
+            if len(arg) > SlowLog.MAX_STRING:
+                more = len(arg) - SlowLog.MAX_STRING
+                argv[i] = f"{arg[:SlowLog.MAX_STRING]}... ({more} more bytes)"
+
+        addr = f"{conn.addr[0]}:{conn.addr[1]}" if conn else ""
+
+        with self._lock:
+            entry = [self._next_id, int(time.time()), duration, argv, addr, ""]
+            self._next_id += 1
+            self._entries.appendleft(entry)
+
+    def build(self, count: int = 10):
+        with self._lock:
+            if count == -1:
+                count = len(self._entries)
+            return list(self._entries)[:count]
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ReplicationBacklog(object):
+    """
+    Circular buffer holding the tail of the replication stream, so that a
+    replica reconnecting with PSYNC gets the bytes it missed rather than a
+    full snapshot.
+
+    Offsets are those of master_repl_offset: the first byte ever streamed
+    is at offset 1 and the last byte fed is at end_offset.
+    """
+
+    MIN_SIZE = 16 * 1024
+
+    def __init__(self, size: int, end_offset: int):
+        self.size = max(size, ReplicationBacklog.MIN_SIZE)
+        self._buf = bytearray(self.size)
+        # Next write position in _buf
+        self._idx = 0
+        self.histlen = 0
+        self.end_offset = end_offset
+
+    @property
+    def start_offset(self):
+        return self.end_offset - self.histlen + 1
+
+    def resize(self, size: int):
+        """
+        Drops the history, replicas reconnecting afterwards resync fully.
+        """
+        self.size = max(size, ReplicationBacklog.MIN_SIZE)
+        self._buf = bytearray(self.size)
+        self._idx = 0
+        self.histlen = 0
+
+    def feed(self, data: bytes):
+        n = len(data)
+        self.end_offset += n
+        self.histlen = min(self.histlen + n, self.size)
+        if n > self.size:
+            data = memoryview(data)[n - self.size :]
+            n = self.size
+
+        first = min(n, self.size - self._idx)
+        self._buf[self._idx : self._idx + first] = data[:first]
+        if first < n:
+            self._buf[: n - first] = data[first:]
+        self._idx = (self._idx + n) % self.size
+
+    def contains(self, offset: int):
+        """
+        True if the stream can be continued from offset, the offset of the
+        next byte the replica expects.
+        """
+        return self.start_offset <= offset <= self.end_offset + 1
+
+    def read_from(self, offset: int):
+        length = self.end_offset - offset + 1
+        pos = (self._idx - length) % self.size
+        if pos + length <= self.size:
+            return bytes(self._buf[pos : pos + length])
+        return bytes(self._buf[pos:]) + bytes(self._buf[: length - (self.size - pos)])
+
+
+# Returned by command handlers whose reply is delivered once the client is
+# unblocked
+BLOCKED = object()
+
+# WAIT callers block on replica acknowledgements rather than on a key
+WAIT_ACKS = "__wait_acks__"
+
+
+class BlockedClient(object):
+    """
+    A client waiting on keys. serve() returns the reply once the client can
+    be unblocked or None to keep waiting, on_timeout() returns the reply
+    when the timeout elapses first. deliver(reply) hands the reply over to
+    the client.
+    """
+
+    __slots__ = ("keys", "serve", "on_timeout", "deliver", "timer", "blocked")
+
+    def __init__(self, keys: list, serve, on_timeout):
+        self.keys = keys
+        self.serve = serve
+        self.on_timeout = on_timeout
+        self.deliver = None
+        self.timer: TimerHandle = None
+        self.blocked = False
+
+
+class BlockedClients(object):
+    """
+    Registry of the clients blocked on keys. Every key has its own FIFO
+    queue of waiters, so a write only serves the clients blocked on the key
+    it changed, in the order they blocked.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # key -> waiters, dicts keep the insertion order and remove in O(1)
+        self._waiters: dict[str, dict[BlockedClient, None]] = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def block(self, client: "BlockedClient"):
+        """
+        Registers the client, then runs serve() once more under the lock: a
+        write landing after the caller's own check and before the client was
+        registered found no waiter to signal. Returns the reply if there is
+        one already, the client is then not left blocked.
+        """
+        with self._lock:
+            client.blocked = True
+            self._count += 1
+            for key in client.keys:
+                self._waiters.setdefault(key, {})[client] = None
+
+            reply = client.serve()
+            if reply is not None:
+                self._unblock(client)
+            return reply
+
+    def unblock(self, client: BlockedClient):
+        """
+        Removes the client from the registry. Returns False if it was already
+        served or timed out.
+        """
+        with self._lock:
+            return self._unblock(client)
+
+    def _unblock(self, client: BlockedClient):
+        if not client.blocked:
+            return False
+
+        client.blocked = False
+        self._count -= 1
+        if client.timer is not None:
+            client.timer.cancel()
+
+        for key in client.keys:
+            queue = self._waiters.get(key)
+            if queue is not None:
+                queue.pop(client, None)
+                if not queue:
+                    del self._waiters[key]
+
+        return True
+
+    def timeout(self, client: BlockedClient):
+        if self.unblock(client):
+            client.deliver(client.on_timeout())
+
+    def signal_key_ready(self, key: str):
+        """
+        Serves the clients blocked on key, in the order they blocked.
+        """
+        if key not in self._waiters:
+            return
+
+        served = []
+        with self._lock:
+            for client in list(self._waiters.get(key, ())):
+                reply = client.serve()
+                if reply is not None:
+                    self._unblock(client)
+                    served.append((client, reply))
+
+        for client, reply in served:
+            client.deliver(reply)
+
+
+@dataclass
+class CommandSpec(object):
+    """
+    Command table entry. Arity counts the command name itself and a negative
+    arity means at least that many arguments, like in Redis.
+    """
+
+    name: str
+    handler: Any
+    arity: int
+    flags: tuple = ()
+    first_key: int = 0
+    last_key: int = 0
+    step: int = 0
+
+    # Statistics, see INFO commandstats and LATENCY HISTOGRAM
+    calls: int = 0
+    usec: int = 0
+    rejected_calls: int = 0
+    failed_calls: int = 0
+    histogram: "LatencyHistogram" = field(default_factory=lambda: LatencyHistogram())
+
+    def record(self, duration: int):
+        self.calls += 1
+        self.usec += duration
+        self.histogram.record(duration)
+
+    def reset_stats(self):
+        self.calls = 0
+        self.usec = 0
+        self.rejected_calls = 0
+        self.failed_calls = 0
+        self.histogram = LatencyHistogram()
+
+    @property
+    def propagate(self):
+        return "write" in self.flags
+
+    def check_arity(self, argc: int):
+        if self.arity < 0:
+            return argc >= -self.arity
+        return argc == self.arity
+
+    def build(self):
+        return [
+            self.name.lower(),
+            self.arity,
+            list(self.flags),
+            self.first_key,
+            self.last_key,
+            self.step,
+        ]
+
+
+COMMAND_TABLE: dict[str, CommandSpec] = {}
+
+
+def command(
+    name: str,
+    arity: int,
+    flags: tuple = (),
+    first_key: int = 0,
+    last_key: int = 0,
+    step: int = 0,
+):
+    """
+    Registers the decorated Server method as the handler of a command.
+    """
+
+    def decorator(func):
+        COMMAND_TABLE[name] = CommandSpec(
+            name, func, arity, flags, first_key, last_key, step
+        )
+        return func
+
+    return decorator
+
+
+class Server(object):
+    _instance = None
+    # Filled in from the command table flags
+    BLOCKING_COMMANDS = frozenset()
+
+    def __init__(
+        self,
+        config: ServerConfig,
+        port: int = 6379,
+        role: ServerRole = ServerRole.MASTER,
+    ):
+        self._host = "localhost"
+        self._port = port
+        self._role = role
+        self._replicas = []
+        self.maxclients = 10000
+        self.loop: EventLoop = None
+        self.blocked = BlockedClients()
+        # WAIT callers, all blocked on WAIT_ACKS and served on REPLCONF ACK
+        self.waiting_acks = BlockedClients()
+        self._getack_offset = -1
+
+        self.master_replid = secrets.token_hex(20)
+        self.master_repl_offset = 0
+        # History this server inherited, see shift_replication_id()
+        self.replid2 = "0" * 40
+        self.second_replid_offset = -1
+        # Created along with the first replica, see feed_replication_stream()
+        self.repl_backlog: ReplicationBacklog = None
+        self.repl_lock = RLock()
+        # "disk" for BGSAVE, "socket" when streaming to diskless replicas
+        self.rdb_child_type: str = None
+        self.stat_sync_full = 0
+        self.stat_client_outbuf_limit_disconnections = 0
+        self.stat_sync_partial_ok = 0
+        self.stat_sync_partial_err = 0
+
+        # Replica side, see replication_set_master()
+        self.master_host: str = None
+        self.master_port = 0
+        self.master_socket: socket.socket = None
+        self.master_link_status = "down"
+        self.master_sync_in_progress = False
+        self.master_last_io = 0
+        # Bytes of the master's stream applied, acknowledged with REPLCONF
+        # ACK. Local writes on a replica don't count, see propagate()
+        self.master_link_offset = 0
+        # Bumped on every master change, older link threads exit
+        self.master_link_gen = 0
+        # True once master_replid and master_repl_offset hold a history a
+        # master may continue with PSYNC
+        self.cached_master = False
+
+        self.config = config
+        self.slowlog = SlowLog(config.slowlog_max_len.value)
+
+        # Statistics, see INFO
+        self.start_time = time.time()
+        self.run_id = secrets.token_hex(20)
+        self.dirty = 0
+        self.stat_numcommands = 0
+        self.stat_numconnections = 0
+        self.stat_rejected_conn = 0
+        self.stat_net_input_bytes = 0
+        self.stat_net_output_bytes = 0
+        self.stat_evicted_keys = 0
+        self.stat_peak_memory = 0
+        self._metrics: dict[str, tuple] = {}
+
+        # Snapshotting, see SAVE and BGSAVE
+        self.rdb_child_pid = -1
+        self.rdb_save_time_start = 0
+        self.rdb_save_time_last = -1
+        self.rdb_saves = 0
+        self.lastbgsave_status = True
+        self.lastbgsave_try = 0
+        self._dirty_before_bgsave = 0
+        # Set by SIGTERM/SIGINT, the cron saves and exits
+        self.shutdown_asap = False
+
+        # Append only file: write commands are buffered and written out
+        # before replying, see flush_append_only_file()
+        self.aof_fd = -1
+        self.aof_buf = bytearray()
+        self.aof_buf_lock = Lock()
+        self.aof_write_lock = Lock()
+        self.aof_current_size = 0
+        self.aof_fsynced_size = 0
+        self.aof_last_fsync = time.monotonic()
+        self.aof_fsync_in_progress = False
+        self.aof_flush_postponed_start = 0
+        self.aof_last_write_status = True
+        self.stat_aof_delayed_fsync = 0
+        self.stat_aof_fsyncs = 0
+        self.stat_aof_fsync_usec = 0
+        self.aof_last_fsync_usec = 0
+        # AOF rewrite, see rewrite_append_only_file_background()
+        self.aof_child_pid = -1
+        self.aof_rewrite_buf: bytearray = None
+        self.aof_rewrite_scheduled = False
+        self.aof_rewrite_base_size = 0
+        self.aof_rewrite_time_start = 0
+        self.aof_rewrite_time_last = -1
+        self.aof_lastbgrewrite_status = True
+        self.stat_aof_rewrites = 0
+        # Event loop clients whose replies wait for the AOF fsync
+        self.clients_pending_write: dict[Connection, None] = {}
+        self.loading = False
+
+        store.update_clock()
+        store.set_policy(config.maxmemory_policy.value)
+
+        self.load_data()
+        self.lastsave = time.time()
+
+    def __new__(cls, *args, **kwargs):
+        # __init__ runs right after, loading the dataset only once
+        if cls._instance is None:
+            cls._instance = super(Server, cls).__new__(cls)
+        return cls._instance
+
+    @property
+    def port(self):
+        return self._port
+
+    @port.setter
+    def port(self, port_: int):
+        self._port = port_
+
+    @property
+    def role(self):
+        return self._role.value
+
+    @role.setter
+    def role(self, role_: ServerRole):
+        self._role = role_
+
+    def add_replica(self, conn: Connection):
+        self._replicas.append(conn)
+
+    METRIC_SAMPLES = 16
+
+    def track_instantaneous_metric(self, name: str, value: int):
+        """
+        Samples the rate of change per second of a counter, see
+        instantaneous_metric().
+        """
+        now = time.monotonic()
+        last_time, last_value, samples = self._metrics.get(
+            name, (now, value, deque(maxlen=Server.METRIC_SAMPLES))
+        )
+        if now > last_time:
+            samples.append((value - last_value) / (now - last_time))
+        self._metrics[name] = (now, value, samples)
+
+    def instantaneous_metric(self, name: str):
+        _, _, samples = self._metrics.get(name, (0, 0, ()))
+        if not samples:
+            return 0
+        return int(sum(samples) / len(samples))
+
+    # Share of each cron period the active expire cycle may use
+    ACTIVE_EXPIRE_CYCLE_SLOW_TIME_PERC = 25
+
+    def cron(self):
+        """
+        Periodic tasks, runs hz times per second.
+        """
+        self.track_instantaneous_metric("commands", self.stat_numcommands)
+        self.track_instantaneous_metric("net_input", self.stat_net_input_bytes)
+        self.track_instantaneous_metric("net_output", self.stat_net_output_bytes)
+        self.stat_peak_memory = max(self.stat_peak_memory, store.used_memory())
+        store.update_clock()
+
+        if self.shutdown_asap:
+            self.shutdown_asap = False
+            if not self.shutdown():
+                print("SIGTERM received but errors trying to shut down the server")
+
+        if self.rdb_child_pid != -1:
+            self.check_child_done()
+        if self.aof_child_pid != -1:
+            self.check_aof_child_done()
+
+        with self.repl_lock:
+            for r in list(self._replicas):
+                self.check_output_buffer_limits(r)
+
+        if not self.has_active_child():
+            self.start_replicas_sync()
+
+        if not self.has_active_child():
+            if self.aof_rewrite_scheduled:
+                try:
+                    self.rewrite_append_only_file_background()
+                except OSError:
+                    pass
+            else:
+                self.check_save_params()
+                self.check_aof_rewrite_params()
+
+        # Buffered expired keys in threaded mode, and the everysec fsync
+        self.flush_append_only_file()
+
+        if self._role == ServerRole.MASTER:
+            # Replicas wait for the master to propagate the expired keys
+            budget = Server.ACTIVE_EXPIRE_CYCLE_SLOW_TIME_PERC / 100 / self.config.hz.value
+            for key in store.active_expire_cycle(budget):
+                self.propagate(["DEL", key])
+
+    def start_cron(self):
+        def tick():
+            try:
+                self.cron()
+            except Exception as e:
+                sys.stderr.write(f"Error in the server cron: {e}\n")
+            finally:
+                # A failed run must not stop expiry, saves and shutdown
+                self.loop.call_later(1 / self.config.hz.value, tick)
+
+        if self.loop is not None:
+            self.loop.call_later(1 / self.config.hz.value, tick)
+        else:
+            Thread(target=server_cron, daemon=True).start()
+
+    def may_block(self, command: str, args: list):
+        if command not in self.BLOCKING_COMMANDS:
+            return False
+        if self.loop is not None:
+            # The event loop parks blocked clients in a registry instead
+            return False
+        if command == "XREAD":
+            return any(arg.upper() == "BLOCK" for arg in args)
+        return True
+
+    def block_client(
+        self,
+        conn: Connection,
+        keys: list,
+        serve,
+        on_timeout,
+        timeout: int,
+        registry: BlockedClients = None,
+    ):
+        """
+        Blocks the client until serve() returns a reply after a write on one
+        of keys, or until timeout milliseconds elapse (0 waits forever).
+
+        In event loop mode the connection is parked and BLOCKED is returned,
+        otherwise the calling thread waits for the reply.
+        """
+        if registry is None:
+            registry = self.blocked
+
+        client = BlockedClient(keys, serve, on_timeout)
+
+        if conn is not None and conn.loop is not None:
+            client.deliver = conn.unblock
+            reply = registry.block(client)
+            if reply is not None:
+                return reply
+            conn.block(client, registry)
+            if timeout > 0:
+                client.timer = self.loop.call_later(
+                    timeout / 1000, lambda: registry.timeout(client)
+                )
+            return BLOCKED
+
+        replies = []
+        ready = Event()
+
+        def deliver(reply):
+            replies.append(reply)
+            ready.set()
+
+        client.deliver = deliver
+        reply = registry.block(client)
+        if reply is not None:
+            return reply
+        ready.wait(timeout / 1000 if timeout > 0 else None)
+        registry.timeout(client)
+
+        return replies[0]
+
+    def remove_replica(self, conn: Connection):
+        if conn in self._replicas:
+            self._replicas.remove(conn)
+
+    def replicas_acked(self, offset: int):
+        """
+        Returns the number of replicas that acknowledged offset.
+        """
+        return sum(1 for r in self._replicas if r.repl_ack_offset >= offset)
+
+    def relay(self, msg: bytes):
+        """
+        Queues msg to every replica, none of them is written to from here.
+        """
+        for r in list(self._replicas):
+            try:
+                r.relay(msg)
+            except OSError as e:
+                # A dead replica must not fail the writer, nor the cron
+                sys.stderr.write(f"Dropping replica {r.addr}: {e}\n")
+                self.free_replica(r)
+                continue
+            self.check_output_buffer_limits(r)
+
+    def check_output_buffer_limits(self, conn: Connection):
+        """
+        Disconnects a replica whose pending output, including the writes
+        buffered during a full sync, passed the hard limit, or stayed over
+        the soft limit for longer than soft-seconds.
+        """
+        hard, soft, soft_seconds = self.config.output_buffer_limit("replica")
+        size = conn.output_size() + len(conn.repl_pending or b"")
+
+        if hard and size >= hard:
+            pass
+        elif soft and size >= soft:
+            now = time.monotonic()
+            if conn.obuf_soft_limit_reached_time == 0:
+                conn.obuf_soft_limit_reached_time = now
+                return
+            if now - conn.obuf_soft_limit_reached_time <= soft_seconds:
+                return
+        else:
+            conn.obuf_soft_limit_reached_time = 0
+            return
+
+        sys.stderr.write(
+            f"Client {conn.addr} scheduled to be closed ASAP for overcoming of "
+            f"output buffer limits ({size} bytes).\n"
+        )
+        self.stat_client_outbuf_limit_disconnections += 1
+        self.free_replica(conn)
+
+    def perform_evictions(self):
+        """
+        Evicts keys until the used memory is back under maxmemory, evicted
+        keys are propagated as DEL. Returns False if the limit can't be met.
+        Replicas don't evict, they get the DELs of their master.
+        """
+        maxmemory = self.config.maxmemory.value
+        policy = self.config.maxmemory_policy.value
+
+        while store.used_memory() > maxmemory:
+            if policy == "noeviction":
+                return False
+
+            key = store.evict(policy, self.config.maxmemory_samples.value)
+            if key is None:
+                return False
+
+            self.stat_evicted_keys += 1
+            self.propagate(["DEL", key])
+
+        return True
+
+    def propagate(self, argv: list):
+        """
+        Sends a command to the AOF and, on a master, to the replicas
+        through the replication stream.
+        """
+        request_bytes = RESPbuilder.build(argv)
+        self.feed_append_only_file(request_bytes)
+        if self._role == ServerRole.SLAVE:
+            # The stream of a replica is the one of its master, writes made
+            # on it stay local
+            return
+        self.feed_replication_stream(request_bytes)
+
+    def feed_replication_stream(self, data: bytes):
+        """
+        Appends to the replication stream: sent to the replicas and kept in
+        the backlog for the ones reconnecting.
+        """
+        with self.repl_lock:
+            self.relay(data)
+            if self.repl_backlog is not None:
+                self.repl_backlog.feed(data)
+            self.master_repl_offset += len(data)
+
+    def create_replication_backlog(self):
+        if self.repl_backlog is None:
+            self.repl_backlog = ReplicationBacklog(
+                self.config.repl_backlog_size.value, self.master_repl_offset
+            )
+
+    def shift_replication_id(self):
+        """
+        Starts a new history on promotion to master. The previous ID is
+        kept as replid2, so that the replicas of the former master can
+        still continue from this server up to the offset of the switch.
+        """
+        self.replid2 = self.master_replid
+        self.second_replid_offset = self.master_repl_offset + 1
+        self.master_replid = secrets.token_hex(20)
+        print(
+            f"Setting secondary replication ID to {self.replid2}, valid up to "
+            f"offset: {self.second_replid_offset}. New replication ID is "
+            f"{self.master_replid}"
+        )
+
+    def try_partial_resync(self, conn: Connection, replid: str, psync_offset: int):
+        """
+        Continues the replication stream of conn from psync_offset when it
+        is in the backlog of the same history. Called with repl_lock held.
+        """
+        if replid != self.master_replid and (
+            replid != self.replid2 or psync_offset > self.second_replid_offset
+        ):
+            return False
+
+        backlog = self.repl_backlog
+        if backlog is None or not backlog.contains(psync_offset):
+            return False
+
+        conn.set_replica()
+        conn.repl_ack_offset = psync_offset - 1
+        if "psync2" in conn.repl_capa:
+            reply = f"+CONTINUE {self.master_replid}\r\n".encode()
+        else:
+            reply = b"+CONTINUE\r\n"
+        missing = backlog.read_from(psync_offset)
+        conn.send(reply + missing)
+        print(
+            f"Partial resynchronization request from {conn.addr} accepted. "
+            f"Sending {len(missing)} bytes of backlog starting from offset "
+            f"{psync_offset}."
+        )
+        return True
+
+    def full_resync(self, conn: Connection):
+        """
+        Queues conn for a snapshot, the replication stream follows from the
+        offset it is taken at. Called with repl_lock held.
+        """
+        self.create_replication_backlog()
+        conn.set_replica(ReplicaState.WAIT_BGSAVE_START)
+        conn.repl_wait_start = time.monotonic()
+
+        if self.rdb_child_type == "disk":
+            # Share the BGSAVE in progress with the replica waiting for it
+            for r in self._replicas:
+                if r.repl_state == ReplicaState.WAIT_BGSAVE_END:
+                    conn.repl_pending = bytearray(r.repl_pending)
+                    self.setup_replica_for_full_resync(conn, r.repl_psync_offset)
+                    print(f"Waiting for end of BGSAVE for SYNC of {conn.addr}")
+                    return
+
+        # Otherwise the cron starts it once the running child is done
+        self.start_replicas_sync()
+
+    def setup_replica_for_full_resync(self, conn: Connection, offset: int):
+        conn.repl_state = ReplicaState.WAIT_BGSAVE_END
+        conn.repl_psync_offset = offset
+        conn.repl_ack_offset = offset
+        if conn.repl_pending is None:
+            conn.repl_pending = bytearray()
+        conn.send(
+            RESPbuilder.build(f"FULLRESYNC {self.master_replid} {offset}", bulkstr=False)
+        )
+
+    def start_replicas_sync(self):
+        """
+        Starts the snapshot for the replicas waiting for one, unless another
+        child is running. With repl-diskless-sync the start is delayed by
+        repl-diskless-sync-delay seconds, so replicas arriving together are
+        served by one child.
+        """
+        with self.repl_lock:
+            waiting = [
+                r for r in self._replicas
+                if r.repl_state == ReplicaState.WAIT_BGSAVE_START
+            ]
+            if not waiting or self.has_active_child():
+                return
+
+            diskless = self.config.repl_diskless_sync.value and all(
+                "eof" in r.repl_capa for r in waiting
+            )
+            if diskless:
+                idle = time.monotonic() - min(r.repl_wait_start for r in waiting)
+                if idle < self.config.repl_diskless_sync_delay.value:
+                    return
+
+            offset = self.master_repl_offset
+            try:
+                if diskless:
+                    rfd = self.rdb_save_to_replicas_sockets()
+                else:
+                    self.bgsave()
+            except OSError as e:
+                sys.stderr.write(f"BGSAVE for replication failed: {e}\n")
+                for r in waiting:
+                    self.free_replica(r)
+                return
+
+            print(
+                f"Starting BGSAVE for SYNC with target: "
+                f"{'replicas sockets' if diskless else 'disk'}"
+            )
+            for r in waiting:
+                self.setup_replica_for_full_resync(r, offset)
+
+            if diskless:
+                for r in waiting:
+                    r.repl_state = ReplicaState.SEND_BULK
+                Thread(
+                    target=self.send_rdb_pipe_to_replicas,
+                    args=(rfd, waiting),
+                    daemon=True,
+                ).start()
+
+    # Bytes of snapshot read and sent to the replicas at a time
+    REPL_TRANSFER_CHUNK = 64 * 1024
+    # Snapshot bytes queued to a replica before the transfer waits for it
+    REPL_TRANSFER_MAX_QUEUED = 4 * REPL_TRANSFER_CHUNK
+
+    def rdb_save_to_replicas_sockets(self):
+        """
+        Forks a child writing the snapshot to a pipe, whose read end is
+        returned. No file is written, see send_rdb_pipe_to_replicas().
+        """
+        rfd, wfd = os.pipe()
+
+        def job():
+            os.close(rfd)
+            with os.fdopen(wfd, "wb") as f:
+                RDBwriter(f, self.config.rdbchecksum.value).save(store)
+
+        try:
+            pid = self.fork_child(job)
+        except OSError:
+            os.close(rfd)
+            os.close(wfd)
+            raise
+        os.close(wfd)
+
+        self.rdb_child_pid = pid
+        self.rdb_child_type = "socket"
+        self.rdb_save_time_start = time.time()
+        return rfd
+
+    def send_rdb_pipe_to_replicas(self, rfd: int, replicas: list):
+        """
+        Streams the snapshot written by the child to the replicas as it is
+        produced. With no length known upfront, the payload is delimited
+        by a random mark: $EOF:<mark>CRLF<rdb><mark>.
+        """
+        mark = secrets.token_hex(20).encode()
+        replicas = self.send_to_replicas(replicas, b"$EOF:" + mark + b"\r\n")
+        with os.fdopen(rfd, "rb") as pipe:
+            while chunk := pipe.read1(Server.REPL_TRANSFER_CHUNK):
+                replicas = self.send_to_replicas(replicas, chunk)
+        replicas = self.send_to_replicas(replicas, mark)
+
+        for r in replicas:
+            self.replica_online(r)
+
+    def send_rdb_file_to_replica(self, conn: Connection):
+        try:
+            with open(self.rdb_path(), "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                conn.send(b"$%d\r\n" % size)
+                while chunk := f.read(Server.REPL_TRANSFER_CHUNK):
+                    conn.wait_output_below(Server.REPL_TRANSFER_MAX_QUEUED)
+                    conn.send(chunk)
+        except OSError as e:
+            sys.stderr.write(f"SYNC failed for replica {conn.addr}: {e}\n")
+            self.free_replica(conn)
+            return
+
+        self.replica_online(conn)
+
+    def send_to_replicas(self, replicas: list, data: bytes):
+        """
+        Sends data to each of replicas, returns the ones still connected.
+        """
+        alive = []
+        for r in replicas:
+            try:
+                r.wait_output_below(Server.REPL_TRANSFER_MAX_QUEUED)
+                r.send(data)
+                alive.append(r)
+            except OSError as e:
+                sys.stderr.write(f"SYNC failed for replica {r.addr}: {e}\n")
+                self.free_replica(r)
+        return alive
+
+    def replica_online(self, conn: Connection):
+        """
+        Sends the writes buffered during the transfer of the snapshot, from
+        then on conn gets the replication stream as it goes.
+        """
+        if conn.loop is not None and not conn.loop.in_loop_thread():
+            # After the chunks of the snapshot queued for the loop, and
+            # before any write relayed from there
+            conn.loop.call_soon_threadsafe(self.replica_online, conn)
+            return
+
+        with self.repl_lock:
+            pending = conn.repl_pending
+            conn.repl_pending = None
+            conn.repl_state = ReplicaState.ONLINE
+            try:
+                if pending:
+                    conn.send(bytes(pending))
+            except OSError as e:
+                sys.stderr.write(f"SYNC failed for replica {conn.addr}: {e}\n")
+                self.free_replica(conn)
+                return
+
+        print(f"Synchronization with replica {conn.addr} succeeded")
+
+    def free_replica(self, conn: Connection):
+        with self.repl_lock:
+            self.remove_replica(conn)
+        conn.close()
+
+    def update_replicas_waiting_bgsave(self, ok: bool):
+        """
+        Called when a BGSAVE to disk is done: the replicas waiting for it
+        are sent the file.
+        """
+        with self.repl_lock:
+            for r in list(self._replicas):
+                if r.repl_state != ReplicaState.WAIT_BGSAVE_END:
+                    continue
+
+                if not ok:
+                    sys.stderr.write(f"SYNC failed for replica {r.addr}: BGSAVE error\n")
+                    self.free_replica(r)
+                    continue
+
+                r.repl_state = ReplicaState.SEND_BULK
+                Thread(
+                    target=self.send_rdb_file_to_replica, args=(r,), daemon=True
+                ).start()
+
+    def replace_dataset(self, db: Store):
+        """
+        Swaps in the dataset received from the master for a full
+        resynchronization.
+        """
+        store.swap(db)
+        if self.aof_fd != -1:
+            # The AOF holds the history of the replaced dataset
+            self.stop_append_only()
+            self.start_append_only()
+
+    # Commands from the master applied per acquisition of the shard locks
+    REPL_APPLY_BATCH = 1024
+    # Seconds between the REPLCONF ACKs a replica sends to its master
+    REPL_ACK_PERIOD = 1
+
+    def apply_master_commands(self, frames: list, stream: bytearray, master_socket):
+        """
+        Applies the commands read from the master, frames as returned by
+        RESPparser.get_commands() over the bytes at the start of stream.
+        Writes are applied under a single acquisition of the shard locks and
+        added to the replication stream at once, under repl_lock so that a
+        snapshot for a sub-replica never sees a batch without its offset.
+        REPLCONF runs on its own, the offset acknowledged by GETACK covers
+        exactly the commands before it. Returns the number of bytes applied.
+        """
+        applied = at = 0
+        i = 0
+        while i < len(frames):
+            with self.repl_lock:
+                store.lock_all()
+                try:
+                    while i < len(frames):
+                        n, argv = frames[i]
+                        if argv and argv[0].upper() == "REPLCONF":
+                            break
+                        if argv:
+                            self.process_command(argv[0], argv[1:])
+                        at += n
+                        i += 1
+                finally:
+                    store.unlock_all()
+
+                if at > applied:
+                    self.feed_replication_stream(bytes(stream[applied:at]))
+                    self.master_link_offset += at - applied
+                    applied = at
+
+            if i < len(frames):
+                n, (command, *args) = frames[i]
+                response = self.process_command(command, args)
+                if response:
+                    master_socket.sendall(response)
+                at += n
+                i += 1
+                # Offsets count the bytes applied, whatever their content
+                self.feed_replication_stream(bytes(stream[applied:at]))
+                self.master_link_offset += at - applied
+                applied = at
+
+        return applied
+
+    def replication_set_master(self, host: str, port: int):
+        """
+        Makes this server a replica of host:port. The link is run by its own
+        thread, reconnecting until the master changes again.
+        """
+        self.close_master_link()
+        self.master_host = host
+        self.master_port = port
+        self._role = ServerRole.SLAVE
+        self.master_link_gen += 1
+
+        Thread(
+            target=handle_master_conn,
+            args=(host, port, self.master_link_gen),
+            daemon=True,
+        ).start()
+
+    def replication_unset_master(self):
+        """
+        Promotes this replica to master, keeping its dataset and backlog.
+        """
+        self.master_link_gen += 1
+        self.close_master_link()
+        self.master_host = None
+        self.master_port = 0
+        self._role = ServerRole.MASTER
+        self.master_link_status = "down"
+        self.shift_replication_id()
+        # The replicas learn the new ID when they continue with PSYNC
+        self.disconnect_replicas()
+
+    def disconnect_replicas(self):
+        """
+        Drops the replicas of this server when its history changes. They
+        reconnect with PSYNC, continuing from replid2 where possible.
+        """
+        with self.repl_lock:
+            for r in list(self._replicas):
+                self.free_replica(r)
+
+    def close_master_link(self):
+        sock = self.master_socket
+        self.master_socket = None
+        if sock is None:
+            return
+
+        try:
+            # Wakes up the link thread blocked in recv()
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def process_command(
+        self,
+        command: str,
+        args: list,
+        conn: Connection = None
+    ):
+        # in case command is not in upper-case letters
+        command = command.upper()
+
+        self.stat_numcommands += 1
+
+        spec = COMMAND_TABLE.get(command)
+        if spec is None:
+            if not conn:
+                return None
+
+            return RESPbuilder.error(command, args, typ=RESPerror.UNKNOWN_CMD)
+
+        if not spec.check_arity(len(args) + 1):
+            spec.rejected_calls += 1
+            if not conn:
+                return None
+
+            return RESPbuilder.error(command)
+
+        if (
+            self.config.maxmemory.value > 0
+            and conn is not None
+            and self._role == ServerRole.MASTER
+            and not self.perform_evictions()
+            and "denyoom" in spec.flags
+        ):
+            spec.rejected_calls += 1
+            return RESPbuilder.error(typ=RESPerror.OOM)
+
+        start = time.perf_counter_ns()
+        try:
+            response = spec.handler(self, args, conn)
+        except Exception:
+            spec.failed_calls += 1
+            raise
+        finally:
+            duration = (time.perf_counter_ns() - start) // 1000
+            spec.record(duration)
+
+        if isinstance(response, bytes) and response[:1] == b"-":
+            spec.failed_calls += 1
+        elif spec.propagate and conn is not None:
+            argv = conn.propagate_argv
+            conn.propagate_argv = None
+            if argv is None:
+                argv = [command, *args]
+
+            if argv:
+                self.dirty += 1
+                if not conn.isreplica:
+                    self.propagate(argv)
+                    conn.woff = self.master_repl_offset
+        elif spec.propagate and not self.loading:
+            # Applied from the master's replication stream
+            self.dirty += 1
+            if self.aof_fd != -1 or self.aof_rewrite_buf is not None:
+                self.feed_append_only_file(RESPbuilder.build([command, *args]))
+
+        threshold = self.config.slowlog_log_slower_than.value
+        if (
+            threshold >= 0
+            and duration >= threshold
+            and not self.may_block(command, args)
+        ):
+            self.slowlog.add(command, args, duration, conn)
+
+        return response
+
+    @command("COMMAND", arity=-1, flags=("loading", "stale"))
+    def command_command(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        if len(args) == 0:
+            return RESPbuilder.build([spec.build() for spec in COMMAND_TABLE.values()])
+
+        subcommand = args[0].upper()
+
+        if subcommand == "COUNT":
+            return RESPbuilder.build(len(COMMAND_TABLE))
+
+        elif subcommand == "INFO":
+            names = args[1:] if len(args) > 1 else list(COMMAND_TABLE.keys())
+            infos = []
+            for name in names:
+                spec = COMMAND_TABLE.get(name.upper())
+                infos.append(spec.build() if spec else None)
+            return RESPbuilder.build(infos)
+
+        elif subcommand == "DOCS":
+            return RESPbuilder.build([])
+
+        return RESPbuilder.error(
+            args=f"unknown subcommand '{args[0]}'. Try COMMAND HELP.",
+            typ=RESPerror.CUSTOM,
+        )
+
+    @command("PING", arity=-1, flags=("fast", "stale"))
+    def command_ping(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        argslen = len(args)
+        if argslen > 1:
+            return RESPbuilder.error("PING")
+
+        if argslen == 1:
+            response = RESPbuilder.build(args[0])
+        else:
+            response = RESPbuilder.build("PONG", bulkstr=False)
+
+        return response
+
+    @command("ECHO", arity=2, flags=("fast", "stale"))
+    def command_echo(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        return RESPbuilder.build(args[0])
+
+    @command("INFO", arity=-1, flags=("loading", "stale"))
+    def command_info(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        sections = [arg.lower() for arg in args] if args else ["default"]
+
+        names = []
+        for section in sections:
+            if section in ("all", "everything"):
+                names += self.INFO_SECTIONS
+            elif section == "default":
+                names += [s for s in self.INFO_SECTIONS if s != "commandstats"]
+            elif section in self.INFO_SECTIONS:
+                names.append(section)
+
+        payload = "\r\n".join(
+            getattr(self, f"info_{name}")() for name in dict.fromkeys(names)
+        )
+
+        return RESPbuilder.build(payload) if payload else RESPbuilder.build("\r\n")
+
+    INFO_SECTIONS = (
+        "server",
+        "clients",
+        "memory",
+        "persistence",
+        "stats",
+        "replication",
+        "commandstats",
+        "keyspace",
+    )
+
+    def info_server(self):
+        uptime = int(time.time() - self.start_time)
+        return (
+            f"# Server\r\n"
+            f"redis_version:7.2.0\r\n"
+            f"redis_mode:standalone\r\n"
+            f"os:{sys.platform}\r\n"
+            f"arch_bits:{struct.calcsize('P') * 8}\r\n"
+            f"multiplexing_api:{'selectors' if self.loop else 'threads'}\r\n"
+            f"python_version:{sys.version.split()[0]}\r\n"
+            f"process_id:{os.getpid()}\r\n"
+            f"run_id:{self.run_id}\r\n"
+            f"tcp_port:{self.port}\r\n"
+            f"uptime_in_seconds:{uptime}\r\n"
+            f"uptime_in_days:{uptime // 86400}\r\n"
+            f"hz:{self.config.hz.value}\r\n"
+        )
+
+    def info_clients(self):
+        return (
+            f"# Clients\r\n"
+            f"connected_clients:{len(connections) - len(self._replicas)}\r\n"
+            f"maxclients:{self.maxclients}\r\n"
+            f"blocked_clients:{len(self.blocked) + len(self.waiting_acks)}\r\n"
+        )
+
+    def info_memory(self):
+        used_memory = store.used_memory()
+        return (
+            f"# Memory\r\n"
+            f"used_memory:{used_memory}\r\n"
+            f"used_memory_human:{bytes_to_human(used_memory)}\r\n"
+            f"used_memory_rss:{rss_memory()}\r\n"
+            f"used_memory_peak:{max(self.stat_peak_memory, used_memory)}\r\n"
+            f"used_memory_dataset:{used_memory}\r\n"
+            f"maxmemory:{self.config.maxmemory.value}\r\n"
+            f"maxmemory_human:{bytes_to_human(self.config.maxmemory.value)}\r\n"
+            f"maxmemory_policy:{self.config.maxmemory_policy.value}\r\n"
+        )
+
+    def info_persistence(self):
+        in_progress = self.rdb_child_pid != -1
+        current = int(time.time() - self.rdb_save_time_start) if in_progress else -1
+        rewrite_time = (
+            int(time.time() - self.aof_rewrite_time_start)
+            if self.aof_child_pid != -1
+            else -1
+        )
+        return (
+            f"# Persistence\r\n"
+            f"loading:0\r\n"
+            f"rdb_changes_since_last_save:{self.dirty}\r\n"
+            f"rdb_bgsave_in_progress:{int(in_progress)}\r\n"
+            f"rdb_last_save_time:{int(self.lastsave)}\r\n"
+            f"rdb_last_bgsave_status:{'ok' if self.lastbgsave_status else 'err'}\r\n"
+            f"rdb_last_bgsave_time_sec:{self.rdb_save_time_last}\r\n"
+            f"rdb_current_bgsave_time_sec:{current}\r\n"
+            f"rdb_saves:{self.rdb_saves}\r\n"
+            f"aof_enabled:{int(self.aof_fd != -1)}\r\n"
+            f"aof_rewrite_in_progress:{int(self.aof_child_pid != -1)}\r\n"
+            f"aof_rewrite_scheduled:{int(self.aof_rewrite_scheduled)}\r\n"
+            f"aof_last_rewrite_time_sec:{self.aof_rewrite_time_last}\r\n"
+            f"aof_current_rewrite_time_sec:{rewrite_time}\r\n"
+            f"aof_last_bgrewrite_status:{'ok' if self.aof_lastbgrewrite_status else 'err'}\r\n"
+            f"aof_rewrites:{self.stat_aof_rewrites}\r\n"
+            f"aof_base_size:{self.aof_rewrite_base_size}\r\n"
+            f"aof_last_write_status:{'ok' if self.aof_last_write_status else 'err'}\r\n"
+            f"aof_current_size:{self.aof_current_size}\r\n"
+            f"aof_buffer_length:{len(self.aof_buf)}\r\n"
+            f"aof_pending_bio_fsync:{int(self.aof_fsync_in_progress)}\r\n"
+            f"aof_delayed_fsync:{self.stat_aof_delayed_fsync}\r\n"
+            f"aof_fsyncs:{self.stat_aof_fsyncs}\r\n"
+            f"aof_last_fsync_usec:{self.aof_last_fsync_usec}\r\n"
+            f"aof_avg_fsync_usec:{self.stat_aof_fsync_usec // max(1, self.stat_aof_fsyncs)}\r\n"
+        )
+
+    def info_stats(self):
+        return (
+            f"# Stats\r\n"
+            f"total_connections_received:{self.stat_numconnections}\r\n"
+            f"total_commands_processed:{self.stat_numcommands}\r\n"
+            f"instantaneous_ops_per_sec:{self.instantaneous_metric('commands')}\r\n"
+            f"total_net_input_bytes:{self.stat_net_input_bytes}\r\n"
+            f"total_net_output_bytes:{self.stat_net_output_bytes}\r\n"
+            f"instantaneous_input_kbps:"
+            f"{self.instantaneous_metric('net_input') / 1024:.2f}\r\n"
+            f"instantaneous_output_kbps:"
+            f"{self.instantaneous_metric('net_output') / 1024:.2f}\r\n"
+            f"rejected_connections:{self.stat_rejected_conn}\r\n"
+            f"expired_keys:{store.stat_expired_keys}\r\n"
+            f"expired_stale_perc:{store.stat_expired_stale_perc * 100:.2f}\r\n"
+            f"expired_time_cap_reached_count:"
+            f"{store.stat_expired_time_cap_reached_count}\r\n"
+            f"expire_cycle_cpu_milliseconds:"
+            f"{store.stat_expire_cycle_time_used // 1000}\r\n"
+            f"evicted_keys:{self.stat_evicted_keys}\r\n"
+            f"sync_full:{self.stat_sync_full}\r\n"
+            f"sync_partial_ok:{self.stat_sync_partial_ok}\r\n"
+            f"sync_partial_err:{self.stat_sync_partial_err}\r\n"
+            f"client_output_buffer_limit_disconnections:"
+            f"{self.stat_client_outbuf_limit_disconnections}\r\n"
+        )
+
+    def info_replication(self):
+        payload = f"# Replication\r\nrole:{self.role}\r\n"
+        if self._role == ServerRole.SLAVE:
+            last_io = -1
+            if self.master_link_status == "up":
+                last_io = int(time.time() - self.master_last_io)
+            payload += (
+                f"master_host:{self.master_host}\r\n"
+                f"master_port:{self.master_port}\r\n"
+                f"master_link_status:{self.master_link_status}\r\n"
+                f"master_last_io_seconds_ago:{last_io}\r\n"
+                f"master_sync_in_progress:{int(self.master_sync_in_progress)}\r\n"
+                f"slave_repl_offset:{self.master_link_offset}\r\n"
+            )
+
+        payload += f"connected_slaves:{len(self._replicas)}\r\n"
+        now = time.time()
+        for i, r in enumerate(list(self._replicas)):
+            state = r.repl_state.value
+            if state.startswith("wait_bgsave"):
+                state = "wait_bgsave"
+            # Seconds since the last REPLCONF ACK, replicas send one per second
+            lag = int(now - r.repl_ack_time)
+            payload += (
+                f"slave{i}:ip={r.addr[0]},port={r.repl_listening_port},"
+                f"state={state},offset={r.repl_ack_offset},lag={lag}\r\n"
+            )
+
+        backlog = self.repl_backlog
+        payload += (
+            f"master_replid:{self.master_replid}\r\n"
+            f"master_replid2:{self.replid2}\r\n"
+            f"master_repl_offset:{self.master_repl_offset}\r\n"
+            f"second_repl_offset:{self.second_replid_offset}\r\n"
+            f"repl_backlog_active:{int(backlog is not None)}\r\n"
+            f"repl_backlog_size:{self.config.repl_backlog_size.value}\r\n"
+            f"repl_backlog_first_byte_offset:"
+            f"{backlog.start_offset if backlog else 0}\r\n"
+            f"repl_backlog_histlen:{backlog.histlen if backlog else 0}\r\n"
+        )
+        return payload
+
+    def info_commandstats(self):
+        payload = "# Commandstats\r\n"
+        for spec in COMMAND_TABLE.values():
+            if spec.calls == 0 and spec.rejected_calls == 0:
+                continue
+            usec_per_call = spec.usec / spec.calls if spec.calls else 0
+            payload += (
+                f"cmdstat_{spec.name.lower()}:calls={spec.calls},"
+                f"usec={spec.usec},usec_per_call={usec_per_call:.2f},"
+                f"rejected_calls={spec.rejected_calls},"
+                f"failed_calls={spec.failed_calls}\r\n"
+            )
+        return payload
+
+    def info_keyspace(self):
+        payload = "# Keyspace\r\n"
+        nkeys = store.size()
+        if nkeys > 0:
+            payload += (
+                f"db0:keys={nkeys},expires={store.expires_size()},"
+                f"avg_ttl={store.stat_avg_ttl}\r\n"
+            )
+        return payload
+
+    @command("CONFIG", arity=-2, flags=("admin", "loading", "stale"))
+    def command_config(self, args: list, conn: Connection = None):
+        response = None
+        subcommand = args[0].upper()
+
+        if subcommand == "GET":
+            opts = args[1:]
+
+            payload = []
+
+            if len(opts) == 0:
+                payload = self.config.build()
+
+            else:
+                for o in opts:
+                    pattern = o.lower()
+                    for opt in self.config.options():
+                        if fnmatch.fnmatchcase(opt.name, pattern):
+                            payload += opt.build()
+
+            response = RESPbuilder.build(payload)
+
+        elif subcommand == "SET":
+            if len(args) < 3 or len(args) % 2 == 0:
+                return RESPbuilder.error("CONFIG SET")
+
+            # Values before this command, restored if any pair is rejected so
+            # that a multi-option CONFIG SET applies all or nothing
+            previous = []
+            for i in range(1, len(args), 2):
+                opt = self.config.lookup(args[i].lower())
+                if opt is None:
+                    response = RESPbuilder.error(
+                        args=f"Unknown option or number of arguments for "
+                        f"CONFIG SET - '{args[i]}'",
+                        typ=RESPerror.CUSTOM,
+                    )
+                    break
+
+                previous.append((opt, opt.value))
+                try:
+                    opt.set(args[i + 1])
+                except ValueError as e:
+                    response = RESPbuilder.error(
+                        args=f"CONFIG SET failed (possibly related to argument "
+                        f"'{args[i]}') - {e}",
+                        typ=RESPerror.CUSTOM,
+                    )
+                    break
+
+            if response is not None:
+                for opt, value in reversed(previous):
+                    opt.value = value
+                return response
+
+            self.slowlog.resize(self.config.slowlog_max_len.value)
+            store.set_policy(self.config.maxmemory_policy.value)
+
+            with self.repl_lock:
+                backlog = self.repl_backlog
+                size = self.config.repl_backlog_size.value
+                if backlog is not None and backlog.size != max(
+                    size, ReplicationBacklog.MIN_SIZE
+                ):
+                    backlog.resize(size)
+
+            if self.config.appendonly.value != (self.aof_fd != -1):
+                try:
+                    if self.config.appendonly.value:
+                        self.start_append_only()
+                    else:
+                        self.stop_append_only()
+                except OSError as e:
+                    self.config.appendonly.value = False
+                    return RESPbuilder.error(
+                        args=f"Can't turn on AOF: {e}", typ=RESPerror.CUSTOM
+                    )
+
+            response = RESPbuilder.build("OK", bulkstr=False)
+
+        elif subcommand == "RESETSTAT":
+            for spec in COMMAND_TABLE.values():
+                spec.reset_stats()
+
+            response = RESPbuilder.build("OK", bulkstr=False)
+
+        return response
+
+    @command("SLOWLOG", arity=-2, flags=("admin", "loading", "stale"))
+    def command_slowlog(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        subcommand = args[0].upper()
+
+        if subcommand == "GET":
+            count = 10
+            if len(args) > 1:
+                count = int(args[1])
+                if count < -1:
+                    raise ValueError("count should be greater than or equal to -1")
+
+            return RESPbuilder.build(self.slowlog.build(count))
+
+        elif subcommand == "LEN" and len(args) == 1:
+            return RESPbuilder.build(len(self.slowlog))
+
+        elif subcommand == "RESET" and len(args) == 1:
+            self.slowlog.reset()
+            return RESPbuilder.build("OK", bulkstr=False)
+
+        return RESPbuilder.error(
+            args=f"unknown subcommand or wrong number of arguments for "
+            f"'{args[0]}'. Try SLOWLOG HELP.",
+            typ=RESPerror.CUSTOM,
+        )
+
+    @command("LATENCY", arity=-2, flags=("admin", "loading", "stale"))
+    def command_latency(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        subcommand = args[0].upper()
+
+        if subcommand == "HISTOGRAM":
+            if len(args) > 1:
+                specs = [COMMAND_TABLE.get(name.upper()) for name in args[1:]]
+            else:
+                specs = COMMAND_TABLE.values()
+
+            payload = []
+            for spec in specs:
+                if spec is None or spec.calls == 0:
+                    continue
+                payload += [
+                    spec.name.lower(),
+                    ["calls", spec.calls, "histogram_usec", spec.histogram.build()],
+                ]
+
+            return RESPbuilder.build(payload)
+
+        return RESPbuilder.error(
+            args=f"unknown subcommand or wrong number of arguments for "
+            f"'{args[0]}'. Try LATENCY HELP.",
+            typ=RESPerror.CUSTOM,
+        )
+
+    @command("MEMORY", arity=-2, flags=("readonly",))
+    def command_memory(self, args: list, conn: Connection = None):
+        """
+        Implements MEMORY USAGE and MEMORY STATS. Value sizes are tracked
+        exactly as they change, so MEMORY USAGE never samples and the count
+        given with SAMPLES has no effect beyond being validated.
+        """
+        if not conn:
+            return None
+
+        subcommand = args[0].upper()
+
+        if subcommand == "USAGE" and len(args) in (2, 4):
+            if len(args) == 4:
+                if args[2].upper() != "SAMPLES" or not args[3].isdigit():
+                    return RESPbuilder.error(typ=RESPerror.SYNTAX)
+
+            return RESPbuilder.build(store.memory_usage(args[1]))
+
+        elif subcommand == "STATS" and len(args) == 1:
+            used_memory = store.used_memory()
+            nkeys = store.size()
+            nexpires = store.expires_size()
+            overhead_main = nkeys * STORE_ENTRY_OVERHEAD
+            overhead_expires = nexpires * EXPIRE_ENTRY_OVERHEAD
+            dataset = used_memory - overhead_main - overhead_expires
+
+            payload = [
+                "peak.allocated",
+                max(self.stat_peak_memory, used_memory),
+                "total.allocated",
+                used_memory,
+                "rss",
+                rss_memory(),
+                "overhead.hashtable.main",
+                overhead_main,
+                "overhead.hashtable.expires",
+                overhead_expires,
+                "keys.count",
+                nkeys,
+                "keys.bytes-per-key",
+                used_memory // nkeys if nkeys else 0,
+                "dataset.bytes",
+                dataset,
+                "dataset.percentage",
+                f"{dataset * 100 / used_memory if used_memory else 0:.2f}",
+            ]
+            for typ, (count, nbytes) in store.type_stats().items():
+                payload += [
+                    f"type.{typ}",
+                    [
+                        "keys.count",
+                        count,
+                        "bytes",
+                        nbytes,
+                        "bytes-per-key",
+                        nbytes // count if count else 0,
+                    ],
+                ]
+
+            return RESPbuilder.build(payload)
+
+        return RESPbuilder.error(
+            args=f"unknown subcommand or wrong number of arguments for "
+            f"'{args[0]}'. Try MEMORY HELP.",
+            typ=RESPerror.CUSTOM,
+        )
+
+    @command("REPLCONF", arity=-1, flags=("admin", "loading", "stale"))
+    def command_replconf(self, args: list, conn: Connection = None):
+        subcommand = ""
+        if len(args) >= 1:
+            subcommand = args[0].upper()
+
+        if subcommand == "GETACK" and args[1] == "*":
+            response = RESPbuilder.build(
+                ["REPLCONF", "ACK", str(self.master_link_offset)]
+            )
+
+        elif subcommand == "ACK" and args[1].isdigit():
+            if conn is None:
+                return b""
+
+            conn.repl_ack_offset = max(conn.repl_ack_offset, int(args[1]))
+            conn.repl_ack_time = time.time()
+            self.waiting_acks.signal_key_ready(WAIT_ACKS)
+
+            # Replicas don't expect a reply to ACK
+            return b""
+
+        elif (
+            subcommand == "LISTENING-PORT"
+            and conn is not None
+            and args[1].isdigit()
+        ):
+            conn.repl_listening_port = int(args[1])
+            response = RESPbuilder.build("OK", bulkstr=False)
+
+        elif subcommand == "CAPA" and conn is not None:
+            conn.repl_capa.update(capa.lower() for capa in args[1::2])
+            response = RESPbuilder.build("OK", bulkstr=False)
+
+        else:
+            # Hardcode +OK\r\n
+            response = RESPbuilder.build("OK", bulkstr=False)
+
+        return response
+
+    @command("PSYNC", arity=-3, flags=("admin", "noscript"))
+    def command_psync(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        replid = args[0]
+        try:
+            psync_offset = int(args[1])
+        except ValueError:
+            return RESPbuilder.error(typ=RESPerror.SYNTAX)
+
+        if self._role == ServerRole.SLAVE and self.master_link_status != "up":
+            # A replica only serves the history it is receiving
+            return RESPbuilder.error(typ=RESPerror.NOMASTERLINK)
+
+        # The handshake replies go out before the stream
+        conn.flush()
+
+        # No write may reach the replicas between the backlog or snapshot
+        # sent here and the replica joining them
+        with self.repl_lock:
+            if self.try_partial_resync(conn, replid, psync_offset):
+                self.stat_sync_partial_ok += 1
+            else:
+                if replid != "?":
+                    self.stat_sync_partial_err += 1
+                    print(
+                        f"Partial resynchronization not accepted for "
+                        f"{conn.addr}, replid {replid} offset {psync_offset}"
+                    )
+                self.stat_sync_full += 1
+                self.full_resync(conn)
+
+        return b""
+
+    @command("REPLICAOF", arity=3, flags=("admin", "noscript", "stale"))
+    @command("SLAVEOF", arity=3, flags=("admin", "noscript", "stale"))
+    def command_replicaof(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        host, port = args
+        if host.lower() == "no" and port.lower() == "one":
+            if self._role == ServerRole.SLAVE:
+                self.replication_unset_master()
+                print("MASTER MODE enabled")
+            return RESPbuilder.build("OK", bulkstr=False)
+
+        try:
+            port = int(port)
+        except ValueError:
+            return RESPbuilder.error(
+                args="Invalid master port", typ=RESPerror.CUSTOM
+            )
+
+        if (
+            self._role == ServerRole.SLAVE
+            and self.master_host == host
+            and self.master_port == port
+        ):
+            return RESPbuilder.build(
+                "OK Already connected to specified master", bulkstr=False
+            )
+
+        # The new master may continue from this server's own history
+        self.cached_master = True
+        self.replication_set_master(host, port)
+        print(f"REPLICAOF {host}:{port} enabled")
+        return RESPbuilder.build("OK", bulkstr=False)
+
+    @command("WAIT", arity=3, flags=("blocking",))
+    def command_wait(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        if self._role == ServerRole.SLAVE:
+            # Writes on a replica are not propagated, and the GETACK below
+            # would shift the stream relayed to its sub-replicas
+            return RESPbuilder.error(
+                args="WAIT cannot be used with replica instances",
+                typ=RESPerror.CUSTOM,
+            )
+
+        numreplicas = int(args[0])
+        timeout = int(args[1])
+
+        # Wait for the writes of this client only
+        target = conn.woff
+
+        def serve():
+            acked = self.replicas_acked(target)
+            return RESPbuilder.build(acked) if acked >= numreplicas else None
+
+        response = serve()
+        if response is not None:
+            return response
+
+        if self._getack_offset < target:
+            # Ask the lagging replicas for an ack. GETACK goes through the
+            # replication stream so that the replica offsets keep matching
+            # master_repl_offset, one is enough for every WAIT up to here.
+            self._getack_offset = self.master_repl_offset
+            self.feed_replication_stream(
+                RESPbuilder.build(["REPLCONF", "GETACK", "*"])
+            )
+
+        return self.block_client(
+            conn,
+            [WAIT_ACKS],
+            serve,
+            lambda: RESPbuilder.build(self.replicas_acked(target)),
+            timeout,
+            registry=self.waiting_acks,
+        )
+
+    @command("KEYS", arity=2, flags=("readonly",))
+    def command_keys(self, args: list, conn: Connection = None):
+        response = None
+
+        if args[0] == "*":
+            keys = list(store.keys())
+            response = RESPbuilder.build(keys)
+
+        return response
+
+    @command("TYPE", arity=2, flags=("readonly", "fast"), first_key=1, last_key=1, step=1)
+    def command_type(self, args: list, conn: Connection = None):
+        value_type = store.type(args[0])
+
+        return RESPbuilder.build(value_type, bulkstr=False)
+
+    @command("XADD", arity=-5, flags=("write", "denyoom", "fast"), first_key=1, last_key=1, step=1)
+    def command_xadd(self, args: list, conn: Connection = None):
+        key = args[0]
+        entry_id = args[1]
+
+        fields = args[2:]
+        if len(fields) % 2 != 0:
+            return RESPbuilder.error("XADD")
+
+        stored_id = store.append(key, entry_id, fields)
+        self.blocked.signal_key_ready(key)
+
+        if not conn:
+            return None
+
+        if not stored_id:
+            return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
+
+        # Replicas must store the same ID, not generate their own
+        conn.propagate_argv = ["XADD", key, stored_id, *fields]
+
+        return RESPbuilder.build(stored_id)
+
+    @staticmethod
+    def parse_range_id(id: str, end: bool):
+        """
+        Parses an XRANGE boundary, "-" and "+" being the smallest and the
+        greatest IDs. A missing sequence number defaults to 0 for the start
+        and to the greatest sequence number for the end of the range. A
+        leading "(" makes the boundary exclusive.
+        """
+        if id == "-":
+            return 0, 0, False
+        if id == "+":
+            return Stream.MAX_SEQ, Stream.MAX_SEQ, False
+
+        exclusive = id.startswith("(")
+        if exclusive:
+            id = id[1:]
+
+        ms, seq = Stream.parse_id(id)
+        if ms == -1 or id.endswith("*"):
+            raise StreamError("Invalid stream ID specified as stream command argument")
+        if seq == -1:
+            seq = Stream.MAX_SEQ if end else 0
+
+        return ms, seq, exclusive
+
+    def stream_range(self, args: list, rev: bool):
+        key = args[0]
+        start, end = (args[2], args[1]) if rev else (args[1], args[2])
+        start_ms, start_seq, start_excl = self.parse_range_id(start, end=False)
+        end_ms, end_seq, end_excl = self.parse_range_id(end, end=True)
+
+        count = -1
+        if len(args) > 3:
+            if len(args) != 5 or args[3].upper() != "COUNT":
+                return RESPbuilder.error(typ=RESPerror.SYNTAX)
+            count = int(args[4])
+
+        stream = store.get(key)
+        if not stream:
+            return RESPbuilder.null()
+        if not isinstance(stream, Stream):
+            return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
+
+        if start_excl:
+            start_idx = stream.upper_bound(start_ms, start_seq)
+        else:
+            start_idx = stream.lower_bound(start_ms, start_seq)
+        if end_excl:
+            end_idx = stream.lower_bound(end_ms, end_seq)
+        else:
+            end_idx = stream.upper_bound(end_ms, end_seq)
+
+        indices = range(start_idx, max(start_idx, end_idx))
+        if rev:
+            indices = indices[::-1]
+        if count >= 0:
+            indices = indices[:count]
+
+        # Entries are serialized as the reply is written out
+        return LazyReply([f"*{len(indices)}\r\n".encode(), (stream, indices)])
+
+    @command("XRANGE", arity=-4, flags=("readonly",), first_key=1, last_key=1, step=1)
+    def command_xrange(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        return self.stream_range(args, rev=False)
+
+    @command("XREVRANGE", arity=-4, flags=("readonly",), first_key=1, last_key=1, step=1)
+    def command_xrevrange(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        return self.stream_range(args, rev=True)
+
+    def read_streams(self, key_id_list: list, count: int = -1):
+        """
+        Returns the reply parts for the entries added after the given ID of
+        each stream, for the streams that have any.
+        """
+        parts = []
+        nstreams = 0
+        for key, (ms, seq) in key_id_list:
+            stream = store.get(key)
+            if not stream:
+                continue
+            if not isinstance(stream, Stream):
+                raise TypeError(key)
+
+            idx = stream.upper_bound(ms, seq)
+            if idx < len(stream):
+                indices = range(idx, len(stream))
+                if count >= 0:
+                    indices = indices[:count]
+
+                nstreams += 1
+                parts += [
+                    b"*2\r\n",
+                    RESPbuilder.build(key),
+                    f"*{len(indices)}\r\n".encode(),
+                    (stream, indices),
+                ]
+
+        if nstreams == 0:
+            return []
+
+        return [f"*{nstreams}\r\n".encode()] + parts
+
+    @command("XREAD", arity=-4, flags=("readonly", "blocking", "movablekeys"))
+    def command_xread(self, args: list, conn: Connection = None):
+        uargs = [arg.upper() for arg in args]
+
+        block = False
+        block_time = 0
+        if "BLOCK" in uargs:
+            block = True
+            block_time = int(args[uargs.index("BLOCK") + 1])
+
+        count = -1
+        if "COUNT" in uargs[: uargs.index("STREAMS") if "STREAMS" in uargs else None]:
+            count = int(args[uargs.index("COUNT") + 1])
+
+        start_idx = 0
+        if "STREAMS" in uargs:
+            start_idx = uargs.index("STREAMS") + 1
+
+        else:
+            if not conn:
+                return None
+
+            return RESPbuilder.error(typ=RESPerror.SYNTAX)
+
+        key_id_len = len(args[start_idx:])
+        if key_id_len % 2 != 0:
+            return RESPbuilder.error(
+                args="Unbalanced XREAD list of streams: for each stream "
+                "key an ID or '$' must be specified",
+                typ=RESPerror.CUSTOM,
+            )
+        if key_id_len == 0:
+            return RESPbuilder.error("XREAD")
+
+        key_id_len = key_id_len // 2
+
+        key_id_list = []
+        for i in range(start_idx, start_idx + key_id_len):
+            key = args[i]
+            id = args[i + key_id_len]
+
+            stream = store.get(key)
+            if stream and not isinstance(stream, Stream):
+                return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
+
+            if id == "$":
+                # Only entries added from now on
+                ms, seq = stream.last_id if stream else (0, 0)
+            else:
+                ms, seq = Stream.parse_id(id)
+                if ms == -1 or id.endswith("*"):
+                    return RESPbuilder.error(
+                        args="Invalid stream ID specified as stream command "
+                        "argument",
+                        typ=RESPerror.CUSTOM,
+                    )
+                if seq == -1:
+                    seq = 0
+
+            key_id_list.append((key, (ms, seq)))
+
+        def serve():
+            try:
+                streams = self.read_streams(key_id_list, count)
+            except TypeError:
+                return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
+
+            return LazyReply(streams) if len(streams) > 0 else None
+
+        response = serve()
+        if response is not None:
+            return response
+
+        if not block:
+            return RESPbuilder.null()
+
+        keys = [key for key, _ in key_id_list]
+        return self.block_client(conn, keys, serve, RESPbuilder.null, block_time)
+
+    @command("SET", arity=-3, flags=("write", "denyoom"), first_key=1, last_key=1, step=1)
+    def command_set(self, args: list, conn: Connection = None):
+        expiry = -1
+        if len(args) > 2:
+            expopt = args[2].upper()
+            if expopt in ("EX", "PX", "EXAT", "PXAT") and len(args) == 4:
+                try:
+                    expiry = int(args[3])
+                except ValueError:
+                    return RESPbuilder.error(
+                        args="value is not an integer or out of range",
+                        typ=RESPerror.CUSTOM,
+                    )
+
+                if expiry > 0:
+                    expiry = expire_time(
+                        expiry,
+                        1000 if expopt in ("EX", "EXAT") else 1,
+                        absolute=expopt in ("EXAT", "PXAT"),
+                    )
+                if expiry is None or expiry <= 0:
+                    return RESPbuilder.error(
+                        args="invalid expire time in 'set' command",
+                        typ=RESPerror.CUSTOM,
+                    )
+            else:
+                if not conn:
+                    return None
+
+                return RESPbuilder.error(typ=RESPerror.SYNTAX)
+
+        store.set(args[0], args[1], expiry)
+
+        if not conn:
+            return None
+
+        if expiry >= 0:
+            # Replicas expire the key at the same time, whenever they get it
+            conn.propagate_argv = ["SET", args[0], args[1], "PXAT", str(expiry)]
+
+        return RESPbuilder.build("OK", bulkstr=False)
+
+    @command("GET", arity=-2, flags=("readonly", "fast"), first_key=1, last_key=-1, step=1)
+    def command_get(self, args: list, conn: Connection = None):
+        if not conn:
+            return None
+
+        nargs = len(args)
+        if nargs == 1:
+            values = store.get(args[0])
+            if values is not None and not isinstance(values, str):
+                return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
+
+        else:
+            values = store.get_many(args)
+            if any(
+                value is not None and not isinstance(value, str) for value in values
+            ):
+                return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
+
+        return RESPbuilder.build(values)
+
+    @command("DEL", arity=-2, flags=("write",), first_key=1, last_key=-1, step=1)
+    def command_del(self, args: list, conn: Connection = None):
+        keys_deleted = store.delete(*args)
+
+        if not conn:
+            return None
+
+        if keys_deleted == 0:
+            conn.propagate_argv = []
+
+        return RESPbuilder.build(keys_deleted)
+
+    def expire_generic(
+        self, name: str, args: list, conn: Connection, unit: int, absolute: bool
+    ):
+        """
+        Implements EXPIRE, PEXPIRE, EXPIREAT and PEXPIREAT. unit is the
+        number of milliseconds in the time unit of the command.
+        """
+        key = args[0]
+        try:
+            when = int(args[1])
+        except ValueError:
+            return RESPbuilder.error(
+                args="value is not an integer or out of range",
+                typ=RESPerror.CUSTOM,
+            )
+
+        when = expire_time(when, unit, absolute)
+        if when is None:
+            return RESPbuilder.error(
+                args=f"invalid expire time in '{name}' command",
+                typ=RESPerror.CUSTOM,
+            )
+
+        cond = None
+        for opt in args[2:]:
+            opt = opt.upper()
+            if opt not in ("NX", "XX", "GT", "LT"):
+                return RESPbuilder.error(
+                    args=f"Unsupported option {opt}", typ=RESPerror.CUSTOM
+                )
+            if cond is not None and cond != opt:
+                if "NX" in (cond, opt):
+                    message = "NX and XX, GT or LT options at the same time are not compatible"
+                else:
+                    message = "GT and LT options at the same time are not compatible"
+                return RESPbuilder.error(args=message, typ=RESPerror.CUSTOM)
+            cond = opt
+
+        updated = store.expire(key, when, cond)
+
+        if not conn:
+            return None
+
+        if not updated:
+            conn.propagate_argv = []
+        elif when <= millis():
+            conn.propagate_argv = ["DEL", key]
+        else:
+            # Absolute time so that replicas expire the key at the same time
+            conn.propagate_argv = ["PEXPIREAT", key, str(when)]
+
+        return RESPbuilder.build(updated)
+
+    @command("EXPIRE", arity=-3, flags=("write", "fast"), first_key=1, last_key=1, step=1)
+    def command_expire(self, args: list, conn: Connection = None):
+        return self.expire_generic("expire", args, conn, 1000, absolute=False)
+
+    @command("PEXPIRE", arity=-3, flags=("write", "fast"), first_key=1, last_key=1, step=1)
+    def command_pexpire(self, args: list, conn: Connection = None):
+        return self.expire_generic("pexpire", args, conn, 1, absolute=False)
+
+    @command("EXPIREAT", arity=-3, flags=("write", "fast"), first_key=1, last_key=1, step=1)
+    def command_expireat(self, args: list, conn: Connection = None):
+        return self.expire_generic("expireat", args, conn, 1000, absolute=True)
+
+    @command("PEXPIREAT", arity=-3, flags=("write", "fast"), first_key=1, last_key=1, step=1)
+    def command_pexpireat(self, args: list, conn: Connection = None):
+        return self.expire_generic("pexpireat", args, conn, 1, absolute=True)
+
+    def ttl_generic(self, args: list, conn: Connection, unit: int, absolute: bool):
+        """
+        Implements TTL, PTTL, EXPIRETIME and PEXPIRETIME.
+        """
+        if not conn:
+            return None
+
+        expiry = store.expiry(args[0])
+        if expiry < 0:
+            return RESPbuilder.build(expiry)
+
+        if absolute:
+            return RESPbuilder.build(expiry // unit)
 
-    @role.setter
-    def role(self, role_: ServerRole):
-        self._role = role_
+        # Round the time left to the closest unit, like Redis
+        ttl = max(0, expiry - millis())
+        return RESPbuilder.build((ttl + unit // 2) // unit)
 
-    def add_replica(self, conn: Connection):
-        self._replicas.append(conn)
+    @command("TTL", arity=2, flags=("readonly", "fast"), first_key=1, last_key=1, step=1)
+    def command_ttl(self, args: list, conn: Connection = None):
+        return self.ttl_generic(args, conn, 1000, absolute=False)
 
-    def relay(self, msg: bytes):
-        for r in self._replicas:
-            r.relay(msg)
+    @command("PTTL", arity=2, flags=("readonly", "fast"), first_key=1, last_key=1, step=1)
+    def command_pttl(self, args: list, conn: Connection = None):
+        return self.ttl_generic(args, conn, 1, absolute=False)
 
-    def process_command(
-        self,
-        command: str,
-        args: list,
-        conn: Connection = None
-    ):
-        global store
-        global repl_offset
+    @command("EXPIRETIME", arity=2, flags=("readonly", "fast"), first_key=1, last_key=1, step=1)
+    def command_expiretime(self, args: list, conn: Connection = None):
+        return self.ttl_generic(args, conn, 1000, absolute=True)
 
-        response = None
+    @command("PEXPIRETIME", arity=2, flags=("readonly", "fast"), first_key=1, last_key=1, step=1)
+    def command_pexpiretime(self, args: list, conn: Connection = None):
+        return self.ttl_generic(args, conn, 1, absolute=True)
 
-        # in case command is not in upper-case letters
-        command = command.upper()
+    @command("PERSIST", arity=2, flags=("write", "fast"), first_key=1, last_key=1, step=1)
+    def command_persist(self, args: list, conn: Connection = None):
+        removed = store.persist(args[0])
 
-        # in case there are quote enclosed arguments
-        new_args = []
-        for arg in args:
-            for s in arg.split():
-                new_args.append(s)
-        args = new_args
+        if not conn:
+            return None
 
-        print(f"Received command {command}, args {args}")
+        if not removed:
+            conn.propagate_argv = []
 
-        if command == "COMMAND":
-            if not conn:
-                return None
+        return RESPbuilder.build(removed)
 
-            response = RESPbuilder.build(["ping", "echo"])
+    @command("SAVE", arity=1, flags=("admin", "noscript"))
+    def command_save(self, args: list, conn: Connection = None):
+        if self.rdb_child_pid != -1:
+            return RESPbuilder.error(
+                args="Background save already in progress", typ=RESPerror.CUSTOM
+            )
 
-        elif command == "PING":
-            if not conn:
-                return None
+        try:
+            self.save()
+        except OSError as e:
+            sys.stderr.write(f"Error saving DB on disk: {e}\n")
+            return RESPbuilder.error(typ=RESPerror.CUSTOM, args=str(e))
+
+        return RESPbuilder.build("OK", bulkstr=False)
+
+    @command("BGSAVE", arity=-1, flags=("admin", "noscript"))
+    def command_bgsave(self, args: list, conn: Connection = None):
+        if self.rdb_child_pid != -1:
+            return RESPbuilder.error(
+                args="Background save already in progress", typ=RESPerror.CUSTOM
+            )
+        if self.aof_child_pid != -1:
+            return RESPbuilder.error(
+                args="Another child process is active (AOF?): can't BGSAVE right now.",
+                typ=RESPerror.CUSTOM,
+            )
+
+        try:
+            self.bgsave()
+        except OSError as e:
+            return RESPbuilder.error(
+                args=f"Can't BGSAVE: fork failed: {e}", typ=RESPerror.CUSTOM
+            )
 
-            argslen = len(args)
-            if argslen > 1:
-                return RESPerror.error(command)
+        return RESPbuilder.build("Background saving started", bulkstr=False)
 
-            if argslen == 1:
-                response = RESPbuilder.build(args[0])
+    @command("LASTSAVE", arity=1, flags=("fast", "loading", "stale"))
+    def command_lastsave(self, args: list, conn: Connection = None):
+        return RESPbuilder.build(int(self.lastsave))
+
+    @command("SHUTDOWN", arity=-1, flags=("admin", "noscript", "loading", "stale"))
+    def command_shutdown(self, args: list, conn: Connection = None):
+        save = None
+        for arg in args:
+            if arg.upper() == "NOSAVE":
+                save = False
+            elif arg.upper() == "SAVE":
+                save = True
             else:
-                response = RESPbuilder.build("PONG", bulkstr=False)
+                return RESPbuilder.error(typ=RESPerror.SYNTAX)
 
-        elif command == "ECHO":
-            if not conn:
-                return None
+        self.shutdown(save)
+        return RESPbuilder.error(
+            args="Errors trying to SHUTDOWN. Check logs.", typ=RESPerror.CUSTOM
+        )
 
-            argslen = len(args)
-            if argslen == 0 or argslen > 1:
-                return RESPbuilder.error(command)
+    def rdb_path(self):
+        return os.path.join(self.config.dirpath.value, self.config.dbfilename.value)
 
-            response = RESPbuilder.build(args[0])
+    def rdb_save(self):
+        """
+        Writes the dataset to a temporary file that is renamed over the RDB
+        file once complete, so a crash mid-save never leaves a truncated
+        snapshot behind. The caller holds all the shard locks.
+        """
+        tmppath = os.path.join(self.config.dirpath.value, f"temp-{os.getpid()}.rdb")
+        try:
+            with open(tmppath, "wb") as f:
+                RDBwriter(f, self.config.rdbchecksum.value).save(store)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmppath, self.rdb_path())
+        except OSError:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
 
-        elif command == "INFO":
-            if not conn:
-                return None
+    def save(self):
+        """
+        Synchronous snapshot, writes are blocked until it completes.
+        """
+        store.lock_all()
+        try:
+            self.rdb_save()
+        finally:
+            store.unlock_all()
 
-            subcommand = ""
-            if len(args) >= 1:
-                subcommand = args[0].upper()
+        self.dirty = 0
+        self.lastsave = time.time()
+        self.rdb_saves += 1
+        print("DB saved on disk")
 
-            if subcommand == "REPLICATION":
-                payload = (
-                    f"# Replication\r\n"
-                    f"role:{server.role}\r\n"
-                    f"master_replid:{server.master_replid}\r\n"
-                    f"master_repl_offset:{server.master_repl_offset}\r\n"
-                )
-                response = RESPbuilder.build(payload)
+    def fork_child(self, job, on_fork=None):
+        """
+        Forks a child that runs job() on its copy-on-write view of the
+        keyspace while the parent keeps serving clients, and exits with
+        status 0 unless job() raises. The shard locks are held across
+        fork() so the child never sees a shard in the middle of an update;
+        on_fork() runs in the parent before they are released.
+        """
+        store.lock_all()
+        try:
+            pid = os.fork()
+        except OSError:
+            store.unlock_all()
+            raise
+
+        if pid == 0:
+            # Child: only this thread survives, and it owns the shard locks
+            status = 0
+            try:
+                job()
+            except Exception as e:
+                sys.stderr.write(f"Write error in child process: {e}\n")
+                status = 1
+            os._exit(status)
 
-            else:
-                response = RESPbuilder.error(
-                    args="not implemented", typ=RESPerror.CUSTOM
-                )
+        try:
+            if on_fork is not None:
+                on_fork()
+        finally:
+            store.unlock_all()
+        return pid
+
+    @staticmethod
+    def reap_child(pid: int):
+        """
+        Returns None while the child runs, then whether it succeeded.
+        """
+        try:
+            done, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            return False
 
-        elif command == "CONFIG":
-            subcommand = ""
-            if len(args) >= 1:
-                subcommand = args[0].upper()
+        if done == 0:
+            return None
+        return os.waitstatus_to_exitcode(status) == 0
 
-            if subcommand == "GET":
-                opts = args[1:]
+    def kill_child(self, pid: int, tmpname: str):
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
 
-                payload = []
+        try:
+            os.unlink(os.path.join(self.config.dirpath.value, tmpname))
+        except OSError:
+            pass
 
-                if len(opts) == 0:
-                    payload = self.config.build()
+    def has_active_child(self):
+        return self.rdb_child_pid != -1 or self.aof_child_pid != -1
 
-                else:
-                    for o in opts:
-                        opt = o.lower()
-                        if opt == "dir":
-                            payload += self.config.dirpath.build()
+    def bgsave(self):
+        """
+        Writes the snapshot from a forked child, see fork_child().
+        """
+        self.lastbgsave_try = time.time()
 
-                        elif opt == "dbfilename":
-                            payload += self.config.dbfilename.build()
+        try:
+            pid = self.fork_child(self.rdb_save)
+        except OSError:
+            self.lastbgsave_status = False
+            raise
+
+        self.rdb_child_pid = pid
+        self.rdb_child_type = "disk"
+        self.rdb_save_time_start = time.time()
+        self._dirty_before_bgsave = self.dirty
+        print(f"Background saving started by pid {pid}")
+
+    def check_child_done(self):
+        """
+        Reaps the BGSAVE child if it has exited.
+        """
+        ok = self.reap_child(self.rdb_child_pid)
+        if ok is None:
+            return
 
-                response = RESPbuilder.build(payload)
+        child_type = self.rdb_child_type
+        if child_type == "socket":
+            # The transfer itself is done by send_rdb_pipe_to_replicas()
+            if ok:
+                print("Background RDB transfer terminated with success")
+            else:
+                sys.stderr.write("Background transfer error\n")
+        elif ok:
+            self.dirty -= self._dirty_before_bgsave
+            self.lastsave = time.time()
+            self.rdb_saves += 1
+            print("Background saving terminated with success")
+        else:
+            sys.stderr.write("Background saving error\n")
 
-        elif command == "REPLCONF":
-            subcommand = ""
-            if len(args) >= 1:
-                subcommand = args[0].upper()
+        if child_type == "disk":
+            self.lastbgsave_status = ok
+        self.rdb_save_time_last = int(time.time() - self.rdb_save_time_start)
+        self.rdb_child_pid = -1
+        self.rdb_child_type = None
 
-            if subcommand == "GETACK" and args[1] == "*":
-                response = RESPbuilder.build(["REPLCONF", "ACK", str(repl_offset)])
+        if child_type == "disk":
+            self.update_replicas_waiting_bgsave(ok)
 
-            elif subcommand == "ACK" and args[1].isdigit():
-                if len(self._replicas) == 0:
-                    return RESPbuilder.error(
-                        args="No replicas connected", typ=RESPerror.CUSTOM
-                    )
+    def kill_rdb_child(self):
+        pid = self.rdb_child_pid
+        self.rdb_child_pid = -1
+        self.rdb_child_type = None
+        self.kill_child(pid, f"temp-{pid}.rdb")
 
-                recvd_offset = int(args[1])
-                if recvd_offset >= self.master_repl_offset:
-                    self.ackcount += 1
+    # Seconds before retrying an automatic BGSAVE that failed
+    BGSAVE_RETRY_DELAY = 5
 
-                return b""
+    def check_save_params(self):
+        """
+        Starts a BGSAVE when one of the "save <seconds> <changes>" rules is
+        met.
+        """
+        now = time.time()
+        for seconds, changes in self.config.save_params():
+            if (
+                self.dirty >= changes
+                and now - self.lastsave > seconds
+                and (
+                    self.lastbgsave_status
+                    or now - self.lastbgsave_try > Server.BGSAVE_RETRY_DELAY
+                )
+            ):
+                print(f"{changes} changes in {seconds} seconds. Saving...")
+                try:
+                    self.bgsave()
+                except OSError as e:
+                    sys.stderr.write(f"Can't save in background: fork: {e}\n")
+                break
 
-            else:
-                # Hardcode +OK\r\n
-                response = RESPbuilder.build("OK", bulkstr=False)
+    def shutdown(self, save: bool = None):
+        """
+        Saves the dataset, if asked to or when save rules are configured,
+        and exits. Returns False if the final save failed.
+        """
+        print("User requested shutdown...")
+        if self.rdb_child_pid != -1:
+            print("There is a child saving an .rdb. Killing it!")
+            self.kill_rdb_child()
+        if self.aof_child_pid != -1:
+            print("There is a child rewriting the AOF. Killing it!")
+            pid = self.aof_child_pid
+            self.aof_child_pid = -1
+            self.kill_child(pid, os.path.basename(self.aof_rewrite_tmppath(pid)))
+
+        if self.aof_fd != -1:
+            print("Calling fsync() on the AOF file.")
+            self.flush_append_only_file(force=True)
+            os.fsync(self.aof_fd)
+
+        if save is None:
+            save = bool(self.config.save_params())
+
+        if save:
+            print("Saving the final RDB snapshot before exiting.")
+            try:
+                self.save()
+            except OSError as e:
+                sys.stderr.write(f"Error trying to save the DB, can't exit: {e}\n")
+                return False
 
-        elif command == "PSYNC":
-            if not conn:
-                return None
+        print("Redis is now ready to exit, bye bye...")
+        sys.stdout.flush()
+        os._exit(0)
 
-            argslen = len(args)
-            if argslen == 1:
-                return RESPbuilder.error(command)
-            if argslen == 2 and args[0] != "?" and args[1] != "-1":
-                return RESPbuilder.error(typ=RESPerror.SYNTAX)
+    @command("BGREWRITEAOF", arity=1, flags=("admin", "noscript"))
+    def command_bgrewriteaof(self, args: list, conn: Connection = None):
+        if self.aof_child_pid != -1:
+            return RESPbuilder.error(
+                args="Background append only file rewriting already in progress",
+                typ=RESPerror.CUSTOM,
+            )
 
-            # set connection as replica
-            conn.set_replica()
+        if self.rdb_child_pid != -1:
+            # Starts from the cron once the BGSAVE is done
+            self.aof_rewrite_scheduled = True
+            return RESPbuilder.build(
+                "Background append only file rewriting scheduled", bulkstr=False
+            )
 
-            # Hardcode response +FULLRESYNC <REPL_ID> 0\r\n and RDB file contents
-            response = RESPbuilder.build(
-                f"FULLRESYNC {server.master_replid} {server.master_repl_offset}",
-                bulkstr=False,
-            ) + RESPbuilder.build(rdb_contents(), rdb=True)
+        try:
+            self.rewrite_append_only_file_background()
+        except OSError:
+            return RESPbuilder.error(
+                args="Can't execute an AOF background rewriting. Please check "
+                "the server logs for more information.",
+                typ=RESPerror.CUSTOM,
+            )
 
-        elif command == "WAIT":
-            if not conn:
-                return None
+        return RESPbuilder.build(
+            "Background append only file rewriting started", bulkstr=False
+        )
 
-            argslen = len(args)
-            if argslen < 2:
-                return RESPbuilder.error(command)
+    def aof_rewrite_tmppath(self, pid: int):
+        return os.path.join(self.config.dirpath.value, f"temp-rewriteaof-bg-{pid}.aof")
 
-            numreplicas = int(args[0])
-            timeout = int(args[1])
+    def rewrite_append_only_file_background(self):
+        """
+        A forked child writes the dataset as an RDB preamble, whose size is
+        bounded by the dataset rather than its write history. Meanwhile the
+        commands the parent runs are kept in aof_rewrite_buf, and appended
+        to the new file once the child is done.
+        """
 
-            # send GETACK message to replicas
-            getack_req = RESPbuilder.build(["REPLCONF", "GETACK", "*"])
-            for r in self._replicas:
-                r.send(getack_req)
+        def start_buffering():
+            with self.aof_buf_lock:
+                self.aof_rewrite_buf = bytearray()
 
-            self.ackcount = 0
+        self.aof_rewrite_scheduled = False
+        try:
+            pid = self.fork_child(self.aof_rewrite, on_fork=start_buffering)
+        except OSError as e:
+            sys.stderr.write(f"Can't rewrite append only file in background: fork: {e}\n")
+            self.aof_lastbgrewrite_status = False
+            raise
+
+        self.aof_child_pid = pid
+        self.aof_rewrite_time_start = time.time()
+        print(f"Background append only file rewriting started by pid {pid}")
+
+    def aof_rewrite(self):
+        # Runs in the child, see fork_child()
+        with open(self.aof_rewrite_tmppath(os.getpid()), "wb") as f:
+            RDBwriter(f, self.config.rdbchecksum.value).save(store)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def check_aof_child_done(self):
+        """
+        Reaps the BGREWRITEAOF child if it has exited, and on success
+        switches to the rewritten file.
+        """
+        ok = self.reap_child(self.aof_child_pid)
+        if ok is None:
+            return
 
-            def poll_func(ev, numreplicas):
-                while True:
-                    if ev.is_set():
-                        return
+        tmppath = self.aof_rewrite_tmppath(self.aof_child_pid)
+        self.aof_child_pid = -1
 
-                    if self.ackcount >= numreplicas:
-                        ev.set()
-                        return
+        if ok:
+            try:
+                self.aof_rewrite_done(tmppath)
+                print("Background AOF rewrite finished successfully")
+            except OSError as e:
+                sys.stderr.write(f"Error trying to finish the AOF rewrite: {e}\n")
+                ok = False
+        else:
+            sys.stderr.write("Background AOF rewrite terminated with error\n")
 
-            wait_ev = Event()
+        if not ok:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+
+        with self.aof_buf_lock:
+            self.aof_rewrite_buf = None
+        self.aof_lastbgrewrite_status = ok
+        self.aof_rewrite_time_last = int(time.time() - self.aof_rewrite_time_start)
+        if ok:
+            self.stat_aof_rewrites += 1
+
+    def aof_rewrite_done(self, tmppath: str):
+        """
+        Appends the commands run during the rewrite to the new file and
+        renames it over the AOF. New writes wait on the buffer lock
+        meanwhile, so none of them is lost between the two files.
+        """
+        with self.aof_write_lock, self.aof_buf_lock:
+            fd = os.open(tmppath, os.O_WRONLY | os.O_APPEND)
+            try:
+                buf = memoryview(self.aof_rewrite_buf)
+                written = 0
+                while written < len(buf):
+                    written += os.write(fd, buf[written:])
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            os.replace(tmppath, self.aof_path())
+            if self.aof_fd != -1:
+                # The unwritten commands are in the rewrite buffer as well
+                os.close(self.aof_fd)
+                self.aof_buf.clear()
+                self.open_append_only_file()
+            else:
+                self.aof_rewrite_base_size = os.path.getsize(self.aof_path())
+            self.aof_rewrite_buf = None
 
-            poll_thread = Thread(
-                target=poll_func,
-                args=(
-                    wait_ev,
-                    numreplicas,
-                ),
-            )
-            poll_thread.start()
+    def check_aof_rewrite_params(self):
+        """
+        Starts a BGREWRITEAOF when the AOF grew by auto-aof-rewrite-percentage
+        since the last rewrite, and is at least auto-aof-rewrite-min-size.
+        """
+        percentage = self.config.auto_aof_rewrite_percentage.value
+        if (
+            self.aof_fd == -1
+            or percentage <= 0
+            or self.aof_current_size < self.config.auto_aof_rewrite_min_size.value
+        ):
+            return
 
-            wait_ev.wait(timeout / 1000)
-            wait_ev.set()
+        base = self.aof_rewrite_base_size or 1
+        growth = self.aof_current_size * 100 // base - 100
+        if growth >= percentage:
+            print(f"Starting automatic rewriting of AOF on {growth}% growth")
+            try:
+                self.rewrite_append_only_file_background()
+            except OSError:
+                pass
 
-            poll_thread.join()
+    def aof_path(self):
+        return os.path.join(self.config.dirpath.value, self.config.appendfilename.value)
 
-            result = self.ackcount if self.ackcount > 0 else len(self._replicas)
+    def load_data(self):
+        """
+        Loads the dataset at startup, from the AOF when it's enabled and
+        present since it is the most up to date, otherwise from the RDB.
+        """
+        if self.config.appendonly.value and os.path.exists(self.aof_path()):
+            self.load_append_only_file()
+        else:
+            self.read_rdb()
 
-            response = RESPbuilder.build(int(result))
+        if self.config.appendonly.value:
+            if os.path.exists(self.aof_path()):
+                self.open_append_only_file()
+            else:
+                self.start_append_only()
 
-        elif command == "KEYS":
-            subcommand = ""
-            if len(args) >= 1:
-                subcommand = args[0]
+    def start_append_only(self):
+        """
+        Creates the AOF from the current dataset, written as an RDB
+        preamble, and starts appending write commands to it.
+        """
+        path = self.aof_path()
+        tmppath = os.path.join(
+            self.config.dirpath.value, f"temp-rewriteaof-{os.getpid()}.aof"
+        )
 
-            if subcommand == "*":
-                keys = list(store.keys())
-                response = RESPbuilder.build(keys)
+        store.lock_all()
+        try:
+            try:
+                with open(tmppath, "wb") as f:
+                    RDBwriter(f, self.config.rdbchecksum.value).save(store)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmppath, path)
+            except OSError:
+                try:
+                    os.unlink(tmppath)
+                except OSError:
+                    pass
+                raise
 
-        elif command == "TYPE":
-            key = ""
-            if len(args) >= 1:
-                key = args[0]
+            # Writes so far are part of the snapshot
+            with self.aof_buf_lock:
+                self.aof_buf.clear()
+            self.open_append_only_file()
+        finally:
+            store.unlock_all()
 
-            value_type = store.type(key)
+        print("AOF created from the current dataset")
 
-            response = RESPbuilder.build(value_type, bulkstr=False)
+    def open_append_only_file(self):
+        self.aof_fd = os.open(
+            self.aof_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+        self.aof_current_size = self.aof_fsynced_size = os.fstat(self.aof_fd).st_size
+        self.aof_last_fsync = time.monotonic()
+        # The file was just loaded, created or rewritten
+        self.aof_rewrite_base_size = self.aof_current_size
+
+    def stop_append_only(self):
+        self.flush_append_only_file(force=True)
+        with self.aof_write_lock:
+            os.fsync(self.aof_fd)
+            os.close(self.aof_fd)
+            self.aof_fd = -1
+        with self.aof_buf_lock:
+            self.aof_buf.clear()
+        print("AOF turned off")
+
+    def feed_append_only_file(self, request_bytes: bytes):
+        if self.aof_fd == -1 and self.aof_rewrite_buf is None:
+            return
+        with self.aof_buf_lock:
+            if self.aof_fd != -1:
+                self.aof_buf += request_bytes
+            if self.aof_rewrite_buf is not None:
+                self.aof_rewrite_buf += request_bytes
 
-        elif command == "XADD":
-            if len(args) < 4:
-                if not conn:
-                    return None
+    def aof_fsync_pending(self):
+        """
+        True if replies must wait for the AOF to be written and fsynced.
+        """
+        return (
+            self.aof_fd != -1
+            and len(self.aof_buf) > 0
+            and self.config.appendfsync.value == "always"
+        )
 
-                return RESPbuilder.error(command)
+    def aof_fsync(self):
+        start = time.perf_counter_ns()
+        os.fsync(self.aof_fd)
+        usec = (time.perf_counter_ns() - start) // 1000
 
-            key = args[0]
-            entry_id = args[1]
+        self.aof_last_fsync_usec = usec
+        self.stat_aof_fsyncs += 1
+        self.stat_aof_fsync_usec += usec
 
-            args = args[2:]
-            argslen = len(args)
+    def aof_background_fsync(self):
+        """
+        Fsyncs the AOF from a thread so that a slow disk doesn't stall the
+        clients, for appendfsync everysec.
+        """
+        size = self.aof_current_size
 
-            stream_entry = StreamEntry(id=entry_id)
+        def fsync():
+            try:
+                self.aof_fsync()
+                self.aof_fsynced_size = max(self.aof_fsynced_size, size)
+            except OSError as e:
+                sys.stderr.write(f"Error fsyncing the AOF: {e}\n")
+            finally:
+                self.aof_fsync_in_progress = False
 
-            for i in range(0, argslen, 2):
-                k = args[i]
-                if i + 1 < argslen:
-                    v = args[i + 1]
-                else:
-                    return RESPbuilder.error(typ=RESPerror.SYNTAX)
+        self.aof_fsync_in_progress = True
+        self.aof_last_fsync = time.monotonic()
+        Thread(target=fsync, daemon=True).start()
 
-                stream_entry[k] = v
+    # Longest time a write may wait for a background fsync, in seconds
+    AOF_FLUSH_POSTPONE_MAX = 2
 
-            stored_id = store.append(key, stream_entry)
+    def flush_append_only_file(self, force: bool = False):
+        """
+        Writes the buffered commands to the AOF, and fsyncs them as
+        appendfsync says. All the commands buffered by then share the
+        write and the fsync: one per event loop iteration, or one per
+        concurrent batch of threads as the ones queued on the lock find
+        their commands already written.
+        """
+        if self.aof_fd == -1:
+            return
 
-            # set XADD event
-            if key in self._xadd_streams:
-                print("setting xadd event")
-                self._xadd_streams.remove(key)
-                self._xadd_ev.set()
+        with self.aof_write_lock:
+            if self.aof_fd == -1:
+                return
 
-            if not conn:
-                return None
+            policy = self.config.appendfsync.value
+            now = time.monotonic()
+
+            if not self.aof_buf:
+                # Commands written since the last fsync still need one
+                if (
+                    policy == "everysec"
+                    and self.aof_fsynced_size < self.aof_current_size
+                    and now - self.aof_last_fsync >= 1
+                    and not self.aof_fsync_in_progress
+                ):
+                    self.aof_background_fsync()
+                return
 
-            response = RESPbuilder.build(stored_id)
+            if policy == "everysec" and self.aof_fsync_in_progress and not force:
+                # write() would block behind the fsync, hold the buffer a
+                # little while
+                if not self.aof_flush_postponed_start:
+                    self.aof_flush_postponed_start = now
+                    return
+                if now - self.aof_flush_postponed_start < Server.AOF_FLUSH_POSTPONE_MAX:
+                    return
+
+                self.stat_aof_delayed_fsync += 1
+                print(
+                    "Asynchronous AOF fsync is taking too long (disk is busy?). "
+                    "Writing the AOF buffer without waiting for fsync to "
+                    "complete, this may slow down Redis."
+                )
+            self.aof_flush_postponed_start = 0
 
-        elif command == "XRANGE":
-            if len(args) < 3:
-                if not conn:
-                    return None
+            with self.aof_buf_lock:
+                buf = self.aof_buf
+                self.aof_buf = bytearray()
 
-                return RESPbuilder.error(command)
+            written = 0
+            try:
+                while written < len(buf):
+                    written += os.write(self.aof_fd, memoryview(buf)[written:])
+            except OSError as e:
+                self.aof_current_size += written
+                with self.aof_buf_lock:
+                    self.aof_buf[:0] = buf[written:]
+                self.aof_last_write_status = False
+                sys.stderr.write(f"Error writing to the AOF file: {e}\n")
+
+                if policy == "always":
+                    # The clients can't be told their writes are durable
+                    sys.stderr.write(
+                        "Can't recover from AOF write error when the AOF fsync "
+                        "policy is 'always'. Exiting...\n"
+                    )
+                    os._exit(1)
+                return
 
-            key = args[0]
-            start_id = args[1]
-            end_id = args[2]
+            self.aof_last_write_status = True
+            self.aof_current_size += written
+
+            if policy == "always":
+                self.aof_fsync()
+                self.aof_fsynced_size = self.aof_current_size
+                self.aof_last_fsync = now
+            elif (
+                policy == "everysec"
+                and now - self.aof_last_fsync >= 1
+                and not self.aof_fsync_in_progress
+            ):
+                self.aof_background_fsync()
+
+    def before_sleep(self):
+        """
+        Runs before each event loop poll: writes the AOF, then the replies
+        that were held for it.
+        """
+        self.flush_append_only_file()
 
-            stream = store.get(key)
-            if not stream:
-                return RESPbuilder.null()
-            if not isinstance(stream, Stream):
-                return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
+        if self.clients_pending_write:
+            pending = self.clients_pending_write
+            self.clients_pending_write = {}
+            for conn in pending:
+                if not conn._closed:
+                    conn.handle_write()
 
-            start_idx = stream.search(start_id, end=False)
-            end_idx = stream.search(end_id)
+    # Bytes of AOF fed to the command parser at a time
+    AOF_LOAD_CHUNK_SIZE = 1024 * 1024
 
-            response = RESPbuilder.build(stream[start_idx : end_idx + 1])
+    def load_append_only_file(self):
+        """
+        Replays the AOF: the RDB preamble if it has one, then the commands.
+        A truncated last command, as left by a crash in the middle of a
+        write, is dropped from the file.
+        """
+        path = self.aof_path()
+        size = os.path.getsize(path)
+        if size == 0:
+            return
 
-        elif command == "XREAD":
-            if len(args) < 1:
-                if not conn:
-                    return None
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+        data = memoryview(mm)
 
-                return RESPbuilder.error(command)
+        start = time.perf_counter()
+        self.loading = True
+        try:
+            pos = 0
+            if data[:5] == b"REDIS":
+                print("Reading RDB preamble from AOF file...")
+                pos = self.load_rdb(data)
+
+            parser = RESPparser()
+            valid = pos
+            ncommands = 0
+            for chunk in range(pos, size, Server.AOF_LOAD_CHUNK_SIZE):
+                parser.feed(bytes(data[chunk : chunk + Server.AOF_LOAD_CHUNK_SIZE]))
+                for n, tokens in parser:
+                    valid += n
+                    command, *args = tokens
+                    try:
+                        self.process_command(command, args)
+                    except (StreamError, ValueError) as e:
+                        # An error reply to a client, nothing to apply
+                        sys.stderr.write(f"Error replaying {command} from the AOF: {e}\n")
+                    ncommands += 1
+        finally:
+            self.loading = False
+            del data, mm
+
+        if valid < size:
+            print(
+                f"!!! Warning: short read while loading the AOF file {path}!!! "
+                f"Truncating the AOF at offset {valid}"
+            )
+            os.truncate(path, valid)
 
-            block = False
-            block_time = 0
-            if "block" in args:
-                block = True
-                block_time = int(args[args.index("block") + 1])
-            elif "BLOCK" in args:
-                block = True
-                block_time = int(args[args.index("BLOCK") + 1])
+        print(
+            f"DB loaded from append only file: {time.perf_counter() - start:.3f} "
+            f"seconds, {ncommands} commands"
+        )
 
-            start_idx = 0
-            if "streams" in args:
-                start_idx = args.index("streams") + 1
+    def read_rdb(self):
+        rdbpath = self.rdb_path()
 
-            elif "STREAMS" in args:
-                start_idx = args.index("STREAMS") + 1
+        try:
+            f = open(rdbpath, "rb")
+        except FileNotFoundError:
+            print(f"RDB file {rdbpath} not found")
+            self.load_rdb(rdb_contents())
+            return
 
-            else:
-                if not conn:
-                    return None
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(f"RDB file {rdbpath} is empty")
 
-                return RESPbuilder.error(command)
+            # Decode straight from the page cache instead of reading the
+            # whole file in memory. The mapping is released with the last
+            # view of it, not closed explicitly, so a decoding error isn't
+            # masked by views still held by its traceback.
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
 
-            key_id_len = len(args[start_idx:])
-            if key_id_len % 2 != 0:
-                return RESPbuilder.error(
-                    args="Unbalanced XREAD list of streams: for each stream "
-                    "key an ID or '$' must be specified",
-                    typ=RESPerror.CUSTOM,
-                )
-            if key_id_len == 0:
-                return RESPbuilder.error(command)
+        start = time.perf_counter()
+        self.load_rdb(memoryview(mm))
+        del mm
 
-            key_id_len = key_id_len // 2
+        print(f"DB loaded from disk: {time.perf_counter() - start:.3f} seconds")
 
-            key_id_list = []
-            for i in range(start_idx, start_idx + key_id_len):
-                key = args[i]
-                id = args[i + key_id_len]
-                key_id_list.append((key, id))
+    def load_rdb(self, data, db: Store = None):
+        """
+        Loads the keys of an RDB file held in data, a bytes-like object,
+        into db or else the keyspace. Returns the offset of the end of the
+        RDB payload.
+        """
+        parser = RDBparser(self.config.rdbchecksum.value)
+        db = store if db is None else db
+        now = millis()
+        end = len(data)
+        # Replicas keep the expired keys, the master sends their DELs
+        keep_expired = self._role == ServerRole.SLAVE
 
-            streams = []
-            for key, id in key_id_list:
-                stream = store.get(key)
-                if not stream:
-                    continue
-                if not isinstance(stream, Stream):
-                    return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
+        for state, key, value, expiry in parser.parse(data):
+            if state[:7] == "key_val":
+                if expiry == -1 or expiry > now or keep_expired:
+                    db.set(key, value, expiry)
+            elif state == "resize_db":
+                print(f"Loading {key} keys ({value} with an expiry)")
+            elif state == "chksum":
+                end = value
 
-                if id == "$":
-                    continue
+        return end
 
-                idx = stream.search(id, end=False)
-                if idx is None:
-                    return RESPbuilder.error(
-                        args="Invalid stream ID specified as stream command "
-                        "argument",
-                        typ=RESPerror.CUSTOM,
-                    )
 
-                streamlen = len(stream)
-                if idx < streamlen and id >= stream[idx]["id"]:
-                    idx += 1
-                if idx < streamlen:
-                    streams.append([key, stream[idx:]])
-
-            if block and len(streams) == 0:
-                for i in range(len(key_id_list)):
-                    key, id = key_id_list[i]
-                    self._xadd_streams.add(key)
-                    if id == "$":
-                        stream = store.get(key)
-                        if not stream:
-                            continue
-                        key_id_list[i] = (key, stream[-1]["id"])
-                        print(key_id_list[i])
-
-                self._xadd_ev.clear()
-                if block_time > 0:
-                    self._xadd_ev.wait(block_time / 1000)
-                else:
-                    self._xadd_ev.wait()
-                
-                for key, id in key_id_list:
-                    stream = store.get(key)
-                    if not stream:
-                        continue
-                    if not isinstance(stream, Stream):
-                        return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
-
-                    idx = stream.search(id, end=False)
-                    if idx is None:
-                        return RESPbuilder.error(
-                            args="Invalid stream ID specified as stream command "
-                            "argument",
-                            typ=RESPerror.CUSTOM,
-                        )
+Server.BLOCKING_COMMANDS = frozenset(
+    name for name, spec in COMMAND_TABLE.items() if "blocking" in spec.flags
+)
 
-                    streamlen = len(stream)
-                    if idx < streamlen and id >= stream[idx]["id"]:
-                        idx += 1
-                    if idx < streamlen:
-                        streams.append([key, stream[idx:]])
 
-            response = (
-                RESPbuilder.build(streams) if len(streams) > 0 else RESPbuilder.null()
-            )
+class RESPProtocolError(ValueError):
+    def __init__(self, message):
+        super(RESPProtocolError, self).__init__(message)
 
-        elif command == "SET":
-            if len(args) < 2:
-                if not conn:
-                    return None
 
-                return RESPbuilder.error(command)
+class RESPparser(object):
+    """
+    Incremental RESP parser working over a per-connection read buffer.
+
+    Bytes are appended with feed() as they are received and complete frames
+    are taken out with get_command(). Bulk strings are sliced by their
+    declared length so they may contain any byte, including CRLF. A request
+    that is split across reads keeps its partially parsed state, so bytes
+    already consumed are never scanned again.
+    """
+
+    # Drop consumed bytes from the front of the buffer past this size
+    COMPACT_SIZE = 64 * 1024
+    # Same limits as Redis' proto-max-bulk-len and inline buffer
+    MAX_BULK_LEN = 512 * 1024 * 1024
+    MAX_MULTIBULK_LEN = 1024 * 1024
+    MAX_INLINE_SIZE = 64 * 1024
 
-            expiry = -1
-            if len(args) > 2:
-                expopt = args[2].upper()
-                if expopt == "PX" and len(args) == 4:
-                    expiry = millis() + int(args[3])
-                else:
-                    if not conn:
-                        return None
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
 
-                    return RESPbuilder.error(typ=RESPerror.SYNTAX)
+        # State of a partially parsed multibulk request
+        self._multibulklen = 0
+        self._bulklen = -1
+        self._args = []
+        self._framelen = 0
 
-            store.set(args[0], args[1], expiry)
+    def feed(self, data: bytes):
+        self._buf += data
 
-            if not conn:
-                return None
+    def pending(self):
+        """
+        Returns the number of received bytes not yet returned as a frame.
+        """
+        return len(self._buf) - self._pos + self._framelen
 
-            response = RESPbuilder.build("OK", bulkstr=False)
+    @staticmethod
+    def decode(data) -> str:
+        return data.decode("utf-8", "surrogateescape")
+
+    def _readline(self):
+        buf = self._buf
+        nl = buf.find(b"\r\n", self._pos)
+        if nl < 0:
+            if len(buf) - self._pos > self.MAX_INLINE_SIZE:
+                raise RESPProtocolError("too big inline request")
+            return None
 
-        elif command == "GET":
-            if not conn:
+        line = buf[self._pos : nl]
+        self._framelen += nl + 2 - self._pos
+        self._pos = nl + 2
+        return line
+
+    def _compact(self):
+        if self._pos == len(self._buf):
+            self._buf.clear()
+            self._pos = 0
+        elif self._pos > self.COMPACT_SIZE:
+            del self._buf[: self._pos]
+            self._pos = 0
+
+    def _complete(self, value):
+        n = self._framelen
+        self._framelen = 0
+        return n, value
+
+    def _get_multibulk(self):
+        buf = self._buf
+
+        if self._multibulklen == 0:
+            line = self._readline()
+            if line is None:
                 return None
 
-            nargs = len(args)
-            if nargs < 1:
-                return RESPbuilder.error(command)
+            try:
+                n = int(line[1:])
+            except ValueError:
+                raise RESPProtocolError("invalid multibulk length")
+            if n > self.MAX_MULTIBULK_LEN:
+                raise RESPProtocolError("invalid multibulk length")
+            if n <= 0:
+                return self._complete([])
+
+            self._multibulklen = n
+            self._args = []
+
+        while self._multibulklen > 0:
+            if self._bulklen == -1:
+                if self._pos >= len(buf):
+                    return None
+                if buf[self._pos] != 0x24:  # '$'
+                    raise RESPProtocolError(
+                        f"expected '$', got '{chr(buf[self._pos])}'"
+                    )
 
-            if nargs == 1:
-                values = store.get(args[0])
-                if isinstance(values, Stream):
-                    return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
+                line = self._readline()
+                if line is None:
+                    return None
 
-            else:
-                values = []
-                for i in range(nargs):
-                    value = store.get(args[i])
-                    if isinstance(value, Stream):
-                        return RESPbuilder.error(typ=RESPerror.WRONGTYPE)
-                    values.append(value)
+                try:
+                    bulklen = int(line[1:])
+                except ValueError:
+                    bulklen = -1
+                if bulklen < 0 or bulklen > self.MAX_BULK_LEN:
+                    raise RESPProtocolError("invalid bulk length")
 
-            response = RESPbuilder.build(values)
+                self._bulklen = bulklen
 
-        elif command == "DEL":
-            if not conn:
+            end = self._pos + self._bulklen
+            if len(buf) < end + 2:
                 return None
 
-            nargs = len(args)
-            if nargs < 1:
-                return RESPbuilder.error(command)
-
-            if nargs == 1:
-                keys_deleted = store.delete(args[0])
+            self._args.append(self.decode(buf[self._pos : end]))
+            self._framelen += self._bulklen + 2
+            self._pos = end + 2
+            self._bulklen = -1
+            self._multibulklen -= 1
 
-            else:
-                keys_deleted = 0
-                for i in range(nargs):
-                    keys_deleted += store.delete(args[i])
+        args = self._args
+        self._args = []
+        return self._complete(args)
 
-            response = RESPbuilder.build(keys_deleted)
+    def _get_value(self):
+        """
+        Parses a single non-array frame: simple strings, errors, integers,
+        bulk strings and inline commands.
+        """
+        buf = self._buf
+        start = self._pos
+        typ = buf[start]
 
-        return response
+        line = self._readline()
+        if line is None:
+            return None
 
-    def read_rdb(self):
-        global store
+        # integer
+        if typ == 0x3A:  # ':'
+            try:
+                return self._complete(int(line[1:]))
+            except ValueError:
+                raise RESPProtocolError("invalid integer")
 
-        rdbdata = b""
-        rdbpath = self.config.dirpath.value + "/" + self.config.dbfilename.value
+        # simple string and error
+        elif typ == 0x2B or typ == 0x2D:  # '+', '-'
+            return self._complete(self.decode(line[1:]))
 
-        parser = RDBparser()
-        try:
-            with open(rdbpath, "rb") as f:
-                rdbdata = f.read()
+        # bulk string
+        elif typ == 0x24:  # '$'
+            try:
+                nbytes = int(line[1:])
+            except ValueError:
+                raise RESPProtocolError("invalid bulk length")
+            if nbytes > self.MAX_BULK_LEN:
+                raise RESPProtocolError("invalid bulk length")
+            if nbytes < 0:
+                return self._complete("")
+
+            end = self._pos + nbytes
+            if len(buf) < end + 2:
+                # Rewind, the header is parsed again once the body arrived
+                self._pos = start
+                self._framelen = 0
+                return None
 
-        except FileNotFoundError as e:
-            print(f"RDB file {rdbpath} not found")
-            rdbdata = rdb_contents()
+            value = self.decode(buf[self._pos : end])
+            self._framelen += nbytes + 2
+            self._pos = end + 2
+            return self._complete(value)
 
-        for state, key, value, expiry in parser.parse(rdbdata):
-            if state[:7] == "key_val" and (expiry == -1 or expiry > millis()):
-                store.set(key, value, expiry)
+        # inline command
+        return self._complete([self.decode(arg) for arg in line.split()])
 
+    def get_command(self):
+        """
+        Returns the next complete frame as a tuple of its exact length in
+        bytes and its parsed value, or None if more data is needed.
+        """
+        if self._multibulklen == 0 and self._bulklen == -1:
+            if self._pos >= len(self._buf):
+                self._compact()
+                return None
 
-class RESPparser(object):
-    @classmethod
-    def _parse_internal(cls, lines):
-        if len(lines) == 0:
-            return 0, [""]
+            if self._buf[self._pos] != 0x2A:  # '*'
+                result = self._get_value()
+                if result is None:
+                    self._compact()
+                return result
 
-        n, startline = RESPStr(lines.pop(0).decode()).rstrip_all("\r\n")
-        ntotal = (n * 2) + len(startline)
+        result = self._get_multibulk()
+        if result is None:
+            self._compact()
+        return result
 
-        params = []
+    def _get_multibulk_fast(self):
+        """
+        Parses a multibulk request that was received as a whole in one pass,
+        without saving any state between its arguments. Returns None if the
+        request is incomplete or malformed, get_multibulk() then takes over
+        from the same position.
+        """
+        buf = self._buf
+        find = buf.find
+        decode = self.decode
+        buflen = len(buf)
 
-        # integer
-        if startline.startswith(":"):
-            return ntotal, int(startline[1:])
+        nl = find(b"\r\n", self._pos)
+        if nl < 0:
+            return None
+        try:
+            n = int(buf[self._pos + 1 : nl])
+        except ValueError:
+            return None
+        if n <= 0 or n > self.MAX_MULTIBULK_LEN:
+            return None
 
-        # simple string
-        elif startline.startswith("+"):
-            return ntotal, startline[1:]
+        pos = nl + 2
+        args = []
+        for _ in range(n):
+            if pos >= buflen or buf[pos] != 0x24:  # '$'
+                return None
+            nl = find(b"\r\n", pos)
+            if nl < 0:
+                return None
+            try:
+                bulklen = int(buf[pos + 1 : nl])
+            except ValueError:
+                return None
+            if bulklen < 0 or bulklen > self.MAX_BULK_LEN:
+                return None
 
-        # bulk string
-        elif startline.startswith("$"):
-            nbytes = int(startline[1:])
-            if len(lines) < 1:
-                raise RuntimeError("Invalid data")
-            n, line = RESPStr(lines.pop(0).decode()).rstrip_all("\r\n")
-            if len(line) < nbytes:
-                raise RuntimeError("Bulk string data fell short")
-            ntotal += (n * 2) + len(line)
-            param = line[:nbytes]
-            return ntotal, param
+            pos = nl + 2 + bulklen
+            if pos + 2 > buflen:
+                return None
+            args.append(decode(buf[nl + 2 : pos]))
+            pos += 2
 
-        # array
-        elif startline.startswith("*"):
-            nparams = int(startline[1:])
+        n = pos - self._pos
+        self._pos = pos
+        return n, args
 
-            for i in range(nparams):
-                nchild, paramschild = cls._parse_internal(lines)
+    def get_commands(self, limit: int):
+        """
+        Returns up to limit complete frames as a list of get_command()
+        results. Requests already received as a whole take a fast path,
+        the rest is parsed incrementally.
+        """
+        frames = []
+        buf = self._buf
+        while len(frames) < limit:
+            result = None
+            if (
+                self._multibulklen == 0
+                and self._bulklen == -1
+                and self._pos < len(buf)
+                and buf[self._pos] == 0x2A  # '*'
+            ):
+                result = self._get_multibulk_fast()
+            if result is None:
+                result = self.get_command()
+                if result is None:
+                    break
+            frames.append(result)
 
-                params.append(paramschild)
-                ntotal += nchild
+        return frames
 
-        return ntotal, params
+    def __iter__(self):
+        while True:
+            result = self.get_command()
+            if result is None:
+                return
+            yield result
 
     @classmethod
     def parse(cls, data):
+        """
+        Parses the first complete frame in data.
+        """
         if len(data) == 0:
             return 0, [""]
 
-        lines = data.splitlines(keepends=True)
-        nlines = len(lines)
+        parser = cls()
+        parser.feed(data)
+        result = parser.get_command()
+        if result is None:
+            raise RuntimeError("Invalid data")
+
+        return result
+
 
-        n, params = cls._parse_internal(lines)
+class LazyReply(object):
+    """
+    Reply serialized straight into a connection's output buffer as the
+    socket drains, so large replies never exist in memory as a whole.
 
-        # if nlines != n:
-        #    raise RuntimeError('Invalid data')
+    Parts are either encoded bytes or (stream, indices) pairs whose entries
+    are encoded one at a time.
+    """
+
+    __slots__ = ("_parts", "_part", "_pos")
+
+    def __init__(self, parts: list):
+        self._parts = parts
+        self._part = 0
+        self._pos = 0
+
+    def write(self, buf: bytearray, limit: int):
+        """
+        Appends encoded parts to buf until it holds limit bytes or the reply
+        is complete. Returns True once the whole reply has been written.
+        """
+        while self._part < len(self._parts):
+            part = self._parts[self._part]
+
+            if isinstance(part, bytes):
+                buf += part
+            else:
+                stream, indices = part
+                while self._pos < len(indices):
+                    if len(buf) >= limit:
+                        return False
+                    RESPbuilder.write_stream_entry(buf, stream, indices[self._pos])
+                    self._pos += 1
+                self._pos = 0
+
+            self._part += 1
+            if len(buf) >= limit and self._part < len(self._parts):
+                return False
 
-        return n, params
+        return True
 
-    def __init__(self, data):
-        self.params = self.parse(data)
+    def encode(self):
+        buf = bytearray()
+        self.write(buf, sys.maxsize)
+        return bytes(buf)
 
 
 class RESPerror(Enum):
@@ -1067,18 +5210,26 @@ class RESPerror(Enum):
     WRONGTYPE = 3
     SYNTAX = 4
     CUSTOM = 5
+    OOM = 6
+    NOMASTERLINK = 7
 
 
 class RESPbuilder(object):
 
     @classmethod
-    def resolve_entry(cls, entry: StreamEntry):
-        l = []
-        keys = list(entry.keys())[1:]
-        for key in keys:
-            l.append(key)
-            l.append(entry[key])
-        return [entry["id"], l]
+    def write_stream_entry(cls, buf: bytearray, stream: Stream, idx: int):
+        """
+        Appends the RESP encoding of a stream entry to buf.
+        """
+        ms, seq, names, values = stream.entry_parts(idx)
+
+        id = b"%d-%d" % (ms, seq)
+        buf += b"*2\r\n$%d\r\n%s\r\n*%d\r\n" % (len(id), id, 2 * len(values))
+
+        for name, value in zip(names, values):
+            name = name.encode("utf-8", "surrogateescape")
+            value = value.encode("utf-8", "surrogateescape")
+            buf += b"$%d\r\n%s\r\n$%d\r\n%s\r\n" % (len(name), name, len(value), value)
 
     @classmethod
     def null(cls):
@@ -1087,23 +5238,27 @@ class RESPbuilder(object):
     @classmethod
     def build(
         cls,
-        data: Union[int, str, list, StreamEntry, Stream],
+        data: Union[None, int, str, list, tuple, Stream],
         bulkstr: bool = True,
         rdb: bool = False
     ):
         typ = type(data)
 
-        if typ == int:
+        if data is None:
+            return cls.null()
+
+        elif typ == int:
             return f":{data}\r\n".encode()
 
         elif typ == str:
             if len(data) == 0:
                 return cls.null()
 
+            data = data.encode("utf-8", "surrogateescape")
             if bulkstr:
-                return f"${len(data)}\r\n{data}\r\n".encode()
+                return b"$%d\r\n%s\r\n" % (len(data), data)
             else:
-                return f"+{data}\r\n".encode()
+                return b"+%s\r\n" % data
 
         elif typ == bytes:
             if rdb:
@@ -1111,20 +5266,11 @@ class RESPbuilder(object):
             else:
                 return cls.null()
 
-        elif typ == list:
+        elif typ == list or typ == tuple:
             return f"*{len(data)}\r\n".encode() + "".encode().join(map(cls.build, data))
 
-        elif typ == StreamEntry:
-            streamentryl = RESPbuilder.resolve_entry(data)
-
-            return RESPbuilder.build(streamentryl)
-
         elif typ == Stream:
-            streaml = []
-            for entry in data:
-                streaml.append(RESPbuilder.resolve_entry(entry))
-
-            return RESPbuilder.build(streaml)
+            return RESPbuilder.build(list(data.entries()))
 
         else:
             raise TypeError(f"Unsupported type: {typ}")
@@ -1161,17 +5307,136 @@ class RESPbuilder(object):
         elif typ == RESPerror.CUSTOM:
             return f"-ERR {args}\r\n".encode()
 
+        elif typ == RESPerror.OOM:
+            return (
+                "-OOM command not allowed when used memory > 'maxmemory'.\r\n"
+            ).encode()
+
+        elif typ == RESPerror.NOMASTERLINK:
+            return (
+                "-NOMASTERLINK Can't SYNC while not connected with my master\r\n"
+            ).encode()
+
         else:
             raise RuntimeError("Unknown error type")
 
 
+# Jones polynomial (reflected), as used by Redis for RDB checksums
+CRC64_POLY = 0x95AC9329AC4BC9B5
+
+
+def crc64_tables():
+    """
+    Lookup tables for slice-by-8: table k maps a byte to the CRC of that
+    byte followed by k zero bytes.
+    """
+    t0 = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ CRC64_POLY if crc & 1 else crc >> 1
+        t0.append(crc)
+
+    tables = [t0]
+    for _ in range(7):
+        prev = tables[-1]
+        tables.append([(crc >> 8) ^ t0[crc & 0xFF] for crc in prev])
+    return tables
+
+
+CRC64_TABLES = crc64_tables()
+
+
+def crc64(crc: int, data):
+    """
+    Updates crc with data, a bytes-like object. Eight bytes are folded in
+    per step (slice-by-8), so checksumming a large file can be done in
+    chunks as it is read or written.
+    """
+    t0, t1, t2, t3, t4, t5, t6, t7 = CRC64_TABLES
+    data = memoryview(data)
+    n = len(data) & ~7
+
+    if sys.byteorder == "little":
+        words = data[:n].cast("Q")
+    else:
+        words = (word for (word,) in struct.iter_unpack("<Q", data[:n]))
+
+    for word in words:
+        crc ^= word
+        crc = (
+            t7[crc & 0xFF]
+            ^ t6[(crc >> 8) & 0xFF]
+            ^ t5[(crc >> 16) & 0xFF]
+            ^ t4[(crc >> 24) & 0xFF]
+            ^ t3[(crc >> 32) & 0xFF]
+            ^ t2[(crc >> 40) & 0xFF]
+            ^ t1[(crc >> 48) & 0xFF]
+            ^ t0[crc >> 56]
+        )
+
+    for b in data[n:]:
+        crc = t0[(crc ^ b) & 0xFF] ^ (crc >> 8)
+
+    return crc
+
+
+def lzf_decompress(data, ulen: int):
+    """
+    Decompresses an LZF block (as written by Redis with rdbcompression) of
+    ulen bytes once decompressed.
+    """
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            # Literal run of ctrl + 1 bytes
+            out += data[i : i + ctrl + 1]
+            i += ctrl + 1
+            continue
+
+        # Back reference: 3 bits of length (7 means an extra length byte)
+        # and 13 bits of offset
+        length = ctrl >> 5
+        if length == 7:
+            length += data[i]
+            i += 1
+        length += 2
+        ref = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+        i += 1
+        if ref < 0:
+            raise ValueError("Invalid LZF compressed string")
+
+        distance = len(out) - ref
+        if length <= distance:
+            out += out[ref : ref + length]
+        else:
+            # Overlapping copy, repeats the last distance bytes
+            pattern = out[ref:]
+            out += (pattern * (length // distance + 1))[:length]
+
+    if len(out) != ulen:
+        raise ValueError("Invalid LZF compressed string")
+    return out
+
+
 class RDBparser(object):
+    """
+    Decodes RDB files over a memoryview, typically of an mmap of the file,
+    so the file is never read into memory as a whole: strings are decoded
+    straight from the mapping and only LZF compressed ones are copied.
+    """
+
     _states = [
         "start",
         "magic",
         "ver",
         "aux",
         "db_sel",
+        "resize_db",
         "key_val_s",
         "key_val_ms",
         "key_val",
@@ -1181,6 +5446,36 @@ class RDBparser(object):
 
     _datatypes = ["str", "int8", "int16", "int32", "lzf"]
 
+    # Value types
+    TYPE_STRING = 0
+    TYPE_LIST = 1
+    TYPE_SET = 2
+    TYPE_ZSET = 3
+    TYPE_HASH = 4
+    TYPE_ZSET_2 = 5
+    TYPE_MODULE = 6
+    TYPE_MODULE_2 = 7
+    TYPE_HASH_ZIPMAP = 9
+    TYPE_LIST_ZIPLIST = 10
+    TYPE_SET_INTSET = 11
+    TYPE_ZSET_ZIPLIST = 12
+    TYPE_HASH_ZIPLIST = 13
+    TYPE_LIST_QUICKLIST = 14
+    TYPE_STREAM_LISTPACKS = 15
+    TYPE_HASH_LISTPACK = 16
+    TYPE_ZSET_LISTPACK = 17
+    TYPE_LIST_QUICKLIST_2 = 18
+    TYPE_STREAM_LISTPACKS_2 = 19
+    TYPE_SET_LISTPACK = 20
+    TYPE_STREAM_LISTPACKS_3 = 21
+
+    # Bytes of input checksummed at a time
+    CRC_CHUNK_SIZE = 1024 * 1024
+
+    # Quicklist 2 node containers
+    QUICKLIST_NODE_PLAIN = 1
+    QUICKLIST_NODE_PACKED = 2
+
     def __init__(self, rdbchecksum: bool = True):
         self._state = RDBparser._states[0]
         self._rdbchecksum = rdbchecksum
@@ -1201,16 +5496,20 @@ class RDBparser(object):
             second_byte = data[pos + 1]
             length = ((first_byte & 0x3F) << 8) | second_byte
             return datatype, length, 2
-        elif msb == 2:  # 10: 32-bit encoding
+        elif msb == 2:  # 10: 32 or 64-bit big-endian encoding
+            if first_byte == 0x81:
+                length = int.from_bytes(data[pos + 1 : pos + 9], byteorder="big")
+                return datatype, length, 9
             length = int.from_bytes(
-                data[pos + 1 : pos + 5], byteorder="little", signed=False
+                data[pos + 1 : pos + 5], byteorder="big", signed=False
             )
             return datatype, length, 5
         else:  # 11: special encoding
             fmt = first_byte & 0x3F
             if fmt == 0x3:
+                # Followed by the compressed and uncompressed lengths
                 datatype = "lzf"
-                raise ValueError("Compressed strings not supported")
+                return datatype, 0, 1
 
             if fmt == 0:
                 datatype = "int8"
@@ -1226,17 +5525,372 @@ class RDBparser(object):
             else:
                 raise ValueError("Invalid data")
 
-    def decode_string_encoding(self, data, pos):
+    def decode_length(self, data, pos):
+        _, length, consumed_bytes = self.decode_length_encoding(data, pos)
+        return length, consumed_bytes
+
+    def read_string(self, data, pos):
+        """
+        Returns a string object as a buffer (a slice of data unless it was
+        compressed) or as an int for the integer encodings, and the number
+        of bytes it takes in data.
+        """
         datatype, str_len, consumed_bytes = self.decode_length_encoding(data, pos)
         pos += consumed_bytes
-        string = ""
         if datatype == "str":
-            string = data[pos : pos + str_len].decode("utf-8")
-        elif datatype[:3] == "int":
-            string = int.from_bytes(data[pos : pos + str_len], byteorder="little")
-        return string, consumed_bytes + str_len
+            return data[pos : pos + str_len], consumed_bytes + str_len
+
+        elif datatype == "lzf":
+            clen, n1 = self.decode_length(data, pos)
+            ulen, n2 = self.decode_length(data, pos + n1)
+            pos += n1 + n2
+            return (
+                lzf_decompress(data[pos : pos + clen], ulen),
+                consumed_bytes + n1 + n2 + clen,
+            )
+
+        return (
+            int.from_bytes(data[pos : pos + str_len], byteorder="little", signed=True),
+            consumed_bytes + str_len,
+        )
+
+    def decode_string_encoding(self, data, pos):
+        strlen = data[pos]
+        if strlen < 0x40:
+            # 6-bit length, the common case for keys and small values
+            return (
+                str(data[pos + 1 : pos + 1 + strlen], "utf-8", "surrogateescape"),
+                1 + strlen,
+            )
+
+        string, consumed_bytes = self.read_string(data, pos)
+        if isinstance(string, int):
+            return str(string), consumed_bytes
+        return str(string, "utf-8", "surrogateescape"), consumed_bytes
+
+    def decode_raw_string(self, data, pos):
+        string, consumed_bytes = self.read_string(data, pos)
+        if isinstance(string, int):
+            return str(string).encode(), consumed_bytes
+        return string, consumed_bytes
+
+    def decode_listpack(self, data):
+        """
+        Returns the elements of a listpack, integers as ints.
+        """
+        elements = []
+        pos = 6
+        while data[pos] != 0xFF:
+            b = data[pos]
+            if b < 0x80:  # 7-bit uint
+                elements.append(b)
+                size = 1
+            elif b < 0xC0:  # 6-bit string length
+                size = 1 + (b & 0x3F)
+                elements.append(str(data[pos + 1 : pos + size], "utf-8", "surrogateescape"))
+            elif b < 0xE0:  # 13-bit int
+                n = ((b & 0x1F) << 8) | data[pos + 1]
+                elements.append(n - (1 << 13) if n >= (1 << 12) else n)
+                size = 2
+            elif b < 0xF0:  # 12-bit string length
+                strlen = ((b & 0x0F) << 8) | data[pos + 1]
+                elements.append(
+                    str(data[pos + 2 : pos + 2 + strlen], "utf-8", "surrogateescape")
+                )
+                size = 2 + strlen
+            elif b == 0xF0:  # 32-bit string length
+                strlen = int.from_bytes(data[pos + 1 : pos + 5], "little")
+                elements.append(
+                    str(data[pos + 5 : pos + 5 + strlen], "utf-8", "surrogateescape")
+                )
+                size = 5 + strlen
+            else:  # 16, 24, 32 and 64-bit ints
+                nbytes = {0xF1: 2, 0xF2: 3, 0xF3: 4, 0xF4: 8}[b]
+                elements.append(
+                    int.from_bytes(data[pos + 1 : pos + 1 + nbytes], "little", signed=True)
+                )
+                size = 1 + nbytes
+
+            # Skip the back length
+            pos += size + (1 if size < 128 else len(RDBwriter.lp_backlen(size)))
+
+        return elements
+
+    def decode_ziplist(self, data):
+        """
+        Returns the elements of a ziplist (the list, hash and sorted set
+        encoding before listpacks), integers as ints.
+        """
+        elements = []
+        pos = 10
+        while data[pos] != 0xFF:
+            # Skip the previous entry length
+            pos += 5 if data[pos] == 0xFE else 1
+
+            b = data[pos]
+            enc = b >> 6
+            if enc == 0:  # 6-bit string length
+                strlen = b & 0x3F
+                pos += 1
+            elif enc == 1:  # 14-bit string length
+                strlen = ((b & 0x3F) << 8) | data[pos + 1]
+                pos += 2
+            elif enc == 2:  # 32-bit string length
+                strlen = int.from_bytes(data[pos + 1 : pos + 5], "big")
+                pos += 5
+            elif 0xF1 <= b <= 0xFD:  # 4-bit immediate from 0 to 12
+                elements.append((b & 0x0F) - 1)
+                pos += 1
+                continue
+            else:
+                nbytes = {0xC0: 2, 0xD0: 4, 0xE0: 8, 0xF0: 3, 0xFE: 1}[b]
+                elements.append(
+                    int.from_bytes(data[pos + 1 : pos + 1 + nbytes], "little", signed=True)
+                )
+                pos += 1 + nbytes
+                continue
+
+            elements.append(str(data[pos : pos + strlen], "utf-8", "surrogateescape"))
+            pos += strlen
+
+        return elements
+
+    def decode_zipmap(self, data):
+        """
+        Returns the field and value pairs of a zipmap, the oldest hash
+        encoding.
+        """
+        elements = []
+        pos = 1
+        while data[pos] != 0xFF:
+            for free in (False, True):
+                strlen = data[pos]
+                if strlen == 254:
+                    strlen = int.from_bytes(data[pos + 1 : pos + 5], "little")
+                    pos += 5
+                else:
+                    pos += 1
+
+                # Values are followed by the count of free bytes after them
+                nfree = 0
+                if free:
+                    nfree = data[pos]
+                    pos += 1
+                elements.append(str(data[pos : pos + strlen], "utf-8", "surrogateescape"))
+                pos += strlen + nfree
+
+        return elements
+
+    @staticmethod
+    def decode_intset(data):
+        encoding, length = struct.unpack_from("<II", data, 0)
+        fmt = {2: "h", 4: "i", 8: "q"}[encoding]
+        return struct.unpack_from(f"<{length}{fmt}", data, 8)
+
+    def decode_stream(self, data, pos, value_type: int = TYPE_STREAM_LISTPACKS):
+        """
+        Decodes a stream value. Consumer groups are not supported by the
+        server, they are skipped.
+        """
+        start = pos
+        stream = Stream()
+
+        nnodes, n = self.decode_length(data, pos)
+        pos += n
+        for _ in range(nnodes):
+            master_id, n = self.decode_raw_string(data, pos)
+            pos += n
+            lp, n = self.decode_raw_string(data, pos)
+            pos += n
+
+            master_ms, master_seq = struct.unpack(">QQ", master_id)
+            elements = self.decode_listpack(lp)
+
+            count, deleted, nfields = elements[0:3]
+            master_names = [str(name) for name in elements[3 : 3 + nfields]]
+            i = 3 + nfields + 1
+
+            for _ in range(count + deleted):
+                flags, ms_diff, seq_diff = elements[i : i + 3]
+                i += 3
+                if flags & RDBwriter.STREAM_ITEM_FLAG_SAMEFIELDS:
+                    names = master_names
+                    values = elements[i : i + len(names)]
+                    i += len(names)
+                else:
+                    nfields = elements[i]
+                    names = elements[i + 1 : i + 1 + 2 * nfields : 2]
+                    values = elements[i + 2 : i + 2 + 2 * nfields : 2]
+                    i += 1 + 2 * nfields
+                # Skip lp-count
+                i += 1
+
+                if not flags & RDBwriter.STREAM_ITEM_FLAG_DELETED:
+                    fields = []
+                    for name, value in zip(names, values):
+                        fields += [str(name), str(value)]
+                    stream.add(master_ms + ms_diff, master_seq + seq_diff, fields)
+
+        # Length and last ID, then the first ID, max deleted ID and entries
+        # added counter since version 2
+        nlengths = 3 if value_type == RDBparser.TYPE_STREAM_LISTPACKS else 8
+        for _ in range(nlengths):
+            _, n = self.decode_length(data, pos)
+            pos += n
+
+        ngroups, n = self.decode_length(data, pos)
+        pos += n
+        for _ in range(ngroups):
+            # Name, last delivered ID and entries read since version 2
+            _, n = self.read_string(data, pos)
+            pos += n
+            for _ in range(2 if value_type == RDBparser.TYPE_STREAM_LISTPACKS else 3):
+                _, n = self.decode_length(data, pos)
+                pos += n
+
+            # Pending entries: ID, delivery time and delivery count
+            npending, n = self.decode_length(data, pos)
+            pos += n
+            for _ in range(npending):
+                pos += 16 + 8
+                _, n = self.decode_length(data, pos)
+                pos += n
+
+            # Consumers: name, seen time, active time since version 3, and
+            # the IDs of their pending entries
+            nconsumers, n = self.decode_length(data, pos)
+            pos += n
+            for _ in range(nconsumers):
+                _, n = self.read_string(data, pos)
+                pos += n + 8
+                if value_type == RDBparser.TYPE_STREAM_LISTPACKS_3:
+                    pos += 8
+                npending, n = self.decode_length(data, pos)
+                pos += n + 16 * npending
+
+        return stream, pos - start
+
+    def decode_zset_score(self, data, pos):
+        # Scores of the original sorted set type are length-prefixed
+        # strings, with special lengths for nan and infinities
+        strlen = data[pos]
+        if strlen == 253:
+            return float("nan"), 1
+        elif strlen == 254:
+            return float("inf"), 1
+        elif strlen == 255:
+            return float("-inf"), 1
+        return float(str(data[pos + 1 : pos + 1 + strlen], "ascii")), 1 + strlen
+
+    def decode_value(self, value_type: int, data, pos):
+        """
+        Decodes a value of the given RDB type: a str, a Stream, or a list,
+        set, dict (hash) or ZSet for the other types. Returns the value and
+        the number of bytes it takes in data.
+        """
+        start = pos
+
+        if value_type == RDBparser.TYPE_STRING:
+            return self.decode_string_encoding(data, pos)
+
+        elif value_type in (
+            RDBparser.TYPE_STREAM_LISTPACKS,
+            RDBparser.TYPE_STREAM_LISTPACKS_2,
+            RDBparser.TYPE_STREAM_LISTPACKS_3,
+        ):
+            return self.decode_stream(data, pos, value_type)
+
+        elif value_type in (
+            RDBparser.TYPE_LIST,
+            RDBparser.TYPE_SET,
+            RDBparser.TYPE_HASH,
+            RDBparser.TYPE_ZSET,
+            RDBparser.TYPE_ZSET_2,
+        ):
+            length, n = self.decode_length(data, pos)
+            pos += n
+            if value_type == RDBparser.TYPE_HASH:
+                length *= 2
+
+            elements = []
+            for _ in range(length):
+                element, n = self.decode_string_encoding(data, pos)
+                pos += n
+                elements.append(element)
+
+                if value_type == RDBparser.TYPE_ZSET:
+                    score, n = self.decode_zset_score(data, pos)
+                    pos += n
+                    elements.append(score)
+                elif value_type == RDBparser.TYPE_ZSET_2:
+                    elements.append(struct.unpack("<d", data[pos : pos + 8])[0])
+                    pos += 8
+
+            if value_type == RDBparser.TYPE_LIST:
+                value = elements
+            elif value_type == RDBparser.TYPE_SET:
+                value = set(elements)
+            elif value_type == RDBparser.TYPE_HASH:
+                value = dict(zip(elements[::2], elements[1::2]))
+            else:
+                value = ZSet(zip(elements[::2], elements[1::2]))
+            return value, pos - start
+
+        elif value_type in (
+            RDBparser.TYPE_LIST_QUICKLIST,
+            RDBparser.TYPE_LIST_QUICKLIST_2,
+        ):
+            nnodes, n = self.decode_length(data, pos)
+            pos += n
+
+            value = []
+            for _ in range(nnodes):
+                container = RDBparser.QUICKLIST_NODE_PACKED
+                if value_type == RDBparser.TYPE_LIST_QUICKLIST_2:
+                    container, n = self.decode_length(data, pos)
+                    pos += n
+
+                node, n = self.decode_raw_string(data, pos)
+                pos += n
+                if container == RDBparser.QUICKLIST_NODE_PLAIN:
+                    value.append(str(node, "utf-8", "surrogateescape"))
+                elif value_type == RDBparser.TYPE_LIST_QUICKLIST_2:
+                    value += map(str, self.decode_listpack(node))
+                else:
+                    value += map(str, self.decode_ziplist(node))
+            return value, pos - start
+
+        # The remaining types are a single blob in a compact encoding
+        blob, n = self.decode_raw_string(data, pos)
+        pos += n
+
+        if value_type == RDBparser.TYPE_SET_INTSET:
+            value = set(map(str, self.decode_intset(blob)))
+        elif value_type == RDBparser.TYPE_SET_LISTPACK:
+            value = set(map(str, self.decode_listpack(blob)))
+        elif value_type == RDBparser.TYPE_LIST_ZIPLIST:
+            value = list(map(str, self.decode_ziplist(blob)))
+        elif value_type == RDBparser.TYPE_HASH_ZIPMAP:
+            elements = self.decode_zipmap(blob)
+            value = dict(zip(elements[::2], elements[1::2]))
+        elif value_type in (RDBparser.TYPE_HASH_ZIPLIST, RDBparser.TYPE_HASH_LISTPACK):
+            if value_type == RDBparser.TYPE_HASH_ZIPLIST:
+                elements = self.decode_ziplist(blob)
+            else:
+                elements = self.decode_listpack(blob)
+            value = dict(zip(map(str, elements[::2]), map(str, elements[1::2])))
+        elif value_type in (RDBparser.TYPE_ZSET_ZIPLIST, RDBparser.TYPE_ZSET_LISTPACK):
+            if value_type == RDBparser.TYPE_ZSET_ZIPLIST:
+                elements = self.decode_ziplist(blob)
+            else:
+                elements = self.decode_listpack(blob)
+            value = ZSet(zip(map(str, elements[::2]), map(float, elements[1::2])))
+        else:
+            raise ValueError(f"Unsupported RDB value type {value_type}")
+
+        return value, pos - start
 
-    def parse(self, stream: bytes):
+    def parse(self, stream):
         streamlen = len(stream)
         pos = 0
 
@@ -1252,21 +5906,37 @@ class RDBparser(object):
         version = 0
         if self._state == "magic":
             # Will raise ValueError on invalid data
-            version = int.from_bytes(stream[pos:9], byteorder="little")
+            version = int(str(stream[pos:9], "ascii"))
 
             pos += 4
             self._state = "ver"
             yield self._state, "RDB version", version, -1
 
+        expiry = -1
+
+        # The checksum is computed as the parse goes, over chunks of the
+        # data that was just decoded
+        crc = 0
+        crc_pos = 0
+        # Streamed input drops the bytes already decoded and checksummed
+        release = stream.release if isinstance(stream, SyncPayload) else None
+
         # Parse rest of the stream
         while pos < streamlen:
+            if pos - crc_pos >= RDBparser.CRC_CHUNK_SIZE:
+                if self._rdbchecksum:
+                    crc = crc64(crc, stream[crc_pos:pos])
+                crc_pos = pos
+                if release is not None:
+                    release(pos)
+
             opcode = stream[pos]
             pos += 1
 
             if opcode == 0xFD:  # Expiry time in seconds
                 self._state = "key_val_s"
 
-                expiry = int.from_bytes(
+                expiry = 1000 * int.from_bytes(
                     stream[pos : pos + 4], byteorder="little", signed=False
                 )
                 pos += 4
@@ -1291,249 +5961,645 @@ class RDBparser(object):
                 yield self._state, aux_key, aux_value, -1
 
             elif opcode == 0xFE:  # Database selector
-                # Skip over database selector field
-                # pos += 1
-                datatype, dbnum_len, consumed_bytes = self.decode_length_encoding(
-                    stream, pos
-                )
+                self._state = "db_sel"
+
+                dbnum, consumed_bytes = self.decode_length(stream, pos)
                 pos += consumed_bytes
-                if datatype == "str":
-                    dbnum = stream[pos : pos + dbnum_len].decode("utf-8")
-                elif datatype[:3] == "int":
-                    dbnum = int.from_bytes(
-                        stream[pos : pos + dbnum_len], byteorder="little"
-                    )
 
             elif opcode == 0xFB:  # Resize database
-                # Skip over resize database field
-                # pos += 4
-                datatype, int_len, consumed_bytes = self.decode_length_encoding(
-                    stream, pos
-                )
+                self._state = "resize_db"
+
+                db_size, consumed_bytes = self.decode_length(stream, pos)
+                pos += consumed_bytes
+                expires_size, consumed_bytes = self.decode_length(stream, pos)
                 pos += consumed_bytes
-                db_hash_tbl_size = int.from_bytes(
-                    stream[pos : pos + int_len], byteorder="little"
-                )
 
-                datatype, int_len, consumed_bytes = self.decode_length_encoding(
-                    stream, pos
-                )
+                yield self._state, db_size, expires_size, -1
+
+            elif opcode == 0xF8:  # LRU idle time of the next key
+                _, consumed_bytes = self.decode_length(stream, pos)
                 pos += consumed_bytes
-                exp_hash_tbl_size = int.from_bytes(
-                    stream[pos : pos + int_len], byteorder="little"
-                )
 
-            elif opcode == 0xFF:  # End of file marker
-                # CRC64 checksum disabled
-                if not self._rdbchecksum:
-                    break
+            elif opcode == 0xF9:  # LFU frequency of the next key
+                pos += 1
+
+            elif opcode == 0xF5:  # Function library
+                _, consumed_bytes = self.read_string(stream, pos)
+                pos += consumed_bytes
+
+            elif opcode == 0xF4:  # Cluster slot info
+                for _ in range(3):
+                    _, consumed_bytes = self.decode_length(stream, pos)
+                    pos += consumed_bytes
+
+            elif opcode == 0xF7:  # Module auxiliary data
+                raise ValueError("Module data not supported")
 
-                # Verify CRC64 checksum
-                # expected_crc = struct.unpack('>Q', stream[pos:pos+8])[0]
-                # calculator = crc.Calculator(crc.Crc64.CRC64)
-                # actual_crc = calculator.checksum(stream[:pos])
-                # if actual_crc != expected_crc:
-                #    print("CRC64 checksum verification failed")
-                #    #raise ValueError("CRC64 checksum verification failed")
+            elif opcode == 0xFF:  # End of file marker
+                self._state = "eof"
+
+                # Verify CRC64 checksum, present since version 5. Zero means
+                # the file was written with checksums disabled.
+                expected_crc = int.from_bytes(stream[pos : pos + 8], "little")
+                if self._rdbchecksum and version >= 5 and expected_crc != 0:
+                    crc = crc64(crc, stream[crc_pos:pos])
+                    if crc != expected_crc:
+                        raise ValueError(
+                            f"Wrong RDB checksum expected: ({expected_crc:016x}) "
+                            f"got: ({crc:016x})"
+                        )
 
-                break  # End of file, stop parsing
+                # End of file, stop parsing. The payload may be followed by
+                # other data, such as the commands of an AOF.
+                self._state = "chksum"
+                yield self._state, "RDB end", pos + (8 if version >= 5 else 0), -1
+                break
 
             else:
-                if self._state[:3] != "key":
+                if self._state[:7] != "key_val":
                     self._state = "key_val"
 
-                pos -= 1
-
-                value_type = stream[pos]
-                pos += 1
+                value_type = opcode
 
                 key, consumed_bytes = self.decode_string_encoding(stream, pos)
                 pos += consumed_bytes
 
-                # Parse value based on type
-                if value_type == 0:  # String encoded as a Redis string
+                if value_type == RDBparser.TYPE_STRING:
                     value, consumed_bytes = self.decode_string_encoding(stream, pos)
-                    pos += consumed_bytes
-                elif value_type == 1:  # List
-                    pass
-                elif value_type == 2:  # Set
-                    pass
-
-                if "expiry" in locals():
-                    yield self._state, key, value, expiry
-                    del expiry
                 else:
-                    yield self._state, key, value, -1
+                    value, consumed_bytes = self.decode_value(value_type, stream, pos)
+                pos += consumed_bytes
 
+                yield self._state, key, value, expiry
 
-def rdb_contents():
-    hex_data = "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e3bfec0ff5aa2"
+                self._state = "key_val"
+                expiry = -1
 
-    return bytes.fromhex(hex_data)
 
+class RDBwriter(object):
+    """
+    Serializes the keyspace in the RDB format: strings (integer encoded
+    when possible), millisecond expiries, streams as listpack nodes and the
+    other containers in their plain encodings.
+    """
 
-def check_expiry():
-    global store
-    CHECK_INTERVAL = 300  # seconds
+    VERSION = 11
 
-    while True:
-        MAX_LOT_SIZE = 20
+    TYPE_STRING = RDBparser.TYPE_STRING
+    TYPE_LIST = RDBparser.TYPE_LIST
+    TYPE_SET = RDBparser.TYPE_SET
+    TYPE_HASH = RDBparser.TYPE_HASH
+    TYPE_ZSET_2 = RDBparser.TYPE_ZSET_2
+    TYPE_STREAM_LISTPACKS = RDBparser.TYPE_STREAM_LISTPACKS
 
-        store_keys = list(store.keys())
-        store_size = len(store_keys)
-        if store_size > 0:
-            lot_size = store_size if store_size < MAX_LOT_SIZE else MAX_LOT_SIZE
-            selected = random.sample(store_keys, lot_size)
-            for key in selected:
-                store.expired(key)
+    STREAM_NODE_MAX_ENTRIES = 100
 
-        time.sleep(CHECK_INTERVAL)
+    # Stream listpack entry flags
+    STREAM_ITEM_FLAG_NONE = 0
+    STREAM_ITEM_FLAG_DELETED = 1
+    STREAM_ITEM_FLAG_SAMEFIELDS = 2
 
+    # Output is checksummed and written in chunks of this size
+    BUFFER_SIZE = 1024 * 1024
 
-def handle_master_conn(host, port):
-    global server
-    global repl_offset
+    def __init__(self, f, rdbchecksum: bool = True):
+        self._f = f
+        self._buf = bytearray()
+        self._rdbchecksum = rdbchecksum
+        self._crc = 0
 
-    print("Connecting to master")
+    def write(self, data: bytes):
+        self._buf += data
+        if len(self._buf) >= RDBwriter.BUFFER_SIZE:
+            self.flush()
 
-    master_socket = socket.create_connection((host, port))
+    def flush(self):
+        if self._rdbchecksum:
+            self._crc = crc64(self._crc, self._buf)
+        self._f.write(self._buf)
+        self._buf.clear()
 
-    ping = RESPbuilder.build(["ping"])
-    master_socket.sendall(ping)
-    master_socket.recv(4096)
-
-    replconf = RESPbuilder.build(["REPLCONF", "listening-port", str(server.port)])
-    master_socket.sendall(replconf)
-    master_socket.recv(4096)
-
-    replconf = RESPbuilder.build(["REPLCONF", "capa", "eof", "capa", "psync2"])
-    master_socket.sendall(replconf)
-    master_socket.recv(4096)
-
-    psync = RESPbuilder.build(["PSYNC", "?", "-1"])
-
-    nparsed = 0
-    data = b""
-
-    MAX_TRIES = 3
-    ntries = 0
-    while ntries < MAX_TRIES:
-        master_socket.sendall(psync)
-        # The tester driver sometimes is too eager to receive the response to
-        # PSYNC command and probably errors out if there is any delay.
-        # Receiving only as many bytes as in the response will avoid post
-        # processing and avoid the delay.
-        data = master_socket.recv(56)
-        n, token = RESPparser.parse(data)
-        nparsed = n
-        pattern = r"FULLRESYNC ([a-zA-Z0-9]{40}) (\d+)"
-        match = re.match(pattern, token)
-        if match and match.start() == 0 and match.end() == len(token):
-            break
+    @staticmethod
+    def encode_length(n: int):
+        if n < (1 << 6):
+            return bytes((n,))
+        elif n < (1 << 14):
+            return bytes((0x40 | (n >> 8), n & 0xFF))
+        elif n <= 0xFFFFFFFF:
+            return b"\x80" + struct.pack(">I", n)
+        return b"\x81" + struct.pack(">Q", n)
 
-        ntries += 1
+    @staticmethod
+    def int_value(s: str):
+        """
+        Returns s as an int if it's the canonical form of a 32-bit integer,
+        otherwise None.
+        """
+        if not 0 < len(s) <= 11 or not s.isascii():
+            return None
+        if not (s.isdigit() or (s[0] == "-" and s[1:].isdigit())):
+            return None
 
-    if ntries == MAX_TRIES:
-        print(f"Error reading replica sync data")
-        master_socket.close()
-        return
+        n = int(s)
+        if str(n) != s or not -(1 << 31) <= n < (1 << 31):
+            return None
+        return n
 
-    rdblen = 0
-    rdbdata = b""
+    @staticmethod
+    def encode_string(s: Union[str, bytes]):
+        if isinstance(s, str):
+            n = RDBwriter.int_value(s)
+            if n is not None:
+                if -(1 << 7) <= n < (1 << 7):
+                    return b"\xc0" + struct.pack("<b", n)
+                elif -(1 << 15) <= n < (1 << 15):
+                    return b"\xc1" + struct.pack("<h", n)
+                return b"\xc2" + struct.pack("<i", n)
 
-    # check if any data is left and parse it
-    if nparsed < len(data):
-        line = data[nparsed:].splitlines(keepends=True)[0]
-        n, line = RESPBytes(line).rstrip_all(b"\r\n")
-        if not line.startswith(b"$"):
-            print("Error reading bulk length while SYNCing")
-            master_socket.close()
-            return
-        try:
-            rdblen = int(line[1:])
-        except ValueError as ve:
-            print("Error reading bulk length while SYNCing")
-            master_socket.close()
-            return
-        # extract rdb data
-        rdbdata = data[
-            nparsed + (n * 2) + len(line) : nparsed + (n * 2) + len(line) + rdblen
-        ]
-        nparsed += (n * 2) + len(line) + len(rdbdata)
-        rdblen -= len(rdbdata)
+            s = s.encode("utf-8", "surrogateescape")
 
-    # wait for RDB file
-    while True:
-        if len(rdbdata) == 0:
-            data = master_socket.recv(4096)
-            lines = data.splitlines(keepends=True)[0]
-            n, line = RESPBytes(lines).rstrip_all(b"\r\n")
-            if not line.startswith(b"$"):
-                print("Error reading bulk length while SYNCing")
-                master_socket.close()
-                return
-            try:
-                rdblen = int(line[1:])
-            except ValueError as ve:
-                print("Error reading bulk length while SYNCing")
-                master_socket.close()
-                return
-            # extract rdb data
-            rdbdata = data[(n * 2) + len(line) : (n * 2) + len(line) + rdblen]
-            nparsed = (n * 2) + len(line) + len(rdbdata)
-            rdblen -= len(rdbdata)
+        return RDBwriter.encode_length(len(s)) + s
+
+    # Listpacks
+
+    @staticmethod
+    def lp_backlen(n: int):
+        if n <= 127:
+            return bytes((n,))
+        elif n < 16383:
+            return bytes((n >> 7, (n & 127) | 128))
+        elif n < 2097151:
+            return bytes((n >> 14, ((n >> 7) & 127) | 128, (n & 127) | 128))
+        elif n < 268435455:
+            return bytes(
+                (
+                    n >> 21,
+                    ((n >> 14) & 127) | 128,
+                    ((n >> 7) & 127) | 128,
+                    (n & 127) | 128,
+                )
+            )
+        return bytes(
+            (
+                n >> 28,
+                ((n >> 21) & 127) | 128,
+                ((n >> 14) & 127) | 128,
+                ((n >> 7) & 127) | 128,
+                (n & 127) | 128,
+            )
+        )
+
+    @staticmethod
+    def lp_encode_int(n: int):
+        if 0 <= n <= 127:
+            enc = bytes((n,))
+        elif -4096 <= n < 4096:
+            n &= 0x1FFF
+            enc = bytes((0xC0 | (n >> 8), n & 0xFF))
+        elif -(1 << 15) <= n < (1 << 15):
+            enc = b"\xf1" + struct.pack("<h", n)
+        elif -(1 << 23) <= n < (1 << 23):
+            enc = b"\xf2" + struct.pack("<i", n)[:3]
+        elif -(1 << 31) <= n < (1 << 31):
+            enc = b"\xf3" + struct.pack("<i", n)
+        else:
+            enc = b"\xf4" + struct.pack("<q", n)
+        return enc + RDBwriter.lp_backlen(len(enc))
+
+    @staticmethod
+    def lp_encode(value: Union[str, int]):
+        if isinstance(value, int):
+            return RDBwriter.lp_encode_int(value)
+
+        n = RDBwriter.int_value(value)
+        if n is not None:
+            return RDBwriter.lp_encode_int(n)
+
+        data = value.encode("utf-8", "surrogateescape")
+        size = len(data)
+        if size < 64:
+            enc = bytes((0x80 | size,)) + data
+        elif size < 4096:
+            enc = bytes((0xE0 | (size >> 8), size & 0xFF)) + data
+        else:
+            enc = b"\xf0" + struct.pack("<I", size) + data
+        return enc + RDBwriter.lp_backlen(len(enc))
+
+    @staticmethod
+    def listpack(elements: list):
+        body = b"".join(elements)
+        nelements = len(elements) if len(elements) < 65535 else 65535
+        return struct.pack("<IH", 6 + len(body) + 1, nelements) + body + b"\xff"
+
+    def encode_stream(self, stream: Stream):
+        """
+        Encodes a stream as RDB_TYPE_STREAM_LISTPACKS: listpack nodes keyed
+        by their master ID, each starting with a master entry holding the
+        field names that the following entries can share.
+        """
+        lp_encode = RDBwriter.lp_encode
+        nentries = len(stream)
+        nodes = []
+
+        for start in range(0, nentries, RDBwriter.STREAM_NODE_MAX_ENTRIES):
+            end = min(nentries, start + RDBwriter.STREAM_NODE_MAX_ENTRIES)
+            master_ms, master_seq, master_names, _ = stream.entry_parts(start)
+
+            # Master entry: count, deleted, fields, names, "0" terminator
+            elements = [lp_encode(end - start), lp_encode(0), lp_encode(len(master_names))]
+            elements += [lp_encode(name) for name in master_names]
+            elements.append(lp_encode(0))
+
+            for idx in range(start, end):
+                ms, seq, names, values = stream.entry_parts(idx)
+                if names is master_names or names == master_names:
+                    elements += [
+                        lp_encode(RDBwriter.STREAM_ITEM_FLAG_SAMEFIELDS),
+                        lp_encode(ms - master_ms),
+                        lp_encode(seq - master_seq),
+                    ]
+                    elements += [lp_encode(value) for value in values]
+                    lp_count = len(values) + 3
+                else:
+                    elements += [
+                        lp_encode(RDBwriter.STREAM_ITEM_FLAG_NONE),
+                        lp_encode(ms - master_ms),
+                        lp_encode(seq - master_seq),
+                        lp_encode(len(names)),
+                    ]
+                    for name, value in zip(names, values):
+                        elements += [lp_encode(name), lp_encode(value)]
+                    lp_count = 2 * len(names) + 4
+                elements.append(lp_encode(lp_count))
+
+            master_id = struct.pack(">QQ", master_ms, master_seq)
+            nodes.append(
+                RDBwriter.encode_string(master_id)
+                + RDBwriter.encode_string(RDBwriter.listpack(elements))
+            )
+
+        last_ms, last_seq = stream.last_id
+        return (
+            RDBwriter.encode_length(len(nodes))
+            + b"".join(nodes)
+            + RDBwriter.encode_length(nentries)
+            + RDBwriter.encode_length(last_ms)
+            + RDBwriter.encode_length(last_seq)
+            # No consumer groups
+            + RDBwriter.encode_length(0)
+        )
+
+    def write_aux(self, key: str, value: str):
+        self.write(b"\xfa" + self.encode_string(key) + self.encode_string(value))
+
+    def write_header(self, used_memory: int = 0):
+        self.write(b"REDIS%04d" % RDBwriter.VERSION)
+        self.write_aux("redis-ver", "7.2.0")
+        self.write_aux("redis-bits", "64")
+        self.write_aux("ctime", str(int(time.time())))
+        self.write_aux("used-mem", str(used_memory))
+        self.write_aux("aof-base", "0")
+
+    def write_db(self, dbnum: int, nkeys: int, nexpires: int):
+        self.write(
+            b"\xfe"
+            + self.encode_length(dbnum)
+            + b"\xfb"
+            + self.encode_length(nkeys)
+            + self.encode_length(nexpires)
+        )
+
+    def write_key(self, key: str, value: Union[str, Stream], expiry: int = -1):
+        if expiry >= 0:
+            self.write(b"\xfc" + struct.pack("<Q", expiry))
+
+        encode_string = self.encode_string
+        typ = value_type(value)
+        if typ == "string":
+            self.write(
+                bytes((RDBwriter.TYPE_STRING,))
+                + encode_string(key)
+                + encode_string(value)
+            )
+        elif typ == "stream":
+            self.write(
+                bytes((RDBwriter.TYPE_STREAM_LISTPACKS,))
+                + encode_string(key)
+                + self.encode_stream(value)
+            )
+        elif typ == "zset":
+            self.write(
+                bytes((RDBwriter.TYPE_ZSET_2,))
+                + encode_string(key)
+                + self.encode_length(len(value))
+                + b"".join(
+                    encode_string(member) + struct.pack("<d", score)
+                    for member, score in value.items()
+                )
+            )
+        elif typ == "hash":
+            self.write(
+                bytes((RDBwriter.TYPE_HASH,))
+                + encode_string(key)
+                + self.encode_length(len(value))
+                + b"".join(
+                    encode_string(field) + encode_string(v)
+                    for field, v in value.items()
+                )
+            )
         else:
-            while rdblen > 0:
-                data = master_socket.recv(4096)
-                rdbdata += data
-                rdblen -= len(data)
-                nparsed = len(data)
+            self.write(
+                bytes((RDBwriter.TYPE_LIST if typ == "list" else RDBwriter.TYPE_SET,))
+                + encode_string(key)
+                + self.encode_length(len(value))
+                + b"".join(map(encode_string, value))
+            )
+
+    def write_footer(self):
+        self.write(b"\xff")
+        self.flush()
+        # A zero checksum tells the loader not to verify it
+        self._f.write(struct.pack("<Q", self._crc))
+
+    def save(self, store: "Store"):
+        """
+        Writes a full snapshot of store, whose shard locks must be held.
+        """
+        self.write_header(store.used_memory())
+        self.write_db(0, store.size(), store.expires_size())
+        for key, value, expiry in store.items():
+            self.write_key(key, value, expiry)
+        self.write_footer()
+
+
+def rdb_contents():
+    hex_data = "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e3bfec0ff5aa2"
+
+    return bytes.fromhex(hex_data)
+
+
+def server_cron():
+    while True:
+        time.sleep(1 / server.config.hz.value)
+        try:
+            server.cron()
+        except Exception as e:
+            # A failed run must not stop expiry, saves and shutdown
+            sys.stderr.write(f"Error in the server cron: {e}\n")
+
+
+class MasterLink(object):
+    """
+    Buffered reader over a replica's blocking socket to its master, for the
+    handshake and the sync payload that precede the replication stream.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+        self.buf = bytearray()
+
+    def fill(self):
+        data = self.socket.recv(16384)
+        if not data:
+            raise ConnectionError("connection closed by master")
+        self.buf += data
+
+    def read_line(self):
+        while True:
+            # Masters send newlines to keep the link alive until the payload
+            while self.buf[:1] == b"\n":
+                del self.buf[:1]
+            nl = self.buf.find(b"\r\n")
+            if nl >= 0:
+                break
+            self.fill()
+
+        line = self.buf[:nl].decode()
+        del self.buf[: nl + 2]
+        return line
+
+    def read_exact(self, n: int):
+        while len(self.buf) < n:
+            self.fill()
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def command(self, *argv):
+        self.socket.sendall(RESPbuilder.build(list(argv)))
+        return self.read_line()
+
+
+def handle_master_conn(host: str, port: int, gen: int):
+    """
+    Replicates host:port until the master changes, reconnecting after a
+    link failure. Reconnections continue the stream with PSYNC.
+    """
+    while server.master_link_gen == gen:
+        try:
+            sync_with_master(host, port, gen)
+        except (OSError, ValueError, RuntimeError) as e:
+            if server.master_link_gen != gen:
+                break
+            sys.stderr.write(f"Error on the link with MASTER {host}:{port}: {e}\n")
+
+        if server.master_link_gen != gen:
             break
+        server.master_link_status = "down"
+        time.sleep(1)
 
-    print("Master-slave handshake complete")
 
-    if len(data[nparsed:]) > 0:
-        data = data[nparsed:]
-        datalen = len(data)
-        at = 0
-        while at < datalen:
-            n, tokens = RESPparser.parse(data[at:])
-            command, *args = tokens
-            response = server.process_command(command, args)
-            if response and len(response) > 0:
-                master_socket.sendall(response)
-            repl_offset += n
-            at += n
+def sync_with_master(host: str, port: int, gen: int):
+    print(f"Connecting to MASTER {host}:{port}")
+    master_socket = socket.create_connection((host, port))
+    if server.master_link_gen != gen:
+        master_socket.close()
+        return
+    server.master_socket = master_socket
+    link = MasterLink(master_socket)
 
     with master_socket:
+        reply = link.command("PING")
+        if reply.startswith("-"):
+            raise ValueError(f"Error reply to PING from master: {reply}")
+        link.command("REPLCONF", "listening-port", str(server.port))
+        link.command("REPLCONF", "capa", "eof", "capa", "psync2")
+
+        if server.cached_master:
+            # Try to continue from where this server's history stops
+            psync_replid = server.master_replid
+            psync_offset = str(server.master_repl_offset + 1)
+        else:
+            psync_replid, psync_offset = "?", "-1"
+
+        reply = link.command("PSYNC", psync_replid, psync_offset)
+        if reply.startswith("+FULLRESYNC"):
+            _, replid, offset = reply.split()
+            # The dataset the sub-replicas follow is about to be replaced
+            server.disconnect_replicas()
+            server.master_sync_in_progress = True
+            try:
+                db = read_sync_payload(link)
+            finally:
+                server.master_sync_in_progress = False
+            with server.repl_lock:
+                server.replace_dataset(db)
+                server.master_replid = replid
+                server.master_repl_offset = int(offset)
+                server.replid2 = "0" * 40
+                server.second_replid_offset = -1
+                # The history before the snapshot is not ours anymore
+                server.repl_backlog = None
+                server.create_replication_backlog()
+            print("MASTER <-> REPLICA sync: Finished with success")
+
+        elif reply.startswith("+CONTINUE"):
+            _, *replid = reply.split()
+            with server.repl_lock:
+                if replid and replid[0] != server.master_replid:
+                    # The master was promoted, the old ID stays valid for
+                    # this server's replicas up to here
+                    server.replid2 = server.master_replid
+                    server.second_replid_offset = server.master_repl_offset + 1
+                    server.master_replid = replid[0]
+                    server.disconnect_replicas()
+                server.create_replication_backlog()
+            print("MASTER <-> REPLICA sync: Master accepted a Partial Resynchronization.")
+
+        else:
+            raise ValueError(f"Unexpected reply to PSYNC from master: {reply}")
+
+        server.cached_master = True
+        server.master_link_offset = server.master_repl_offset
+        server.master_last_io = time.time()
+        server.master_link_status = "up"
+        print("Master-slave handshake complete")
+
+        # The writes buffered during the transfer arrive as one burst, with
+        # commands split across reads
+        parser = RESPparser()
+        # Received bytes not applied yet
+        raw = bytearray(link.buf)
+        parser.feed(raw)
+        # Reads wake up in time for the periodic ACK on an idle link
+        master_socket.settimeout(Server.REPL_ACK_PERIOD)
+        last_ack = 0
         while True:
-            data = master_socket.recv(4096)
-            #print(f'Received from master: {data}')
-            if not data:
-                break
+            now = time.monotonic()
+            if now - last_ack >= Server.REPL_ACK_PERIOD:
+                # Lets the master track the lag of this replica
+                master_socket.sendall(
+                    RESPbuilder.build(
+                        ["REPLCONF", "ACK", str(server.master_link_offset)]
+                    )
+                )
+                last_ack = now
 
-            datalen = len(data)
-            at = 0
-            while at < datalen:
-                n, tokens = RESPparser.parse(data[at:])
-                command, *args = tokens
-                response = server.process_command(command, args)
-                if response and len(response) > 0:
-                    master_socket.sendall(response)
-                repl_offset += n
-                at += n
+            frames = parser.get_commands(Server.REPL_APPLY_BATCH)
+            if frames:
+                del raw[: server.apply_master_commands(frames, raw, master_socket)]
+                if len(frames) == Server.REPL_APPLY_BATCH:
+                    continue
+
+            try:
+                chunk = master_socket.recv(Server.REPL_TRANSFER_CHUNK)
+            except socket.timeout:
+                continue
+            if not chunk:
+                raise ConnectionError("connection closed by master")
+            server.master_last_io = time.time()
+            parser.feed(chunk)
+            raw += chunk
+
+
+class SyncPayload(object):
+    """
+    The snapshot sent by the master for a full resynchronization, as a
+    bytes-like object RDBparser decodes while it arrives: indexing past the
+    received bytes reads more from the link. Bytes before the offset given
+    to release() are dropped, so the payload is never held as a whole.
+    """
+
+    def __init__(self, link: MasterLink, length: int = -1):
+        self._link = link
+        # -1 when delimited by an end mark, see send_rdb_pipe_to_replicas()
+        self._length = length
+        # Payload offset of link.buf[0]
+        self._base = 0
+
+    def __len__(self):
+        # With no length, the parse stops at the RDB end opcode
+        return self._length if self._length >= 0 else sys.maxsize
+
+    def _ensure(self, end: int):
+        while len(self._link.buf) < end - self._base:
+            self._link.fill()
+
+    def __getitem__(self, key):
+        base = self._base
+        if isinstance(key, slice):
+            start = key.start or 0
+            stop = key.stop if self._length < 0 else min(key.stop, self._length)
+            if stop - base > len(self._link.buf):
+                self._ensure(stop)
+            return self._link.buf[start - base : stop - base]
+
+        if key - base >= len(self._link.buf):
+            self._ensure(key + 1)
+        return self._link.buf[key - base]
+
+    def release(self, pos: int):
+        self._ensure(pos)
+        del self._link.buf[: pos - self._base]
+        self._base = pos
+
+
+def read_sync_payload(link: MasterLink):
+    """
+    Loads the snapshot sent by the master for a full resynchronization
+    into a new store as it is received, the dataset being served is kept
+    until it is complete.
+    """
+    line = link.read_line()
+    if not line.startswith("$"):
+        raise ValueError("Bad protocol from MASTER, the first byte is not '$'")
+
+    if line.startswith("$EOF:"):
+        mark = line[5:].encode()
+        payload = SyncPayload(link)
+        print("MASTER <-> REPLICA sync: receiving streamed RDB from master")
+    else:
+        mark = None
+        payload = SyncPayload(link, int(line[1:]))
+        print(f"MASTER <-> REPLICA sync: receiving {line[1:]} bytes from master")
+
+    db = Store.detached()
+    start = time.perf_counter()
+    end = server.load_rdb(payload, db)
+
+    if mark is not None:
+        if payload[end : end + len(mark)] != mark:
+            raise ValueError("Bad end mark of the RDB payload from MASTER")
+        end += len(mark)
+    else:
+        end = len(payload)
+    payload.release(end)
+
+    print(
+        f"MASTER <-> REPLICA sync: loaded {db.size()} keys in "
+        f"{time.perf_counter() - start:.3f} seconds"
+    )
+    return db
 
 
 # Globals
 store = Store()
 server = None
-repl_offset = 0
 connections = []
 
 
 def main():
     global server
-    global repl_offset
 
     parser = argparse.ArgumentParser(description="Dummy Redis Server")
     parser.add_argument("--port", type=int, help="Port number")
@@ -1548,7 +6614,113 @@ def main():
     )
     parser.add_argument("--dbfilename", type=str, help="Name of the RDB file")
     parser.add_argument(
-        "--rdbchecksum", action="store_true", help="Enable CRC64 checksum"
+        "--rdbchecksum",
+        nargs="?",
+        const="yes",
+        default="yes",
+        choices=("yes", "no"),
+        help="Write and verify CRC64 checksums of RDB files",
+    )
+    parser.add_argument(
+        "--event-loop",
+        action="store_true",
+        help="Serve clients from a single-threaded event loop",
+    )
+    parser.add_argument(
+        "--maxclients", type=int, help="Max number of connected clients"
+    )
+    parser.add_argument(
+        "--tcp-backlog", type=int, default=511, help="Listen backlog size"
+    )
+    parser.add_argument(
+        "--output-flush-size",
+        type=int,
+        default=64 * 1024,
+        help="Flush pipelined replies once this many bytes are buffered",
+    )
+    parser.add_argument(
+        "--slowlog-log-slower-than",
+        type=int,
+        default=10000,
+        help="Log commands slower than this many microseconds, -1 disables",
+    )
+    parser.add_argument(
+        "--slowlog-max-len", type=int, default=128, help="Slow log length"
+    )
+    parser.add_argument(
+        "--maxmemory",
+        type=parse_memory,
+        default=0,
+        help="Memory limit for the dataset (e.g. 100mb), 0 means no limit",
+    )
+    parser.add_argument(
+        "--maxmemory-policy",
+        default="noeviction",
+        choices=ServerConfig.maxmemory_policy.choices,
+        help="How to make room when maxmemory is reached",
+    )
+    parser.add_argument(
+        "--save",
+        default="3600 1 300 100 60 10000",
+        help='Snapshot rules as "<seconds> <changes> ...", "" disables them',
+    )
+    parser.add_argument(
+        "--appendonly",
+        default="no",
+        choices=("yes", "no"),
+        help="Log every write command to the append only file",
+    )
+    parser.add_argument(
+        "--appendfilename",
+        default="appendonly.aof",
+        help="Name of the append only file",
+    )
+    parser.add_argument(
+        "--appendfsync",
+        default="everysec",
+        choices=ServerConfig.appendfsync.choices,
+        help="When to fsync the append only file",
+    )
+    parser.add_argument(
+        "--auto-aof-rewrite-percentage",
+        type=int,
+        default=100,
+        help="Rewrite the AOF when it grew by this much since the last rewrite, 0 disables",
+    )
+    parser.add_argument(
+        "--auto-aof-rewrite-min-size",
+        type=parse_memory,
+        default=64 * 1024 * 1024,
+        help="Smallest AOF size for automatic rewrites",
+    )
+    parser.add_argument(
+        "--repl-backlog-size",
+        type=parse_memory,
+        default=1024 * 1024,
+        help="Size of the replication backlog partial resyncs are served from",
+    )
+    parser.add_argument(
+        "--client-output-buffer-limit",
+        default="normal 0 0 0 replica 256mb 64mb 60 pubsub 32mb 8mb 60",
+        help="Output buffer limits as <class> <hard> <soft> <soft seconds> groups",
+    )
+    parser.add_argument(
+        "--repl-diskless-sync",
+        choices=("yes", "no"),
+        default="no",
+        help="Stream snapshots to replicas without writing them to disk",
+    )
+    parser.add_argument(
+        "--repl-diskless-sync-delay",
+        type=int,
+        default=5,
+        help="Seconds to wait for more replicas before a diskless transfer",
+    )
+    parser.add_argument(
+        "--hz",
+        type=int,
+        default=10,
+        help="Frequency of background tasks such as active key expiry, 1 to 500",
     )
 
     args = parser.parse_args()
@@ -1556,10 +6728,28 @@ def main():
     # Configuration
     dirpath = args.dir if args.dir else "./"
     dbfilename = args.dbfilename if args.dbfilename else "dump.rdb"
-    rdbchecksum = args.rdbchecksum if args.rdbchecksum else True
+    rdbchecksum = args.rdbchecksum == "yes"
 
     config = ServerConfig(
-        rdbchecksum=rdbchecksum, dirpath=dirpath, dbfilename=dbfilename
+        rdbchecksum=rdbchecksum,
+        dirpath=dirpath,
+        dbfilename=dbfilename,
+        output_flush_size=args.output_flush_size,
+        slowlog_log_slower_than=args.slowlog_log_slower_than,
+        slowlog_max_len=args.slowlog_max_len,
+        hz=args.hz,
+        maxmemory=args.maxmemory,
+        maxmemory_policy=args.maxmemory_policy,
+        save=args.save,
+        appendonly=args.appendonly == "yes",
+        appendfilename=args.appendfilename,
+        appendfsync=args.appendfsync,
+        auto_aof_rewrite_percentage=args.auto_aof_rewrite_percentage,
+        auto_aof_rewrite_min_size=args.auto_aof_rewrite_min_size,
+        repl_backlog_size=args.repl_backlog_size,
+        repl_diskless_sync=args.repl_diskless_sync == "yes",
+        client_output_buffer_limit=args.client_output_buffer_limit,
+        repl_diskless_sync_delay=args.repl_diskless_sync_delay,
     )
 
     # Get port number
@@ -1568,57 +6758,83 @@ def main():
         port = args.port
 
     server = Server(config, port)
+    if args.maxclients:
+        server.maxclients = args.maxclients
 
     print(f"Running on port: {server.port}")
 
-    master_thread = None
-    # Get master host and port
-    if args.replicaof:
-        args.replicaof = args.replicaof[0].split()
-        server.role = ServerRole.SLAVE
-        master_host = args.replicaof[0]
-        master_port = args.replicaof[1]
-        print(f"Set as slave replicating {args.replicaof[0]}:{args.replicaof[1]}")
+    def request_shutdown(signum, frame):
+        # The cron saves and exits, outside of any command in flight
+        print(f"Received {signal.Signals(signum).name} scheduling shutdown...")
+        server.shutdown_asap = True
 
-        master_thread = Thread(
-            target=handle_master_conn,
-            args=(
-                master_host,
-                master_port,
-            ),
-        )
-        master_thread.start()
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
 
-    # Start thread to check for key expiry
-    expiry_thread = Thread(target=check_expiry)
-    expiry_thread.start()
+    # Get master host and port, given as one "<host> <port>" argument or two
+    if args.replicaof:
+        master_host, master_port = " ".join(args.replicaof).split()
+        print(f"Set as slave replicating {master_host}:{master_port}")
+        server.replication_set_master(master_host, int(master_port))
 
     # create socket to listen for incomming connections
     server_socket = socket.create_server(
-        ("localhost", server.port), backlog=2, reuse_port=True
+        ("localhost", server.port), backlog=args.tcp_backlog, reuse_port=True
     )
 
-    MAX_CONCURRENT_CONN = 15
-    global connections
-    num_conn = 0
+    if args.event_loop:
+        serve_event_loop(server_socket)
+    else:
+        serve_threaded(server_socket)
+
 
-    while num_conn < MAX_CONCURRENT_CONN:
+def serve_threaded(server_socket: socket.socket):
+    server.start_cron()
+
+    while True:
         client_socket, addr = server_socket.accept()  # wait for client
         conn = Connection(client_socket, addr, server)
+        server.stat_numconnections += 1
         print("Incoming connection from", addr)
-        t = Thread(target=conn.handle_connection)
+        t = Thread(target=conn.handle_connection, daemon=True)
         conn.set_thread(t)
         connections.append(conn)
         conn.start()
-        num_conn += 1
 
-    for conn in connections:
-        conn.join()
 
-    if master_thread:
-        master_thread.join()
+def serve_event_loop(server_socket: socket.socket):
+    raise_open_files_limit(server.maxclients)
+
+    loop = EventLoop()
+    loop.before_sleep = server.before_sleep
+    server.loop = loop
+
+    listener = Listener(server_socket, server, loop)
+    listener.start()
+    server.start_cron()
+
+    print("Serving clients from the event loop")
+    loop.run_forever()
+
+
+def raise_open_files_limit(maxclients: int):
+    # Each client holds a file descriptor, keep some spare for files and
+    # the listening/replication sockets.
+    try:
+        import resource
+    except ImportError:
+        return
+
+    wanted = maxclients + 32
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
 
-    expiry_thread.join()
+    limit = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    except (ValueError, OSError) as e:
+        print(f"Unable to raise open files limit to {limit}: {e}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,81 @@
+"""
+Keyspace memory benchmark: RSS bytes per key for small string keys, with
+the former dataclass element (value, expiry and access clock in an instance
+__dict__) and with the current slotted StoreElement. Each layout is
+measured in a fresh interpreter.
+
+Usage: python -m benchmarks.memory_bench [--keys 1000000]
+"""
+import argparse
+import subprocess
+import sys
+from dataclasses import dataclass
+from typing import Union
+
+from app.main import Store, Stream, rss_memory
+
+
+@dataclass
+class DataclassElement(object):
+    value: Union[str, Stream]
+    expiry: float
+    lru: int = 0
+    pos: int = 0
+
+
+def fill_dataclass(nkeys: int):
+    data = {}
+    keylist = []
+    for i in range(nkeys):
+        key = f"key:{i}"
+        data[key] = DataclassElement(f"value:{i}", -1, 0, len(keylist))
+        keylist.append(key)
+    return data, keylist
+
+
+def fill_store(nkeys: int):
+    store = Store()
+    for i in range(nkeys):
+        store.set(f"key:{i}", f"value:{i}")
+    return store
+
+
+def measure(layout: str, nkeys: int):
+    rss_before = rss_memory()
+    keyspace = fill_dataclass(nkeys) if layout == "dataclass" else fill_store(nkeys)
+    per_key = (rss_memory() - rss_before) / nkeys
+
+    line = f"{layout:<10} {per_key:8.1f} bytes/key"
+    if layout == "slots":
+        line += f"  (used_memory estimate {keyspace.used_memory() / nkeys:.1f})"
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keyspace memory benchmark")
+    parser.add_argument("--keys", type=int, default=1_000_000)
+    parser.add_argument("--layout", choices=("dataclass", "slots"))
+    args = parser.parse_args()
+
+    if args.layout:
+        measure(args.layout, args.keys)
+        return
+
+    print(f"{args.keys} small string keys")
+    for layout in ("dataclass", "slots"):
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.memory_bench",
+                "--keys",
+                str(args.keys),
+                "--layout",
+                layout,
+            ],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Replica apply benchmark: rate at which a replica applies the replication
+stream. A minimal master in this process does the handshake, sends an empty
+snapshot, then writes a burst of SETs followed by REPLCONF GETACK; the time
+until the replica acknowledges the whole burst gives its apply rate.
+
+Usage: python -m benchmarks.replication_bench [--writes 200000] [--event-loop]
+"""
+import argparse
+import io
+import socket
+import subprocess
+import sys
+import time
+
+from app.main import RDBwriter, RESPbuilder, RESPparser, Store
+
+
+def read_command(sock: socket.socket, parser: RESPparser):
+    while True:
+        result = parser.get_command()
+        if result is not None:
+            return result[1]
+        data = sock.recv(16384)
+        if not data:
+            raise ConnectionError("replica closed the connection")
+        parser.feed(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replica apply benchmark")
+    parser.add_argument("--writes", type=int, default=200_000)
+    parser.add_argument("--port", type=int, default=7379)
+    parser.add_argument("--event-loop", action="store_true")
+    args = parser.parse_args()
+
+    listener = socket.create_server(("localhost", args.port))
+    cmd = [
+        sys.executable,
+        "-m",
+        "app.main",
+        "--port",
+        str(args.port + 1),
+        "--save",
+        "",
+        "--replicaof",
+        f"localhost {args.port}",
+    ]
+    if args.event_loop:
+        cmd.append("--event-loop")
+    replica = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+
+    try:
+        sock, _ = listener.accept()
+        replies = RESPparser()
+
+        # PING, REPLCONF listening-port, REPLCONF capa
+        for _ in range(3):
+            argv = read_command(sock, replies)
+            sock.sendall(b"+PONG\r\n" if argv[0] == "PING" else b"+OK\r\n")
+
+        read_command(sock, replies)  # PSYNC
+        snapshot = io.BytesIO()
+        RDBwriter(snapshot, True).save(Store.detached())
+        payload = snapshot.getvalue()
+        sock.sendall(
+            b"+FULLRESYNC %s 0\r\n$%d\r\n%s" % (b"0" * 40, len(payload), payload)
+        )
+
+        stream = b"".join(
+            RESPbuilder.build(["SET", f"key:{i}", f"value:{i}"])
+            for i in range(args.writes)
+        )
+        # GETACK is answered with the offset of the commands before it
+        target = len(stream)
+        stream += RESPbuilder.build(["REPLCONF", "GETACK", "*"])
+        time.sleep(0.5)
+
+        start = time.perf_counter()
+        sock.sendall(stream)
+        # Replicas also send an ACK every second, wait for the whole burst
+        offset = 0
+        while offset < target:
+            argv = read_command(sock, replies)
+            assert argv[:2] == ["REPLCONF", "ACK"], argv
+            offset = int(argv[2])
+        elapsed = time.perf_counter() - start
+
+        assert offset == target, "offset mismatch"
+        print(f"{args.writes} SETs applied in {elapsed:.2f}s, "
+              f"{args.writes / elapsed:,.0f} writes/s")
+    finally:
+        replica.kill()
+        replica.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Sharded store benchmark: GET throughput with 1..N reader threads, on a
+single lock store and on a sharded one. Reads only scale with the number
+of threads on a free-threaded Python build; under the GIL the run shows the
+locking overhead.
+
+Usage: python -m benchmarks.store_bench [--keys 100000] [--ops 200000] [--threads 8]
+"""
+import argparse
+import random
+import sys
+import threading
+import time
+
+from app.main import Store
+
+
+def run(store: Store, keys: list, nthreads: int, ops: int):
+    barrier = threading.Barrier(nthreads + 1)
+
+    def reader(seed: int):
+        sample = random.Random(seed).choices(keys, k=ops)
+        barrier.wait()
+        for key in sample:
+            store.get(key)
+
+    threads = [
+        threading.Thread(target=reader, args=(i,)) for i in range(nthreads)
+    ]
+    for t in threads:
+        t.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+
+    return nthreads * ops / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded store benchmark")
+    parser.add_argument("--keys", type=int, default=100_000)
+    parser.add_argument("--ops", type=int, default=200_000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"Python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}")
+
+    keys = [f"key:{i}" for i in range(args.keys)]
+
+    for nshards in (1, Store.NSHARDS):
+        store = Store(nshards)
+        for key in keys:
+            store.set(key, "value")
+
+        base = None
+        nthreads = 1
+        while nthreads <= args.threads:
+            rate = run(store, keys, nthreads, args.ops)
+            base = base or rate
+            print(f"shards={nshards:<3} threads={nthreads:<3} "
+                  f"{rate:>12,.0f} GET/s  x{rate / base:.2f}")
+            nthreads *= 2
+
+
+if __name__ == "__main__":
+    main()
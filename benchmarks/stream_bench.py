@@ -0,0 +1,62 @@
+"""
+Stream engine benchmark: XADD throughput and XRANGE latency on large streams.
+
+Usage: python -m benchmarks.stream_bench [--entries 10000000] [--ranges 100000]
+"""
+import argparse
+import random
+import time
+
+from app.main import Store, Stream, rss_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream engine benchmark")
+    parser.add_argument("--entries", type=int, default=10_000_000)
+    parser.add_argument("--ranges", type=int, default=100_000)
+    parser.add_argument("--count", type=int, default=10)
+    args = parser.parse_args()
+
+    store = Store()
+    fields = ["sensor", "temperature", "value", "21.5"]
+
+    rss_before = rss_memory()
+    start = time.perf_counter()
+    for i in range(args.entries):
+        store.append("stream", f"{i // 4 + 1}-*", fields)
+    elapsed = time.perf_counter() - start
+
+    stream = store.get("stream")
+    print(f"XADD: {args.entries} entries in {elapsed:.2f}s "
+          f"({args.entries / elapsed:,.0f} ops/s)")
+    print(f"RSS growth: {(rss_memory() - rss_before) / args.entries:.1f} bytes/entry")
+
+    last_ms = stream.last_id[0]
+    start = time.perf_counter()
+    nentries = 0
+    for _ in range(args.ranges):
+        lo = stream.lower_bound(random.randint(1, last_ms), 0)
+        for _ in stream.entries(lo, min(len(stream), lo + args.count)):
+            nentries += 1
+    elapsed = time.perf_counter() - start
+
+    print(f"XRANGE COUNT {args.count}: {args.ranges} lookups in {elapsed:.2f}s "
+          f"({elapsed / args.ranges * 1e6:.1f} usec/lookup, {nentries} entries)")
+
+    # Lookup cost must stay logarithmic in the stream length
+    small = Stream()
+    for i in range(1_000):
+        small.add(i // 4 + 1, i % 4, fields)
+
+    for probe in (small, stream):
+        last_ms = probe.last_id[0]
+        start = time.perf_counter()
+        for _ in range(args.ranges):
+            probe.lower_bound(random.randint(1, last_ms), 0)
+        elapsed = time.perf_counter() - start
+        print(f"lower_bound on {len(probe)} entries: "
+              f"{elapsed / args.ranges * 1e6:.2f} usec")
+
+
+if __name__ == "__main__":
+    main()